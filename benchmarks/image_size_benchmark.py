@@ -0,0 +1,387 @@
+"""
+Micro-benchmark for get_image_size on a synthetic corpus.
+
+Generates images of every supported format in memory, including worst cases
+like JPEGs with large EXIF/ICC segments or hundreds of markers before the frame
+header, and measures for each image:
+
+- the wall time of get_image_size on a buffer holding the entire file,
+- the number of bytes the parser needs, in the ranges it asks for,
+- the bytes and range requests the upload processor fetches with its ranged
+  reads, starting at --initial-range-bytes. The processor's RangedObjectReader
+  runs against an in-memory stand-in of S3 which counts the GETs and bytes.
+
+Runs offline, without AWS access. Results are written as JSON, and a previous
+results file can be passed with --compare to print the relative differences.
+
+Usage:
+    python benchmarks/image_size_benchmark.py --output bench_results.json
+    python benchmarks/image_size_benchmark.py --compare bench_results.json
+"""
+
+# Standard library imports
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "lambda_functions", "s3_upload_processor"))
+
+# Third party imports
+from botocore.exceptions import (  # pylint: disable=wrong-import-position
+    ClientError,
+)
+
+# Local application/library specific imports
+from image_size import (  # pylint: disable=import-error,wrong-import-position
+    NeedMoreData,
+    SparseData,
+    get_image_size,
+)
+from ranged_reader import (  # pylint: disable=import-error,wrong-import-position
+    RangedObjectReader,
+)
+
+REFERENCE_PNG = os.path.join(
+    REPO_ROOT, "integration_tests", "arrange_act_s3_upload", "example.png"
+)
+
+
+def png(width, height):
+    """Return a PNG with a single, empty IDAT chunk."""
+
+    def chunk(chunk_type, data):
+        crc = zlib.crc32(chunk_type + data)
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    idat = zlib.compress(b"\x00" * (1 + width * 3) * min(height, 16))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", ihdr)
+        + chunk(b"IDAT", idat)
+        + chunk(b"IEND", b"")
+    )
+
+
+def gif(width, height):
+    """Return a GIF with a two color palette and an empty image."""
+    screen = struct.pack("<HHBBB", width, height, 0x80, 0, 0) + b"\x00" * 6
+    image = b"," + struct.pack("<HHHHB", 0, 0, width, height, 0) + b"\x02\x00"
+    return b"GIF89a" + screen + image + b";"
+
+
+def jpeg_segment(marker, payload):
+    """Return a JPEG marker segment."""
+    return struct.pack(">BBH", 0xFF, marker, len(payload) + 2) + payload
+
+
+def jpeg(
+    width,
+    height,
+    sof_marker=0xC0,
+    exif_bytes=0,
+    icc_bytes=0,
+    extra_markers=0,
+    scan_bytes=4096,
+):
+    """Return a JPEG with configurable metadata segments before the frame header."""
+    segments = [
+        b"\xff\xd8",
+        jpeg_segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"),
+    ]
+    if exif_bytes:
+        segments.append(jpeg_segment(0xE1, b"Exif\x00\x00" + b"\x00" * exif_bytes))
+    # ICC profiles are split in APP2 segments of at most 64 KiB
+    chunk_count = -(-icc_bytes // 65000)
+    for chunk_number in range(chunk_count):
+        payload = b"\x00" * min(65000, icc_bytes - chunk_number * 65000)
+        segments.append(
+            jpeg_segment(
+                0xE2,
+                b"ICC_PROFILE\x00" + bytes([chunk_number + 1, chunk_count]) + payload,
+            )
+        )
+    for marker_number in range(extra_markers):
+        segments.append(jpeg_segment(0xFE, f"comment {marker_number}".encode()))
+    segments.append(jpeg_segment(0xDB, b"\x00" + bytes(range(64))))
+    segments.append(
+        jpeg_segment(
+            sof_marker,
+            struct.pack(">BHHB", 8, height, width, 3)
+            + b"\x01\x22\x00\x02\x11\x00\x03\x11\x00",
+        )
+    )
+    segments.append(jpeg_segment(0xC4, b"\x00" + b"\x00" * 16))
+    segments.append(jpeg_segment(0xDA, b"\x03\x01\x00\x02\x11\x03\x11\x00\x3f\x00"))
+    segments.append(b"\x55" * scan_bytes + b"\xff\xd9")
+    return b"".join(segments)
+
+
+def riff_webp(chunk_type, data):
+    """Wrap a single chunk in a RIFF WEBP container."""
+    chunk = chunk_type + struct.pack("<I", len(data)) + data
+    return b"RIFF" + struct.pack("<I", 4 + len(chunk)) + b"WEBP" + chunk
+
+
+def webp_lossy(width, height):
+    """Return a VP8 (lossy) WebP."""
+    frame = b"\x00\x00\x00" + b"\x9d\x01\x2a" + struct.pack("<HH", width, height)
+    return riff_webp(b"VP8 ", frame + b"\x00" * 64)
+
+
+def webp_lossless(width, height):
+    """Return a VP8L (lossless) WebP."""
+    bits = (width - 1) | ((height - 1) << 14)
+    return riff_webp(b"VP8L", b"\x2f" + struct.pack("<I", bits) + b"\x00" * 64)
+
+
+def webp_extended(width, height):
+    """Return a VP8X (extended) WebP."""
+    canvas = (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")
+    return riff_webp(b"VP8X", b"\x10\x00\x00\x00" + canvas)
+
+
+def bmp(width, height):
+    """Return a BMP with a BITMAPINFOHEADER and top-down rows."""
+    dib = struct.pack("<IiiHHIIiiII", 40, width, -height, 1, 24, 0, 0, 0, 0, 0, 0)
+    return b"BM" + struct.pack("<IHHI", 14 + len(dib), 0, 0, 14 + len(dib)) + dib
+
+
+def tiff(width, height, byte_order="<", pixel_bytes=0):
+    """Return a TIFF, with the IFD after pixel_bytes of image data."""
+    magic = b"II*\x00" if byte_order == "<" else b"MM\x00*"
+    ifd_offset = 8 + pixel_bytes
+    entries = [(256, 4, 1, width), (257, 3, 1, height), (258, 3, 1, 8)]
+    ifd = struct.pack(f"{byte_order}H", len(entries))
+    for tag, field_type, count, value in entries:
+        if field_type == 3:
+            value_field = struct.pack(f"{byte_order}HH", value, 0)
+        else:
+            value_field = struct.pack(f"{byte_order}I", value)
+        ifd += struct.pack(f"{byte_order}HHI", tag, field_type, count) + value_field
+    ifd += struct.pack(f"{byte_order}I", 0)
+    return (
+        magic + struct.pack(f"{byte_order}I", ifd_offset) + b"\x00" * pixel_bytes + ifd
+    )
+
+
+def heif(width, height, brand=b"heic"):
+    """Return a HEIF/AVIF with a thumbnail and a full size ispe property."""
+
+    def box(box_type, payload):
+        return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+    def ispe(box_width, box_height):
+        return box(
+            b"ispe", b"\x00\x00\x00\x00" + struct.pack(">II", box_width, box_height)
+        )
+
+    ipco = box(b"ipco", ispe(width // 8, height // 8) + ispe(width, height))
+    meta = box(
+        b"meta",
+        b"\x00\x00\x00\x00"
+        + box(b"hdlr", b"\x00" * 4 + b"\x00" * 4 + b"pict" + b"\x00" * 13)
+        + box(b"iprp", ipco),
+    )
+    return (
+        box(b"ftyp", brand + b"\x00\x00\x00\x00mif1" + brand)
+        + meta
+        + box(b"mdat", b"\x00" * 1024)
+    )
+
+
+def build_corpus():
+    """Return (name, data, expected dimensions) for every benchmark image."""
+    corpus = [
+        ("png", png(640, 480), (640, 480)),
+        ("gif", gif(640, 480), (640, 480)),
+        ("jpeg_baseline", jpeg(4000, 3000), (4000, 3000)),
+        ("jpeg_progressive", jpeg(4000, 3000, sof_marker=0xC2), (4000, 3000)),
+        (
+            "jpeg_exif_64k",
+            jpeg(6000, 4000, exif_bytes=64000),
+            (6000, 4000),
+        ),
+        (
+            "jpeg_exif_icc_1m",
+            jpeg(6000, 4000, exif_bytes=64000, icc_bytes=1024**2),
+            (6000, 4000),
+        ),
+        (
+            "jpeg_500_markers",
+            jpeg(6000, 4000, extra_markers=500),
+            (6000, 4000),
+        ),
+        ("webp_vp8", webp_lossy(1920, 1080), (1920, 1080)),
+        ("webp_vp8l", webp_lossless(1920, 1080), (1920, 1080)),
+        ("webp_vp8x", webp_extended(1920, 1080), (1920, 1080)),
+        ("bmp", bmp(800, 600), (800, 600)),
+        ("tiff_le", tiff(5000, 4000), (5000, 4000)),
+        ("tiff_be", tiff(5000, 4000, byte_order=">"), (5000, 4000)),
+        (
+            "tiff_ifd_after_8m_pixels",
+            tiff(5000, 4000, pixel_bytes=8 * 1024**2),
+            (5000, 4000),
+        ),
+        ("heic", heif(4032, 3024), (4032, 3024)),
+        ("avif", heif(4032, 3024, brand=b"avif"), (4032, 3024)),
+    ]
+    with open(REFERENCE_PNG, "rb") as reference_file:
+        corpus.append(("reference_example_png", reference_file.read(), (172, 178)))
+    return corpus
+
+
+def bytes_required(data):
+    """Return how many bytes of the file the parser needs, in all ranges."""
+    sparse = SparseData()
+    while True:
+        try:
+            get_image_size(sparse)
+            return sum(len(chunk) for chunk in sparse.ranges.values())
+        except NeedMoreData as exc:
+            if exc.offset + exc.length > len(data):
+                raise RuntimeError("Parser needs more bytes than the file has") from exc
+            sparse.add(exc.offset, data[exc.offset : exc.offset + exc.length])
+
+
+class StubS3Client:
+    """In-memory stand-in for S3 GetObject, which counts requests and bytes."""
+
+    def __init__(self, data):
+        """Serve data as the only object."""
+        self.data = data
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def get_object(self, Bucket, Key, Range):  # pylint: disable=invalid-name
+        """Return a range of the object like S3 does."""
+        del Bucket, Key
+        first, last = (int(position) for position in Range[6:].split("-"))
+        if first >= len(self.data):
+            raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+        body = self.data[first : last + 1]
+        self.requests += 1
+        self.bytes_sent += len(body)
+        return {
+            "ContentType": "application/octet-stream",
+            "ETag": '"benchmark"',
+            "ContentRange": f"bytes {first}-{first + len(body) - 1}/{len(self.data)}",
+            "Body": io.BytesIO(body),
+        }
+
+
+def ranged_fetch(data, initial_range_bytes):
+    """Return (bytes fetched, requests) of the upload processor's ranged reader."""
+    s3_client = StubS3Client(data)
+    reader = RangedObjectReader(s3_client, "benchmark", "image", initial_range_bytes)
+    reader.image_size()
+    return s3_client.bytes_sent, s3_client.requests
+
+
+def time_parser(data, repeat, number):
+    """Return the min and median time per get_image_size call in microseconds."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            get_image_size(data)
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return min(timings), statistics.median(timings)
+
+
+def git_commit():
+    """Return the current git commit, if available."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(initial_range_bytes, repeat, number):
+    """Run the benchmark and return the results."""
+    results = []
+    for name, data, expected in build_corpus():
+        dimensions = tuple(get_image_size(data))
+        if dimensions != expected:
+            raise RuntimeError(f"{name}: expected {expected}, got {dimensions}")
+        fetched, requests = ranged_fetch(data, initial_range_bytes)
+        time_min, time_median = time_parser(data, repeat, number)
+        results.append(
+            {
+                "name": name,
+                "file_bytes": len(data),
+                "width": dimensions[0],
+                "height": dimensions[1],
+                "bytes_required": bytes_required(data),
+                "bytes_fetched": fetched,
+                "range_requests": requests,
+                "time_us_min": round(time_min, 3),
+                "time_us_median": round(time_median, 3),
+            }
+        )
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "initial_range_bytes": initial_range_bytes,
+        "results": results,
+    }
+
+
+def compare(previous, current):
+    """Print the relative difference per image between two result sets."""
+    previous_results = {result["name"]: result for result in previous["results"]}
+    print(f"{'name':<28}{'time_us_median':>24}{'bytes_fetched':>28}")
+    for result in current["results"]:
+        before = previous_results.get(result["name"])
+        if not before:
+            print(f"{result['name']:<28}{'(new)':>24}")
+            continue
+        time_change = result["time_us_median"] / before["time_us_median"] - 1
+        print(
+            f"{result['name']:<28}"
+            f"{before['time_us_median']:>10.2f} -> {result['time_us_median']:<8.2f}"
+            f"{time_change:+6.0%}"
+            f"{before['bytes_fetched']:>12} -> {result['bytes_fetched']:<12}"
+        )
+
+
+def main():
+    """Parse the command line arguments and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="results JSON of a previous run")
+    parser.add_argument("--initial-range-bytes", type=int, default=65536)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    results = run(args.initial_range_bytes, args.repeat, args.number)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as previous_file:
+            compare(json.load(previous_file), results)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,15 +12,37 @@ ddb_table_name = os.environ.get("DDB_TABLE")
 ddb_table = boto3.resource("dynamodb").Table(name=ddb_table_name)
 
 
-def event_handler(_event, _context):
-    """Arrange and Act: create a user in DDB."""
+def event_handler(event, _context):
+    """Arrange and Act: create, update or delete a user in DDB."""
+    scenario = event.get("scenario", "create")
+
     # 1. Arrange
     now = time.time()
-    user_object = {"PK": f"USER#{now}", "SK": f"USER#{now}"}
+    user_id = now
+    # Every iteration of every scenario in a load test creates its own user
+    if "load_test_run" in event:
+        user_id = f"{event['load_test_run']}#{scenario}#{event['iteration']}"
+    user_object = {"PK": f"USER#{user_id}", "SK": f"USER#{user_id}"}
 
     # 2. Act
+    response = {"act_success": True, "test_user_key": user_object, "created_at": now}
     try:
         ddb_table.put_item(Item=user_object)
-        return {"act_success": True, "test_user_key": user_object}
+        if scenario == "update":
+            updated_attributes = {"email": f"user-{now}@example.com"}
+            ddb_table.update_item(
+                Key=user_object,
+                UpdateExpression="SET email = :email",
+                ExpressionAttributeValues={":email": updated_attributes["email"]},
+            )
+            response["updated_attributes"] = updated_attributes
+        if scenario == "delete":
+            ddb_table.delete_item(Key=user_object)
     except Exception:  # pylint: disable=broad-except
-        return {"act_success": False, "error_message": "failed to write to DDB"}
+        return {"act_success": False, "error_message": f"failed to {scenario} in DDB"}
+
+    acted_at = time.time()
+    return response | {
+        "acted_at": acted_at,
+        "act_duration_seconds": round(acted_at - now, 3),
+    }
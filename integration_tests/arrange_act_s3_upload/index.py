@@ -12,15 +12,24 @@ s3 = boto3.resource("s3")
 s3_bucket_name = os.environ.get("S3_BUCKET")
 
 
-def event_handler(_event, _context):
+def event_handler(event, _context):
     """Arrange and Act: put the example file in the S3 Bucket."""
     # 1. Arrange
     now = time.time()
     object_key = f"test_file_{now}.png"
+    # Every iteration of a load test uploads its own file
+    if "load_test_run" in event:
+        object_key = f"test_file_{event['load_test_run']}_{event['iteration']}.png"
 
     # 2. Act
     try:
         s3.Bucket(s3_bucket_name).upload_file("example.png", object_key)
-        return {"act_success": True, "test_object_key": object_key}
+        acted_at = time.time()
+        return {
+            "act_success": True,
+            "test_object_key": object_key,
+            "acted_at": acted_at,
+            "act_duration_seconds": round(acted_at - now, 3),
+        }
     except Exception:  # pylint: disable=broad-except
         return {"act_success": False, "error_message": "failed to put object"}
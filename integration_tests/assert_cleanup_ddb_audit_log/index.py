@@ -1,9 +1,12 @@
 """Lambda Function for the Assert and Clean Up steps of the DDB test."""
 
 # Standard library imports
+import gzip
 import json
+import math
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
 
 # Third party imports
 import boto3
@@ -12,93 +15,316 @@ import boto3
 logs_client = boto3.client("logs")
 log_group_name = os.environ.get("LOG_STREAM_NAME")
 
+s3_client = boto3.client("s3")
+audit_bucket_name = os.environ.get("AUDIT_BUCKET")
+audit_sink = os.environ.get("AUDIT_SINK", "cloudwatch")
+
 ddb_table_name = os.environ.get("DDB_TABLE")
 ddb_table = boto3.resource("dynamodb").Table(name=ddb_table_name)
 
+# The JSON path and representation of attributes in every audit encoding
+AUDIT_SCHEMAS = {
+    "dynamodb": {
+        "string_path": "{name}.S",
+        "string": lambda value: {"S": value},
+        "map": lambda value: {"M": value},
+    },
+    "plain": {
+        "string_path": "{name}",
+        "string": lambda value: value,
+        "map": lambda value: value,
+    },
+}
+audit_schema = AUDIT_SCHEMAS[os.environ.get("AUDIT_ENCODING", "dynamodb")]
+
+# The audit log is searched from shortly before the user was created until now,
+# allowing for clock skew, for at most the search budget per attempt
+CLOCK_SKEW = timedelta(minutes=1)
+search_budget_seconds = float(os.environ.get("SEARCH_BUDGET_SECONDS", "20"))
+
+# The state machine polls until the audit log is written or the deadline passes,
+# waiting twice as long after every attempt
+poll_deadline_seconds = float(os.environ.get("POLL_DEADLINE_SECONDS", "60"))
+INITIAL_POLL_SECONDS = 1
+MAX_POLL_SECONDS = 16
+
+# The audit event type and test name of every scenario
+SCENARIOS = {
+    "create": ("UserCreated", "ddb_user_audit_log"),
+    "update": ("UserUpdated", "ddb_user_update_audit_log"),
+    "delete": ("UserDeleted", "ddb_user_delete_audit_log"),
+}
+
+
+def event_handler(event, context):
+    """
+    Assert and Clean Up: verify the audit log event and delete the user.
+
+    Returns a pending response with the seconds to wait before polling again
+    while the event isn't written yet, and the test result otherwise.
+    """
+    started = time.perf_counter()
+    event_type, test_name = SCENARIOS[event.get("scenario", "create")]
 
-def event_handler(event, _context):
-    """Assert and Clean Up: verify the metadata and delete the object."""
     # If the arrange / act step returned an error, bail early
     if not event["arrange_act_payload"]["act_success"]:
-        return error_response(event["arrange_act_payload"]["error_message"])
+        return error_response(test_name, event["arrange_act_payload"]["error_message"])
 
     test_user_key = event["arrange_act_payload"]["test_user_key"]
     test_user_pk = test_user_key["PK"]
     test_user_sk = test_user_key["SK"]
 
     expected_json = {
-        "EventType": "UserCreated",
-        "PK": {"S": test_user_pk},
-        "SK": {"S": test_user_sk},
+        "EventType": event_type,
+        "PK": audit_schema["string"](test_user_pk),
+        "SK": audit_schema["string"](test_user_sk),
     }
+    # Updates only log the attributes which changed
+    updated_attributes = event["arrange_act_payload"].get("updated_attributes")
+    if updated_attributes:
+        expected_json["Changes"] = audit_schema["map"](
+            {
+                name: audit_schema["string"](value)
+                for name, value in updated_attributes.items()
+            }
+        )
+    pk_path = audit_schema["string_path"].format(name="$.PK")
+    sk_path = audit_schema["string_path"].format(name="$.SK")
 
     # 3. Assert
 
-    # Filter the sought event from the CloudWatch Log Group
-    filter_pattern = (
-        f'{{ ($.EventType = "UserCreated") && ($.SK.S = "{test_user_pk}") '
-        f'&& ($.PK.S = "{test_user_sk}") }}'
+    # The audit event was written between creating the user and now
+    acted_at = event["arrange_act_payload"]["acted_at"]
+    created_at = event["arrange_act_payload"]["created_at"]
+    start_time = datetime.fromtimestamp(created_at, timezone.utc) - CLOCK_SKEW
+    end_time = datetime.now(timezone.utc) + CLOCK_SKEW
+    # Leave time to clean up when the function is about to time out
+    search_seconds = min(
+        search_budget_seconds, context.get_remaining_time_in_millis() / 1000 - 2
     )
+    if audit_sink == "firehose":
+        messages = find_messages_in_s3(
+            start_time,
+            event_type,
+            {pk_path: test_user_pk, sk_path: test_user_sk},
+            time.monotonic() + search_seconds,
+        )
+    else:
+        messages = find_messages_in_log_group(
+            start_time,
+            end_time,
+            f'{{ ($.EventType = "{event_type}") && ({pk_path} = "{test_user_pk}") '
+            f'&& ({sk_path} = "{test_user_sk}") }}',
+            time.monotonic() + search_seconds,
+        )
 
-    # Set the search horizon to one minute ago
-    start_time = int((datetime.today() - timedelta(minutes=1)).timestamp()) * 1000
-
-    # Execute the search
-    response = logs_client.filter_log_events(
-        logGroupName=log_group_name, startTime=start_time, filterPattern=filter_pattern
-    )
+    # Poll again until the event is written, or fail once the deadline passed
+    elapsed = time.time() - acted_at
+    if len(messages) == 0:
+        return poll_again_response(event, elapsed) or clean_up_with_error_response(
+            event, test_name, f"event not found after {elapsed:.1f} seconds"
+        )
 
     # Assert exactly one event matching the pattern is found
-    if "events" not in response:
+    if len(messages) != 1:
         return clean_up_with_error_response(
-            test_user_pk, test_user_sk, "events not found"
+            event, test_name, "more than one event found"
         )
 
-    if len(response["events"]) == 0:
+    if messages[0] != expected_json:
         return clean_up_with_error_response(
-            test_user_pk, test_user_sk, "event not found"
+            event, test_name, "log event does not match expected JSON"
         )
 
-    if len(response["events"]) != 1:
-        return clean_up_with_error_response(
-            test_user_pk, test_user_sk, "more than one event found"
+    # Return success
+    return clean_up_with_success_response(event, test_name, elapsed, started)
+
+
+def find_messages_in_log_group(start_time, end_time, filter_pattern, deadline):
+    """
+    Return the audit messages matching a filter pattern in the CloudWatch Log Group.
+
+    The stream processor writes to a stream per execution environment and day,
+    named after the day, so only the streams of the days in the time window
+    are searched. Pages are followed until one has a match, the pages run out
+    or the deadline (in time.monotonic() seconds) passes.
+    """
+    messages = []
+    pages_scanned = 0
+    events_scanned = 0
+    budget_exhausted = False
+    prefixes = sorted({f"{day:%Y/%m/%d}/" for day in (start_time, end_time)})
+    for prefix in prefixes:
+        filter_params = {
+            "logGroupName": log_group_name,
+            "logStreamNamePrefix": prefix,
+            "startTime": int(start_time.timestamp() * 1000),
+            "endTime": int(end_time.timestamp() * 1000),
+            "filterPattern": filter_pattern,
+        }
+        while not messages:
+            if time.monotonic() > deadline:
+                budget_exhausted = True
+                break
+            response = logs_client.filter_log_events(**filter_params)
+            pages_scanned += 1
+            events = response.get("events", [])
+            events_scanned += len(events)
+            messages += [json.loads(event["message"]) for event in events]
+            # An empty page doesn't mean the search is done, only a missing token
+            if "nextToken" not in response:
+                break
+            filter_params["nextToken"] = response["nextToken"]
+        if messages or budget_exhausted:
+            break
+
+    print(
+        json.dumps(
+            {
+                "log_stream_prefixes": prefixes,
+                "pages_scanned": pages_scanned,
+                "events_scanned": events_scanned,
+                "budget_exhausted": budget_exhausted,
+            }
         )
+    )
+    return messages
 
-    if json.loads(response["events"][0]["message"]) != expected_json:
-        return clean_up_with_error_response(
-            test_user_pk, test_user_sk, "log event does not match expected JSON"
+
+def find_messages_in_s3(start_time, event_type, key_values, deadline):
+    """
+    Return the audit messages of a user in the gzipped NDJSON files in S3.
+
+    The key_values map the JSON paths of the item keys to the expected values.
+    Firehose partitions the files by day, so only the days in the time window
+    are listed. Pages are followed until one has a match, the pages run out or
+    the deadline (in time.monotonic() seconds) passes.
+    """
+    messages = []
+    pages_scanned = 0
+    objects_scanned = 0
+    events_scanned = 0
+    budget_exhausted = False
+    prefixes = sorted(
+        {f"audit/{day:%Y/%m/%d}/" for day in (start_time, datetime.now(timezone.utc))}
+    )
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=audit_bucket_name, Prefix=prefix):
+            pages_scanned += 1
+            for s3_object in page.get("Contents", []):
+                if s3_object["LastModified"] < start_time:
+                    continue
+                if time.monotonic() > deadline:
+                    budget_exhausted = True
+                    break
+                body = s3_client.get_object(
+                    Bucket=audit_bucket_name, Key=s3_object["Key"]
+                )["Body"].read()
+                objects_scanned += 1
+                for line in gzip.decompress(body).decode("utf-8").splitlines():
+                    events_scanned += 1
+                    message = json.loads(line)
+                    if message["EventType"] == event_type and all(
+                        json_path_value(message, path) == value
+                        for path, value in key_values.items()
+                    ):
+                        messages.append(message)
+            if messages or budget_exhausted:
+                break
+        if messages or budget_exhausted:
+            break
+
+    print(
+        json.dumps(
+            {
+                "audit_prefixes": prefixes,
+                "pages_scanned": pages_scanned,
+                "objects_scanned": objects_scanned,
+                "events_scanned": events_scanned,
+                "budget_exhausted": budget_exhausted,
+            }
         )
+    )
+    return messages
 
-    # Return success
-    return clean_up_with_success_response(test_user_pk, test_user_sk)
+
+def json_path_value(message, path):
+    """Return the value at a simple JSON path like $.PK.S in a message."""
+    value = message
+    for name in path.split(".")[1:]:
+        value = value.get(name) if isinstance(value, dict) else None
+    return value
+
+
+def poll_again_response(event, elapsed):
+    """
+    Return the input of the next attempt, or None if the deadline has passed.
+
+    The wait doubles after every attempt, and never extends past the deadline.
+    """
+    remaining = poll_deadline_seconds - elapsed
+    if remaining <= 0:
+        return None
+    attempt = event.get("attempt", 0)
+    wait_seconds = min(INITIAL_POLL_SECONDS * 2**attempt, MAX_POLL_SECONDS)
+    return event | {
+        "pending": True,
+        "attempt": attempt + 1,
+        "wait_seconds": max(1, min(wait_seconds, math.ceil(remaining))),
+    }
 
 
-def error_response(error_message):
+def error_response(test_name, error_message):
     """Return a well-formed error message."""
     return {
+        "pending": False,
         "success": False,
-        "test_name": "ddb_user_audit_log",
+        "test_name": test_name,
         "error_message": error_message,
     }
 
 
-def clean_up_with_error_response(test_user_pk, test_user_sk, error_message):
-    """Remove the file from DDB and return an error message."""
+def clean_up(event):
+    """
+    Remove the user from DDB, unless the caller removes it later.
+
+    Load tests remove all users of a run in batches, those results carry the
+    key of the user instead.
+    """
+    test_user_key = event["arrange_act_payload"]["test_user_key"]
+    if not event.get("clean_up", True):
+        return {"test_user_key": test_user_key}
     ddb_table.delete_item(
         Key={
-            "PK": test_user_pk,
-            "SK": test_user_sk,
+            "PK": test_user_key["PK"],
+            "SK": test_user_key["SK"],
         }
     )
-    return error_response(error_message)
+    return {}
 
 
-def clean_up_with_success_response(test_user_pk, test_user_sk):
-    """Remove the file from DDB and return a success message."""
-    ddb_table.delete_item(
-        Key={
-            "PK": test_user_pk,
-            "SK": test_user_sk,
-        }
-    )
-    return {"success": True, "test_name": "ddb_user_audit_log"}
+def clean_up_with_error_response(event, test_name, error_message):
+    """Remove the user from DDB and return an error message."""
+    return error_response(test_name, error_message) | clean_up(event)
+
+
+def clean_up_with_success_response(event, test_name, elapsed, started):
+    """
+    Remove the user from DDB and return a success message with the timings.
+
+    The time to consistency is measured when the event was first observed, so
+    at most one wait late. The assert duration only covers the final attempt.
+    """
+    return {
+        "pending": False,
+        "success": True,
+        "test_name": test_name,
+        "acted_at": event["arrange_act_payload"]["acted_at"],
+        "act_duration_seconds": event["arrange_act_payload"]["act_duration_seconds"],
+        "time_to_consistency_seconds": round(elapsed, 3),
+        "assert_duration_seconds": round(time.perf_counter() - started, 3),
+        "attempts": event.get("attempt", 0) + 1,
+        # The wait before the final attempt, the effect was observed within it
+        "last_wait_seconds": event.get("wait_seconds", 0),
+    } | clean_up(event)
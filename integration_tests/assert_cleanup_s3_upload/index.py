@@ -1,7 +1,9 @@
 """Lambda Function for the Assert and Clean Up steps of the DDB test."""
 
 # Standard library imports
+import math
 import os
+import time
 
 # Third party imports
 import boto3
@@ -9,10 +11,30 @@ import boto3
 
 s3_client = boto3.client("s3")
 s3_bucket_name = os.environ.get("S3_BUCKET")
+storage_mode = os.environ.get("STORAGE_MODE", "metadata")
+
+# The state machine polls until the dimensions are written or the deadline
+# passes, waiting twice as long after every attempt
+poll_deadline_seconds = float(os.environ.get("POLL_DEADLINE_SECONDS", "30"))
+INITIAL_POLL_SECONDS = 1
+MAX_POLL_SECONDS = 8
+
+dimension_index_table_name = os.environ.get("DIMENSION_INDEX_TABLE")
+dimension_index_table = None
+if dimension_index_table_name:
+    dimension_index_table = boto3.resource("dynamodb").Table(
+        name=dimension_index_table_name
+    )
 
 
 def event_handler(event, _context):
-    """Assert and Clean Up: verify the metadata and delete the object."""
+    """
+    Assert and Clean Up: verify the metadata and delete the object.
+
+    Returns a pending response with the seconds to wait before polling again
+    while the dimensions aren't written yet, and the test result otherwise.
+    """
+    started = time.perf_counter()
     # If the arrange / act step returned an error, bail early
     if not event["arrange_act_payload"]["act_success"]:
         return error_response(event["arrange_act_payload"]["error_message"])
@@ -20,48 +42,130 @@ def event_handler(event, _context):
     test_object_key = event["arrange_act_payload"]["test_object_key"]
 
     # 3. Assert
-    image_object = s3_client.get_object(Bucket=s3_bucket_name, Key=test_object_key)
+    dimensions = read_dimensions(test_object_key)
+    elapsed = time.time() - event["arrange_act_payload"]["acted_at"]
 
-    # Assert metadata is present
-    if "Metadata" not in image_object:
-        return clean_up_with_error_response(test_object_key, "metadata not found")
+    # Assert metadata or tags are present, polling again until the deadline
+    if dimensions is None:
+        return poll_again_response(event, elapsed) or clean_up_with_error_response(
+            event, f"{storage_mode} not found after {elapsed:.1f} seconds"
+        )
     # Assert image_height is present
-    if "image_height" not in image_object["Metadata"]:
+    if "image_height" not in dimensions:
         return clean_up_with_error_response(
-            test_object_key, "'image_height' metadata not found"
+            event, f"'image_height' {storage_mode} not found"
         )
     # Assert image_width is present
-    if "image_width" not in image_object["Metadata"]:
+    if "image_width" not in dimensions:
         return clean_up_with_error_response(
-            test_object_key, "'image_width' metadata not found"
+            event, f"'image_width' {storage_mode} not found"
         )
     # Assert image_height matches expected value
-    if image_object["Metadata"]["image_height"] != "178":
-        return clean_up_with_error_response(test_object_key, "'image_height' incorrect")
+    if dimensions["image_height"] != "178":
+        return clean_up_with_error_response(event, "'image_height' incorrect")
     # Assert image_width matches expected value
-    if image_object["Metadata"]["image_width"] != "172":
-        return clean_up_with_error_response(test_object_key, "'image_width' incorrect")
+    if dimensions["image_width"] != "172":
+        return clean_up_with_error_response(event, "'image_width' incorrect")
+
+    # Assert the dimension index entry matches, if the index is deployed
+    if dimension_index_table:
+        index_item = dimension_index_table.get_item(
+            Key={"PK": test_object_key}, ConsistentRead=True
+        ).get("Item")
+        # The index is written after the dimensions, it may lag behind
+        if not index_item or "deleted" in index_item:
+            return poll_again_response(event, elapsed) or clean_up_with_error_response(
+                event, "dimension index entry not found"
+            )
+        if (index_item["image_width"], index_item["image_height"]) != (172, 178):
+            return clean_up_with_error_response(
+                event, "dimension index entry incorrect"
+            )
 
     # Return success
-    return clean_up_with_success_response(test_object_key)
+    return clean_up_with_success_response(event, elapsed, started)
+
+
+def read_dimensions(test_object_key):
+    """Read the dimensions from wherever the deployed storage mode writes them."""
+    if storage_mode == "tags":
+        response = s3_client.get_object_tagging(
+            Bucket=s3_bucket_name, Key=test_object_key
+        )
+        if not response["TagSet"]:
+            return None
+        return {tag["Key"]: tag["Value"] for tag in response["TagSet"]}
+
+    image_object = s3_client.head_object(Bucket=s3_bucket_name, Key=test_object_key)
+    if not image_object.get("Metadata"):
+        return None
+    return image_object["Metadata"]
+
+
+def poll_again_response(event, elapsed):
+    """
+    Return the input of the next attempt, or None if the deadline has passed.
+
+    The wait doubles after every attempt, and never extends past the deadline.
+    """
+    remaining = poll_deadline_seconds - elapsed
+    if remaining <= 0:
+        return None
+    attempt = event.get("attempt", 0)
+    wait_seconds = min(INITIAL_POLL_SECONDS * 2**attempt, MAX_POLL_SECONDS)
+    return event | {
+        "pending": True,
+        "attempt": attempt + 1,
+        "wait_seconds": max(1, min(wait_seconds, math.ceil(remaining))),
+    }
 
 
 def error_response(error_message):
     """Return a well-formed error message."""
     return {
+        "pending": False,
         "success": False,
         "test_name": "s3_png_metadata",
         "error_message": error_message,
     }
 
 
-def clean_up_with_error_response(test_object_key, error_message):
-    """Remove the file from S3 and return an error message."""
+def clean_up(event):
+    """
+    Remove the file from S3, unless the caller removes it later.
+
+    Load tests remove all files of a run in batches, those results carry the
+    key of the file instead.
+    """
+    test_object_key = event["arrange_act_payload"]["test_object_key"]
+    if not event.get("clean_up", True):
+        return {"test_object_key": test_object_key}
     s3_client.delete_object(Bucket=s3_bucket_name, Key=test_object_key)
-    return error_response(error_message)
+    return {}
 
 
-def clean_up_with_success_response(test_object_key):
-    """Remove the file from S3 and return a success message."""
-    s3_client.delete_object(Bucket=s3_bucket_name, Key=test_object_key)
-    return {"success": True, "test_name": "s3_png_metadata"}
+def clean_up_with_error_response(event, error_message):
+    """Remove the file from S3 and return an error message."""
+    return error_response(error_message) | clean_up(event)
+
+
+def clean_up_with_success_response(event, elapsed, started):
+    """
+    Remove the file from S3 and return a success message with the timings.
+
+    The time to consistency is measured when the dimensions were first
+    observed, so at most one wait late. The assert duration only covers the
+    final attempt.
+    """
+    return {
+        "pending": False,
+        "success": True,
+        "test_name": "s3_png_metadata",
+        "acted_at": event["arrange_act_payload"]["acted_at"],
+        "act_duration_seconds": event["arrange_act_payload"]["act_duration_seconds"],
+        "time_to_consistency_seconds": round(elapsed, 3),
+        "assert_duration_seconds": round(time.perf_counter() - started, 3),
+        "attempts": event.get("attempt", 0) + 1,
+        # The wait before the final attempt, the effect was observed within it
+        "last_wait_seconds": event.get("wait_seconds", 0),
+    } | clean_up(event)
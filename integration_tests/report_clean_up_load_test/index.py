@@ -0,0 +1,166 @@
+"""Lambda Function for the Report and Clean Up steps of the load test."""
+
+# Standard library imports
+import json
+import math
+import os
+import time
+
+# Third party imports
+import boto3
+
+
+s3_client = boto3.client("s3")
+s3_bucket_name = os.environ.get("S3_BUCKET")
+
+dynamodb_client = boto3.client("dynamodb")
+ddb_table_name = os.environ.get("DDB_TABLE")
+
+# Limits of a single DeleteObjects and BatchWriteItem call
+MAX_KEYS_PER_DELETE_OBJECTS = 1000
+MAX_ITEMS_PER_BATCH_WRITE = 25
+MAX_BATCH_WRITE_ATTEMPTS = 5
+
+
+def event_handler(event, _context):
+    """Report and Clean Up: aggregate the iteration results and remove the test data."""
+    # Every test ran in its own Map iteration, which returned the result of every
+    # iteration of the test
+    results = [result for test_results in event["results"] for result in test_results]
+
+    report = {
+        test_name: test_report(
+            [result for result in results if result["test_name"] == test_name]
+        )
+        for test_name in sorted({result["test_name"] for result in results})
+    }
+
+    object_keys = {
+        result["test_object_key"] for result in results if "test_object_key" in result
+    }
+    user_keys = {
+        (result["test_user_key"]["PK"], result["test_user_key"]["SK"])
+        for result in results
+        if "test_user_key" in result
+    }
+    # Iterations which failed with an error didn't return the keys of their data
+    for result in results:
+        if "arrange_act_input" in result:
+            object_key, user_key = iteration_keys(result["arrange_act_input"])
+            object_keys.add(object_key)
+            if user_key:
+                user_keys.add(user_key)
+    report["clean_up"] = {
+        "objects_deleted": delete_objects(sorted(object_keys)),
+        "items_deleted": delete_items(sorted(user_keys)),
+    }
+
+    print(json.dumps(report))
+    return report
+
+
+def test_report(results):
+    """
+    Return the throughput and end-to-end latency percentiles of one test.
+
+    The throughput counts the successful iterations per second, from the first
+    act until the last effect was observed.
+
+    The latencies are measured when polling first observed the effect, so each
+    is up to one poll wait late. The waits double per attempt, which quantizes
+    the percentiles; the resolution is the longest wait before a final attempt.
+    """
+    successes = [result for result in results if result["success"]]
+    report = {
+        "iterations": len(results),
+        "successes": len(successes),
+        "failures": len(results) - len(successes),
+        "errors": sorted(
+            {result["error_message"] for result in results if not result["success"]}
+        ),
+    }
+    if not successes:
+        return report
+
+    latencies = sorted(result["time_to_consistency_seconds"] for result in successes)
+    first_act = min(result["acted_at"] for result in successes)
+    last_observed = max(
+        result["acted_at"] + result["time_to_consistency_seconds"]
+        for result in successes
+    )
+    report["throughput_per_second"] = round(
+        len(successes) / max(last_observed - first_act, 0.001), 3
+    )
+    report["latency_seconds"] = {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1],
+    }
+    report["latency_resolution_seconds"] = max(
+        result.get("last_wait_seconds", 0) for result in successes
+    )
+    return report
+
+
+def iteration_keys(arrange_act_input):
+    """
+    Return the object key and user key of the data of a load test iteration.
+
+    The keys are named the way the Arrange & Act functions name them. Only the
+    DDB tests have a scenario and create a user, deleting the object key of a
+    DDB test is a no-op.
+    """
+    load_test_run = arrange_act_input["load_test_run"]
+    iteration = arrange_act_input["iteration"]
+    object_key = f"test_file_{load_test_run}_{iteration}.png"
+    if "scenario" not in arrange_act_input:
+        return object_key, None
+    user_id = f"USER#{load_test_run}#{arrange_act_input['scenario']}#{iteration}"
+    return object_key, (user_id, user_id)
+
+
+def percentile(sorted_values, rank):
+    """Return the nearest-rank percentile of a sorted list."""
+    return sorted_values[max(math.ceil(rank / 100 * len(sorted_values)) - 1, 0)]
+
+
+def delete_objects(object_keys):
+    """Delete files from S3 in batches, return how many were deleted."""
+    deleted = 0
+    for start in range(0, len(object_keys), MAX_KEYS_PER_DELETE_OBJECTS):
+        batch = object_keys[start : start + MAX_KEYS_PER_DELETE_OBJECTS]
+        response = s3_client.delete_objects(
+            Bucket=s3_bucket_name,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+        # Quiet mode only reports the keys which could not be deleted
+        errors = response.get("Errors", [])
+        for error in errors:
+            print(json.dumps({"object_key": error["Key"], "error": error["Code"]}))
+        deleted += len(batch) - len(errors)
+    return deleted
+
+
+def delete_items(user_keys):
+    """Delete users from DDB in batches, return how many were deleted."""
+    deleted = 0
+    for start in range(0, len(user_keys), MAX_ITEMS_PER_BATCH_WRITE):
+        requests = [
+            {"DeleteRequest": {"Key": {"PK": {"S": pk}, "SK": {"S": sk}}}}
+            for pk, sk in user_keys[start : start + MAX_ITEMS_PER_BATCH_WRITE]
+        ]
+        for attempt in range(1, MAX_BATCH_WRITE_ATTEMPTS + 1):
+            response = dynamodb_client.batch_write_item(
+                RequestItems={ddb_table_name: requests}
+            )
+            unprocessed = response.get("UnprocessedItems", {}).get(ddb_table_name, [])
+            deleted += len(requests) - len(unprocessed)
+            requests = unprocessed
+            if not requests:
+                break
+            if attempt < MAX_BATCH_WRITE_ATTEMPTS:
+                time.sleep(0.1 * 2**attempt)
+        if requests:
+            print(json.dumps({"error": f"Failed to delete {len(requests)} users"}))
+    return deleted
@@ -0,0 +1,130 @@
+"""Suppression of stream records which were already written to the audit log."""
+
+# Standard library imports
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+from botocore.exceptions import ClientError
+
+# Keys per BatchGetItem call
+MAX_KEYS_PER_BATCH_GET = 100
+# Attempts per BatchGetItem request while DynamoDB returns unprocessed keys
+MAX_BATCH_GET_ATTEMPTS = 4
+
+
+class AuditLedger:
+    """
+    Two-tier record of the stream event IDs which were written to the audit log.
+
+    The first tier is an LRU dictionary with TTL eviction, which lives as long as
+    the Lambda container. The optional second tier is a DynamoDB table with a
+    conditional write per event, which is shared between all containers.
+
+    Event IDs are only recorded after they were written, so a batch which times
+    out halfway is written again instead of being lost.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, table_name=None, dynamodb_client=None):
+        """Create an empty ledger."""
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.table_name = table_name
+        self.dynamodb_client = dynamodb_client
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def find_logged(self, event_ids):
+        """Return the event IDs which were already written to the audit log."""
+        now = time.time()
+        logged = set()
+        with self.lock:
+            for event_id in event_ids:
+                expires_at = self.entries.get(event_id)
+                if expires_at is not None and expires_at > now:
+                    self.entries.move_to_end(event_id)
+                    logged.add(event_id)
+
+        unknown = [event_id for event_id in event_ids if event_id not in logged]
+        if self.table_name and unknown:
+            logged |= self._find_in_table(unknown, now)
+        return logged
+
+    def record_logged(self, event_ids):
+        """Record event IDs which were written to the audit log."""
+        now = time.time()
+        with self.lock:
+            for event_id in event_ids:
+                self._store(event_id, now + self.ttl_seconds)
+
+        if self.table_name and event_ids:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                list(executor.map(self._record_in_table, event_ids))
+
+    def _store(self, event_id, expires_at):
+        """Add an event ID to the LRU, evicting the least recently used if full."""
+        self.entries[event_id] = expires_at
+        self.entries.move_to_end(event_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _find_in_table(self, event_ids, now):
+        """
+        Return the event IDs with an unexpired entry in the table.
+
+        Unprocessed keys are requested again with exponential backoff. Keys which
+        are still unprocessed after the last attempt count as not logged, so
+        their events are written again rather than lost.
+        """
+        logged = {}
+        for start in range(0, len(event_ids), MAX_KEYS_PER_BATCH_GET):
+            request = {
+                self.table_name: {
+                    "Keys": [
+                        {"PK": {"S": event_id}}
+                        for event_id in event_ids[
+                            start : start + MAX_KEYS_PER_BATCH_GET
+                        ]
+                    ],
+                    "ConsistentRead": True,
+                }
+            }
+            for attempt in range(1, MAX_BATCH_GET_ATTEMPTS + 1):
+                response = self.dynamodb_client.batch_get_item(RequestItems=request)
+                for item in response["Responses"].get(self.table_name, []):
+                    # DynamoDB TTL deletes lazily, so check the expiry ourselves
+                    if int(item["expires_at"]["N"]) > now:
+                        logged[item["PK"]["S"]] = int(item["expires_at"]["N"])
+                request = response.get("UnprocessedKeys")
+                if not request:
+                    break
+                if attempt < MAX_BATCH_GET_ATTEMPTS:
+                    time.sleep(0.05 * 2**attempt)
+            else:
+                unprocessed = len(request[self.table_name]["Keys"])
+                print(f"Treating {unprocessed} unprocessed keys as not logged")
+
+        with self.lock:
+            for event_id, expires_at in logged.items():
+                self._store(event_id, expires_at)
+        return set(logged)
+
+    def _record_in_table(self, event_id):
+        """Write an event ID to the table, unless an unexpired entry exists."""
+        now = time.time()
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "PK": {"S": event_id},
+                    "expires_at": {"N": str(int(now + self.ttl_seconds))},
+                },
+                ConditionExpression="attribute_not_exists(PK) OR expires_at < :now",
+                ExpressionAttributeValues={":now": {"N": str(int(now))}},
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                # The event is in the audit log, failing now would only log it twice
+                print(f"Failed to record {event_id} in the ledger: {exc!r}")
@@ -4,65 +4,278 @@
 # Standard library imports
 import json
 import os
-from dataclasses import dataclass
-from typing import Optional
+import time
+from decimal import Decimal
 
 # Third party imports
 import boto3
-from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer
 
+# Local application/library specific imports
+from deduplication import AuditLedger
+from instrumentation import MetricsLogger
+from sinks import CloudWatchLogsSink, FirehoseSink
 
-logs_client = boto3.client("logs")
-log_group_name = os.environ.get("AUDIT_LOG_GROUP_NAME")
 
+# "dynamodb" logs the attributes as is, "plain" converts them to compact plain JSON
+audit_encoding = os.environ.get("AUDIT_ENCODING", "dynamodb")
 
-@dataclass
-class SequenceToken:
-    """Container for a sequence token."""
+# "cloudwatch" writes the audit log to a Log Group, "firehose" to a delivery
+# stream which stores it in S3
+if os.environ.get("AUDIT_SINK", "cloudwatch") == "firehose":
+    sink = FirehoseSink(
+        firehose_client=boto3.client("firehose"),
+        delivery_stream_name=os.environ.get("AUDIT_DELIVERY_STREAM_NAME"),
+    )
+else:
+    sink = CloudWatchLogsSink(
+        logs_client=boto3.client("logs"),
+        log_group_name=os.environ.get("AUDIT_LOG_GROUP_NAME"),
+    )
 
-    token: Optional[str] = None
+# Stream records are kept for 24 hours, so retries never come later than that
+ledger = AuditLedger(
+    max_entries=int(os.environ.get("AUDIT_LEDGER_CACHE_SIZE", "10000")),
+    ttl_seconds=int(os.environ.get("AUDIT_LEDGER_TTL_SECONDS", "86400")),
+    table_name=os.environ.get("AUDIT_LEDGER_TABLE"),
+    dynamodb_client=boto3.client("dynamodb"),
+)
 
+# Embedded metrics, printed once at the end of every invocation
+metrics = MetricsLogger()
 
-sequence_token = SequenceToken()
+# The audit routes map the PK prefix and event name of a stream record to an
+# audit event type and message handler. The DynamoDbStreams construct owns the
+# defaults and always sets them, so a missing variable is a deployment error.
+if "AUDIT_ROUTES" not in os.environ:
+    raise RuntimeError("AUDIT_ROUTES is not set")
+
+# The routes per event name, longest key prefix first
+routes = {}
+for audit_route in json.loads(os.environ["AUDIT_ROUTES"]):
+    routes.setdefault(audit_route["event_name"], []).append(audit_route)
+for event_routes in routes.values():
+    event_routes.sort(key=lambda route: len(route["key_prefix"]), reverse=True)
 
 
 def event_handler(event, context):
-    """Write audit logs to CloudWatch."""
-    # Create a log stream if it doesn't exist yet
+    """Write audit logs to the sink, return the records to retry."""
     try:
-        logs_client.create_log_stream(
-            logGroupName=log_group_name,
-            logStreamName=context.log_stream_name,
-        )
-    except ClientError as exc:
-        if exc.response["Error"]["Code"] != "ResourceAlreadyExistsException":
-            raise
-
-    # Prepare the parameters for put_log_events()
-    put_log_params = {
-        "logGroupName": log_group_name,
-        "logStreamName": context.log_stream_name,
-        "logEvents": [
+        return process_batch(event, context)
+    finally:
+        metrics.flush()
+
+
+def process_batch(event, context):
+    """Write the audit logs of a batch of stream records to the sink."""
+    started = time.perf_counter()
+
+    # Lambda retries a shard from the lowest reported sequence number onwards,
+    # so only write the records before the first one we can't convert
+    records = sorted(event["Records"], key=sequence_number)
+    converted = []
+    failed_records = []
+    malformed = 0
+    unrouted = 0
+    for position, record in enumerate(records):
+        try:
+            route = route_for(record)
+            if not route:
+                unrouted += 1
+                continue
+            converted.append((record, to_log_event(record, route)))
+        except (KeyError, TypeError, ValueError) as exc:
+            print(
+                json.dumps(
+                    {
+                        "eventID": record.get("eventID"),
+                        "error": f"Malformed stream record: {exc!r}",
+                    }
+                )
+            )
+            malformed = 1
+            failed_records = records[position:]
+            break
+
+    # Drop the records which a previous attempt of this batch already wrote
+    logged = ledger.find_logged([record["eventID"] for record, _ in converted])
+    converted = [pair for pair in converted if pair[0]["eventID"] not in logged]
+
+    # Write the events in chronological order, as PutLogEvents requires
+    converted.sort(key=lambda pair: pair[1]["timestamp"])
+    log_events = [log_event for _, log_event in converted]
+
+    # Only record the events the sink wrote, the others are retried
+    written_positions = set(sink.write(log_events, context))
+    written = len(written_positions)
+    ledger.record_logged(
+        [
+            record["eventID"]
+            for position, (record, _) in enumerate(converted)
+            if position in written_positions
+        ]
+    )
+    rejected = [
+        record
+        for position, (record, _) in enumerate(converted)
+        if position not in written_positions
+    ]
+    failed_records += rejected
+
+    duration = time.perf_counter() - started
+    metrics.put_metric("BatchSize", len(records))
+    metrics.put_metric("RecordsWritten", written)
+    # The records after a malformed one are retried, but didn't fail themselves
+    metrics.put_metric("Errors", malformed + len(rejected))
+    metrics.put_metric("DuplicatesSuppressed", len(logged))
+    metrics.put_metric("RecordsPerSecond", written / duration, "Count/Second")
+    for latency in sink.latencies:
+        metrics.put_metric("SinkLatency", latency, "Milliseconds")
+    put_event_type_metrics([record for record, _ in converted])
+    print(
+        json.dumps(
             {
-                # Fetch the creation timestamp from the DDB item
-                "timestamp": int(
-                    record["dynamodb"]["ApproximateCreationDateTime"] * 1000
+                "records": len(records),
+                "records_written": written,
+                "duplicates_suppressed": len(logged),
+                "records_unrouted": unrouted,
+                "records_failed": len(failed_records),
+                "sink_calls": sink.calls,
+                "bytes": sum(
+                    len(log_event["message"].encode("utf-8"))
+                    for log_event in log_events
                 ),
-                # Create a dictionary combining the EventType and the data from DDB
-                "message": json.dumps(
-                    {"EventType": "UserCreated"} | record["dynamodb"]["NewImage"]
+                "bytes_saved": sum(
+                    bytes_saved(record, log_event) for record, log_event in converted
                 ),
+                "duration_ms": round(duration * 1000, 1),
+                "records_per_second": round(written / duration, 1),
             }
-            for record in event["Records"]
-        ],
+        )
+    )
+
+    if not failed_records:
+        return {"batchItemFailures": []}
+    first_failure = min(failed_records, key=sequence_number)
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": first_failure["dynamodb"]["SequenceNumber"]}
+        ]
+    }
+
+
+def sequence_number(record):
+    """Return the position of a record in its shard."""
+    return int(record["dynamodb"]["SequenceNumber"])
+
+
+def put_event_type_metrics(records):
+    """Add the record count and the largest lag behind DynamoDB per event type."""
+    now = time.time()
+    event_types = {}
+    for record in records:
+        counts = event_types.setdefault(route_for(record)["event_type"], [0, 0])
+        counts[0] += 1
+        lag = now - record["dynamodb"]["ApproximateCreationDateTime"]
+        counts[1] = max(counts[1], lag * 1000)
+    for event_type, (count, lag) in event_types.items():
+        metrics.put_metric("Records", count, event_type=event_type)
+        metrics.put_metric("Lag", lag, "Milliseconds", event_type=event_type)
+
+
+def route_for(record):
+    """Return the audit route of a stream record, or None if it isn't audited."""
+    key = record["dynamodb"]["Keys"]["PK"]["S"]
+    for route in routes.get(record["eventName"], []):
+        if key.startswith(route["key_prefix"]):
+            return route
+    return None
+
+
+def to_log_event(record, route):
+    """Convert a stream record to an audit log event."""
+    header = {"EventType": route["event_type"]}
+    return {
+        # Fetch the creation timestamp from the DDB item
+        "timestamp": int(record["dynamodb"]["ApproximateCreationDateTime"] * 1000),
+        # Create a dictionary combining the EventType and the data from DDB
+        "message": encode_message(
+            *MESSAGE_HANDLERS[route["handler"]](header, record["dynamodb"])
+        ),
     }
 
-    # Add the sequence token if we have one
-    if sequence_token.token:
-        put_log_params["sequenceToken"] = sequence_token.token
 
-    # Write the audit log to the CloudWatch Log Group
-    response = logs_client.put_log_events(**put_log_params)
+def new_image_message(header, stream_record):
+    """Return the header and the full new item."""
+    return header, stream_record["NewImage"]
 
-    # Store the sequence token for the next iteration
-    sequence_token.token = response["nextSequenceToken"]
+
+def keys_message(header, stream_record):
+    """Return the header and the item keys, eg. to identify a deleted item."""
+    return header, stream_record["Keys"]
+
+
+def changes_message(header, stream_record):
+    """Return the header, the item keys and the attributes which changed."""
+    old_image = stream_record.get("OldImage", {})
+    new_image = stream_record["NewImage"]
+    changes = {
+        name: value
+        for name, value in new_image.items()
+        if name not in old_image
+        or deserializer.deserialize(old_image[name]) != deserializer.deserialize(value)
+    }
+    removed = sorted(set(old_image) - set(new_image))
+    if removed:
+        header["Removed"] = removed
+    return header, stream_record["Keys"] | {"Changes": {"M": changes}}
+
+
+MESSAGE_HANDLERS = {
+    "new_image": new_image_message,
+    "keys": keys_message,
+    "changes": changes_message,
+}
+
+
+class StreamImageDeserializer(TypeDeserializer):
+    """Deserializer for stream images, where binary values are base64 strings."""
+
+    def _deserialize_b(self, value):
+        return value
+
+    def _deserialize_bs(self, value):
+        return set(value)
+
+
+deserializer = StreamImageDeserializer()
+
+
+def encode_message(header, image):
+    """Serialize an audit message in the configured encoding."""
+    if audit_encoding == "plain":
+        plain_image = {
+            key: deserializer.deserialize(value) for key, value in image.items()
+        }
+        return json.dumps(header | plain_image, separators=(",", ":"), default=to_json)
+    return json.dumps(header | image)
+
+
+def to_json(value):
+    """Convert the numbers and sets of a deserialized image to JSON types."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def bytes_saved(record, log_event):
+    """Return how many bytes a message saved compared to logging the full images."""
+    images = {
+        name: record["dynamodb"][name]
+        for name in ("OldImage", "NewImage")
+        if name in record["dynamodb"]
+    }
+    full_message = json.dumps({"EventType": route_for(record)["event_type"]} | images)
+    return len(full_message.encode("utf-8")) - len(log_event["message"].encode("utf-8"))
@@ -0,0 +1,281 @@
+"""
+Destinations for audit log events.
+
+The sinks get their boto3 client passed in. To run against a local stand-in,
+pass a client with an endpoint_url or set AWS_ENDPOINT_URL_LOGS or
+AWS_ENDPOINT_URL_FIREHOSE for the stream processor.
+"""
+
+# Standard library imports
+import abc
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+# Third party imports
+from botocore.exceptions import ClientError
+
+# Limits of a single PutLogEvents call
+MAX_EVENTS_PER_CALL = 10000
+MAX_BYTES_PER_CALL = 1048576
+EVENT_OVERHEAD_BYTES = 26
+MAX_SPAN_MILLISECONDS = 24 * 60 * 60 * 1000
+# Attempts per chunk when the sequence token turns out to be stale
+MAX_PUT_ATTEMPTS = 3
+
+# Limits of a single PutRecordBatch call
+MAX_RECORDS_PER_BATCH = 500
+MAX_BYTES_PER_BATCH = 4 * 1024 * 1024
+# Attempts per batch to deliver the records Firehose rejected
+MAX_BATCH_ATTEMPTS = 4
+
+
+class AuditSink(abc.ABC):
+    """
+    Destination for audit log events.
+
+    Log events are dictionaries with a timestamp in milliseconds and a message.
+    Every sink counts the API calls of its latest write, and their latencies in
+    milliseconds.
+    """
+
+    def __init__(self):
+        """Create a new AuditSink."""
+        self.calls = 0
+        self.latencies = []
+
+    @abc.abstractmethod
+    def write(self, log_events, context):
+        """Write log events, return the positions of the events which were written."""
+
+
+@dataclass
+class SequenceToken:
+    """Container for a sequence token."""
+
+    token: Optional[str] = None
+
+
+class CloudWatchLogsSink(AuditSink):
+    """Write audit log events to a CloudWatch Log Group."""
+
+    def __init__(self, logs_client, log_group_name):
+        """Create a new CloudWatchLogsSink."""
+        super().__init__()
+        self.logs_client = logs_client
+        self.log_group_name = log_group_name
+        # The log streams this container created, with their latest sequence token
+        self.log_streams = {}
+
+    def write(self, log_events, context):
+        """
+        Write log events in chunks within the PutLogEvents limits.
+
+        The chunks are written in order, so the written events are the ones
+        before the first chunk which failed.
+        """
+        self.calls = 0
+        self.latencies = []
+        log_stream_name = audit_log_stream_name(context)
+        written = 0
+        for chunk in chunk_log_events(log_events):
+            try:
+                self._put_log_events(log_stream_name, chunk)
+            except ClientError as exc:
+                print(json.dumps({"error": f"Failed to write audit log: {exc!r}"}))
+                break
+            written += len(chunk)
+        return list(range(written))
+
+    def _get_log_stream(self, log_stream_name):
+        """Return the sequence token of a log stream, creating the stream if needed."""
+        if log_stream_name not in self.log_streams:
+            try:
+                self.logs_client.create_log_stream(
+                    logGroupName=self.log_group_name,
+                    logStreamName=log_stream_name,
+                )
+            except ClientError as exc:
+                if exc.response["Error"]["Code"] != "ResourceAlreadyExistsException":
+                    raise
+            self.log_streams[log_stream_name] = SequenceToken()
+        return self.log_streams[log_stream_name]
+
+    def _put_log_events(self, log_stream_name, log_events):
+        """Write a single chunk of log events to the audit log stream."""
+        for attempt in range(1, MAX_PUT_ATTEMPTS + 1):
+            sequence_token = self._get_log_stream(log_stream_name)
+
+            # Prepare the parameters for put_log_events()
+            put_log_params = {
+                "logGroupName": self.log_group_name,
+                "logStreamName": log_stream_name,
+                "logEvents": log_events,
+            }
+
+            # Add the sequence token if we have one
+            if sequence_token.token:
+                put_log_params["sequenceToken"] = sequence_token.token
+
+            # Write the audit log to the CloudWatch Log Group
+            self.calls += 1
+            started = time.perf_counter()
+            try:
+                response = self.logs_client.put_log_events(**put_log_params)
+            except ClientError as exc:
+                self.latencies.append((time.perf_counter() - started) * 1000)
+                error_code = exc.response["Error"]["Code"]
+                if error_code == "DataAlreadyAcceptedException":
+                    # A previous attempt of this chunk succeeded after all
+                    sequence_token.token = exc.response.get("expectedSequenceToken")
+                    return
+                if attempt == MAX_PUT_ATTEMPTS:
+                    raise
+                if error_code == "InvalidSequenceTokenException":
+                    # Another writer used the stream, continue from its token
+                    sequence_token.token = exc.response.get("expectedSequenceToken")
+                elif error_code == "ResourceNotFoundException":
+                    # The stream was deleted, create it again
+                    self.log_streams.pop(log_stream_name, None)
+                else:
+                    raise
+                print(f"Retrying PutLogEvents after {error_code} (attempt {attempt})")
+                continue
+
+            self.latencies.append((time.perf_counter() - started) * 1000)
+
+            # Store the sequence token for the next iteration
+            sequence_token.token = response.get("nextSequenceToken")
+            return
+
+
+class FirehoseSink(AuditSink):
+    """
+    Write audit log events to a Kinesis Data Firehose delivery stream.
+
+    Every message becomes one line of newline delimited JSON, which the delivery
+    stream compresses and writes to S3.
+    """
+
+    def __init__(self, firehose_client, delivery_stream_name):
+        """Create a new FirehoseSink."""
+        super().__init__()
+        self.firehose_client = firehose_client
+        self.delivery_stream_name = delivery_stream_name
+
+    def write(self, log_events, context):
+        """Write log events in batches within the PutRecordBatch limits."""
+        self.calls = 0
+        self.latencies = []
+        lines = [
+            f"{log_event['message']}\n".encode("utf-8") for log_event in log_events
+        ]
+        written = []
+        batch_start = 0
+        for batch in chunk_records(lines):
+            try:
+                delivered = self._put_record_batch(batch)
+            except ClientError as exc:
+                print(json.dumps({"error": f"Failed to write audit log: {exc!r}"}))
+                break
+            written += [batch_start + position for position in delivered]
+            if len(delivered) < len(batch):
+                break
+            batch_start += len(batch)
+        return written
+
+    def _put_record_batch(self, batch):
+        """
+        Write a batch of records, retrying the entries Firehose rejected.
+
+        Returns the positions in the batch of the records which were delivered.
+        Firehose accepts or rejects every entry on its own, so the records after
+        a rejected one may have been delivered as well.
+        """
+        pending = list(range(len(batch)))
+        for attempt in range(1, MAX_BATCH_ATTEMPTS + 1):
+            self.calls += 1
+            started = time.perf_counter()
+            response = self.firehose_client.put_record_batch(
+                DeliveryStreamName=self.delivery_stream_name,
+                Records=[{"Data": batch[position]} for position in pending],
+            )
+            self.latencies.append((time.perf_counter() - started) * 1000)
+            if not response["FailedPutCount"]:
+                return list(range(len(batch)))
+
+            failures = [
+                (position, result["ErrorCode"])
+                for position, result in zip(pending, response["RequestResponses"])
+                if "ErrorCode" in result
+            ]
+            pending = [position for position, _ in failures]
+            print(
+                f"{len(failures)} records rejected with {failures[0][1]} "
+                f"(attempt {attempt})"
+            )
+            if attempt < MAX_BATCH_ATTEMPTS:
+                time.sleep(0.1 * 2**attempt)
+
+        print(json.dumps({"error": f"Failed to deliver {len(pending)} audit records"}))
+        rejected = set(pending)
+        return [position for position in range(len(batch)) if position not in rejected]
+
+
+def audit_log_stream_name(context):
+    """
+    Return the audit log stream of this execution environment.
+
+    Stream records don't identify their shard or batch slot, but every
+    concurrent batch runs in its own execution environment. Writing to a stream
+    per environment means concurrent batches never share a sequence token. The
+    date prefix keeps the streams of one day together.
+    """
+    # Lambda log stream names end with "[<version>]<execution environment id>"
+    environment_id = context.log_stream_name.rsplit("]", 1)[-1]
+    return f"{datetime.now(timezone.utc):%Y/%m/%d}/{environment_id}"
+
+
+def event_size(log_event):
+    """Return the size of a log event as counted towards the PutLogEvents limit."""
+    return len(log_event["message"].encode("utf-8")) + EVENT_OVERHEAD_BYTES
+
+
+def chunk_log_events(log_events):
+    """Split sorted log events into chunks within the PutLogEvents limits."""
+    chunk = []
+    chunk_bytes = 0
+    for log_event in log_events:
+        size = event_size(log_event)
+        if chunk and (
+            len(chunk) == MAX_EVENTS_PER_CALL
+            or chunk_bytes + size > MAX_BYTES_PER_CALL
+            or log_event["timestamp"] - chunk[0]["timestamp"] > MAX_SPAN_MILLISECONDS
+        ):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(log_event)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def chunk_records(records):
+    """Split Firehose records into batches within the PutRecordBatch limits."""
+    batch = []
+    batch_bytes = 0
+    for record in records:
+        if batch and (
+            len(batch) == MAX_RECORDS_PER_BATCH
+            or batch_bytes + len(record) > MAX_BYTES_PER_BATCH
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(record)
+        batch_bytes += len(record)
+    if batch:
+        yield batch
@@ -0,0 +1,279 @@
+"""
+Backfill the image dimensions of objects uploaded before the processor existed.
+
+Lists the bucket page by page, determines the dimensions of every supported
+image which doesn't have them yet with the same ranged reads and parser as the
+upload processor, and stores them using the same storage mode. Objects which
+already have them cost a HEAD (metadata) or GetObjectTagging (tags) request,
+without reading the image. Progress is checkpointed after every page, so an
+interrupted run resumes where it stopped. Objects which failed are kept in the
+checkpoint and retried first when the run resumes.
+
+With DIMENSION_INDEX_TABLE (and DIMENSION_INDEX_SHARDS) set, the dimensions of
+every image are also written to the dimension index, unless the upload
+processor already indexed it.
+
+Usage:
+    python lambda_functions/s3_upload_processor/backfill.py --bucket <name> \
+        --checkpoint backfill.json --concurrency 32
+
+Set AWS_ENDPOINT_URL_S3 to run against a local S3 stand-in.
+"""
+
+# Standard library imports
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from itertools import repeat
+from typing import List
+
+# Third party imports
+import boto3
+from botocore.config import Config
+
+# The upload processor imports the instrumentation layer, which Lambda mounts
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "../../lambda_layers/instrumentation/python",
+    )
+)
+
+# Local application/library specific imports
+import index  # pylint: disable=wrong-import-position
+
+# Sorts before the sequencer of every S3 event, so the backfill only adds index
+# entries and never replaces those of the upload processor
+BACKFILL_SEQUENCER = "0"
+
+SUPPORTED_EXTENSIONS = (
+    ".jpeg",
+    ".jpg",
+    ".gif",
+    ".png",
+    ".webp",
+    ".bmp",
+    ".tif",
+    ".tiff",
+    ".heic",
+    ".heif",
+    ".avif",
+)
+
+
+@dataclass
+class BackfillProgress:
+    """Counters of a backfill run, the key to resume from and the keys to retry."""
+
+    bucket_name: str
+    prefix: str = ""
+    start_after: str = ""
+    objects_updated: int = 0
+    objects_skipped: int = 0
+    objects_failed: int = 0
+    bytes_read: int = 0
+    failed_keys: List[str] = field(default_factory=list)
+
+
+def load_progress(checkpoint_path, bucket_name, prefix):
+    """Load the checkpoint of a previous run, or start from scratch."""
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return BackfillProgress(bucket_name=bucket_name, prefix=prefix)
+
+    with open(checkpoint_path, encoding="utf-8") as checkpoint_file:
+        progress = BackfillProgress(**json.load(checkpoint_file))
+    if (progress.bucket_name, progress.prefix) != (bucket_name, prefix):
+        raise ValueError(
+            f"Checkpoint {checkpoint_path} belongs to "
+            f"s3://{progress.bucket_name}/{progress.prefix}"
+        )
+    return progress
+
+
+def save_progress(checkpoint_path, progress):
+    """Atomically replace the checkpoint file."""
+    if not checkpoint_path:
+        return
+    with open(f"{checkpoint_path}.tmp", "w", encoding="utf-8") as checkpoint_file:
+        json.dump(asdict(progress), checkpoint_file)
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+
+def stored_dimensions(bucket_name, object_key, storage_mode):
+    """Return the stored (width, height) of an object, or None without them."""
+    if storage_mode == "tags":
+        response = index.s3_client.get_object_tagging(
+            Bucket=bucket_name, Key=object_key
+        )
+        stored = {tag["Key"]: tag["Value"] for tag in response["TagSet"]}
+    else:
+        metadata = index.s3_client.head_object(Bucket=bucket_name, Key=object_key)[
+            "Metadata"
+        ]
+        # Some S3 stand-ins return the underscores of metadata keys as hyphens
+        stored = {key.replace("-", "_"): value for key, value in metadata.items()}
+    if not {"image_width", "image_height"} <= set(stored):
+        return None
+    return int(stored["image_width"]), int(stored["image_height"])
+
+
+def backfill_object(bucket_name, object_key, range_bytes, storage_mode):
+    """Store the dimensions of a single object, return (status, bytes read)."""
+    try:
+        dimensions = stored_dimensions(bucket_name, object_key, storage_mode)
+        status, bytes_read = "skipped", 0
+        if dimensions is None:
+            dimensions, object_info = index.ranged_image_size(
+                bucket_name, object_key, range_bytes
+            )
+            image_width, image_height = dimensions
+            index.store_dimensions(
+                bucket_name,
+                object_key,
+                image_width,
+                image_height,
+                object_info,
+                mode=storage_mode,
+            )
+            status, bytes_read = "updated", object_info.bytes_fetched
+
+        if index.dimension_index:
+            image_width, image_height = dimensions
+            index.dimension_index.put(
+                object_key, image_width, image_height, BACKFILL_SEQUENCER
+            )
+        return status, bytes_read
+    except Exception as exc:  # pylint: disable=broad-except
+        print(json.dumps({"object_key": object_key, "error": repr(exc)}))
+        return "failed", 0
+
+
+def backfill(
+    bucket_name,
+    prefix="",
+    checkpoint_path=None,
+    concurrency=16,
+    range_bytes=16384,
+    storage_mode="metadata",
+):
+    """Backfill the dimensions of all supported images in a bucket."""
+    progress = load_progress(checkpoint_path, bucket_name, prefix)
+    run_started = time.monotonic()
+    run_objects = 0
+    run_bytes = 0
+
+    paginator = index.s3_client.get_paginator("list_objects_v2")
+    pages = paginator.paginate(
+        Bucket=bucket_name, Prefix=prefix, StartAfter=progress.start_after
+    )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        def backfill_keys(object_keys):
+            """Backfill objects and count their outcomes, return the bytes read."""
+            outcomes = executor.map(
+                backfill_object,
+                repeat(bucket_name),
+                object_keys,
+                repeat(range_bytes),
+                repeat(storage_mode),
+            )
+            bytes_total = 0
+            for object_key, (status, bytes_read) in zip(object_keys, outcomes):
+                if status == "updated":
+                    progress.objects_updated += 1
+                elif status == "skipped":
+                    progress.objects_skipped += 1
+                else:
+                    progress.objects_failed += 1
+                    progress.failed_keys.append(object_key)
+                progress.bytes_read += bytes_read
+                bytes_total += bytes_read
+            return bytes_total
+
+        # Retry the objects which failed in previous runs, they are counted again
+        if progress.failed_keys:
+            retry_keys = progress.failed_keys
+            progress.failed_keys = []
+            progress.objects_failed -= len(retry_keys)
+            run_bytes += backfill_keys(retry_keys)
+            run_objects += len(retry_keys)
+            save_progress(checkpoint_path, progress)
+            log_progress(progress, run_started, run_objects, run_bytes)
+
+        for page in pages:
+            if not page.get("Contents"):
+                continue
+            object_keys = [
+                s3_object["Key"]
+                for s3_object in page["Contents"]
+                if s3_object["Key"].lower().endswith(SUPPORTED_EXTENSIONS)
+            ]
+            run_bytes += backfill_keys(object_keys)
+            run_objects += len(object_keys)
+
+            # The whole page is done, so the next run can start after it. Its
+            # failed objects are in the checkpoint, to be retried then.
+            progress.start_after = page["Contents"][-1]["Key"]
+            save_progress(checkpoint_path, progress)
+            log_progress(progress, run_started, run_objects, run_bytes)
+
+    return progress
+
+
+def log_progress(progress, run_started, run_objects, run_bytes):
+    """Print the progress and the throughput of this run."""
+    elapsed = time.monotonic() - run_started
+    print(
+        json.dumps(
+            asdict(progress)
+            | {
+                "objects_per_second": round(run_objects / elapsed, 1),
+                "bytes_per_second": round(run_bytes / elapsed),
+            }
+        )
+    )
+
+
+def main():
+    """Parse the command line arguments and run the backfill."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--checkpoint", help="file to store and resume progress")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--range-bytes", type=int, default=16384)
+    parser.add_argument(
+        "--storage-mode", choices=["metadata", "tags"], default="metadata"
+    )
+    args = parser.parse_args()
+
+    # The processor functions use its module level clients, give them a larger pool.
+    # Multipart copies of all objects share the part copy executor of the processor.
+    index.s3_client = boto3.client(
+        "s3",
+        config=Config(
+            max_pool_connections=args.concurrency + index.multipart_copy_concurrency
+        ),
+    )
+    if index.dimension_index:
+        index.dimension_index.dynamodb_client = boto3.client(
+            "dynamodb", config=Config(max_pool_connections=args.concurrency)
+        )
+
+    backfill(
+        bucket_name=args.bucket,
+        prefix=args.prefix,
+        checkpoint_path=args.checkpoint,
+        concurrency=args.concurrency,
+        range_bytes=args.range_bytes,
+        storage_mode=args.storage_mode,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Queryable index of image dimensions in DynamoDB.
+
+Every image is an item keyed by its object key. The image_width and
+image_height attributes are the sort keys of two GSIs, partitioned over a fixed
+number of shards so heavy write loads (like a backfill) are spread over several
+GSI partitions. Range queries fan out over all shards in parallel.
+
+Usage:
+    index = DimensionIndex(table_name="...", shard_count=10)
+    for item in index.query_width(min_width=4000):
+        print(item["object_key"], item["image_width"], item["image_height"])
+"""
+
+# Standard library imports
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+import boto3
+from botocore.exceptions import ClientError
+
+WIDTH_INDEX = "WidthIndex"
+HEIGHT_INDEX = "HeightIndex"
+# Deleted objects leave a tombstone for a day, so late create events are ignored
+TOMBSTONE_TTL_SECONDS = 86400
+
+
+def normalize_sequencer(sequencer):
+    """Left-pad the hexadecimal sequencer so string order equals event order."""
+    return sequencer.upper().rjust(32, "0")
+
+
+class DimensionIndex:
+    """Write and query image dimensions in the DynamoDB index table."""
+
+    def __init__(self, table_name, shard_count=10, dynamodb_client=None):
+        """Create a new DimensionIndex."""
+        self.table_name = table_name
+        self.shard_count = shard_count
+        self.dynamodb_client = dynamodb_client or boto3.client("dynamodb")
+
+    def shard_for(self, object_key):
+        """Return the GSI partition for an object key."""
+        return f"SHARD#{zlib.crc32(object_key.encode()) % self.shard_count}"
+
+    def put(self, object_key, image_width, image_height, sequencer):
+        """Store the dimensions of an object, unless a later event was indexed."""
+        self._conditional_put(
+            {
+                "PK": {"S": object_key},
+                "shard": {"S": self.shard_for(object_key)},
+                "image_width": {"N": str(image_width)},
+                "image_height": {"N": str(image_height)},
+                "sequencer": {"S": normalize_sequencer(sequencer)},
+            }
+        )
+
+    def remove(self, object_key, sequencer):
+        """
+        Replace the entry of a deleted object with a tombstone.
+
+        The tombstone has no shard or dimension attributes, so it immediately
+        disappears from both (sparse) GSIs.
+        """
+        self._conditional_put(
+            {
+                "PK": {"S": object_key},
+                "deleted": {"BOOL": True},
+                "sequencer": {"S": normalize_sequencer(sequencer)},
+                "expires_at": {"N": str(int(time.time()) + TOMBSTONE_TTL_SECONDS)},
+            }
+        )
+
+    def _conditional_put(self, item):
+        """Write an item if it belongs to a later event than the stored item."""
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item=item,
+                ConditionExpression="attribute_not_exists(PK) OR sequencer < :seq",
+                ExpressionAttributeValues={":seq": item["sequencer"]},
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            print(f"Ignoring out of order event for {item['PK']['S']}")
+
+    def get(self, object_key):
+        """Return the dimensions of a single object, or None if it isn't indexed."""
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={"PK": {"S": object_key}},
+            ConsistentRead=True,
+        )
+        item = response.get("Item")
+        if not item or "deleted" in item:
+            return None
+        return _deserialize(item)
+
+    def query_width(self, min_width=None, max_width=None):
+        """Yield the objects with a width in the (inclusive) range."""
+        return self._query(WIDTH_INDEX, "image_width", min_width, max_width)
+
+    def query_height(self, min_height=None, max_height=None):
+        """Yield the objects with a height in the (inclusive) range."""
+        return self._query(HEIGHT_INDEX, "image_height", min_height, max_height)
+
+    def _query(self, index_name, attribute, minimum, maximum):
+        """Query all shards of a GSI in parallel."""
+        condition = "shard = :shard"
+        values = {}
+        if minimum is not None and maximum is not None:
+            condition += f" AND {attribute} BETWEEN :min AND :max"
+            values = {":min": {"N": str(minimum)}, ":max": {"N": str(maximum)}}
+        elif minimum is not None:
+            condition += f" AND {attribute} >= :min"
+            values = {":min": {"N": str(minimum)}}
+        elif maximum is not None:
+            condition += f" AND {attribute} <= :max"
+            values = {":max": {"N": str(maximum)}}
+
+        def query_shard(shard):
+            paginator = self.dynamodb_client.get_paginator("query")
+            pages = paginator.paginate(
+                TableName=self.table_name,
+                IndexName=index_name,
+                KeyConditionExpression=condition,
+                ExpressionAttributeValues=values | {":shard": {"S": shard}},
+            )
+            return [_deserialize(item) for page in pages for item in page["Items"]]
+
+        shards = [f"SHARD#{number}" for number in range(self.shard_count)]
+        with ThreadPoolExecutor(max_workers=self.shard_count) as executor:
+            for items in executor.map(query_shard, shards):
+                yield from items
+
+
+def _deserialize(item):
+    """Convert an index item to a plain dictionary."""
+    return {
+        "object_key": item["PK"]["S"],
+        "image_width": int(item["image_width"]["N"]),
+        "image_height": int(item["image_height"]["N"]),
+    }
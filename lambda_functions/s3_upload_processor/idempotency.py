@@ -0,0 +1,139 @@
+"""Duplicate suppression for at-least-once S3 event notifications."""
+
+# Standard library imports
+import threading
+import time
+from collections import OrderedDict
+
+# Third party imports
+from botocore.exceptions import ClientError
+
+
+# The status of an event in the table
+IN_PROGRESS = "IN_PROGRESS"
+COMPLETED = "COMPLETED"
+
+
+class IdempotencyCache:
+    """
+    Two-tier record of the events that are being or have been processed.
+
+    The first tier is an LRU dictionary with TTL eviction, which lives as long as
+    the Lambda container. The optional second tier is a DynamoDB table with a
+    conditional write per event, which is shared between all containers.
+
+    A claim is in progress until it is completed or released. It expires after
+    in_progress_seconds, about the function timeout, so an event whose function
+    timed out or crashed can be claimed again by the retry. Completed events
+    expire after ttl_seconds.
+    """
+
+    def __init__(
+        self,
+        max_entries,
+        ttl_seconds,
+        in_progress_seconds,
+        table_name=None,
+        dynamodb_client=None,
+    ):
+        """Create an empty cache."""
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.in_progress_seconds = in_progress_seconds
+        self.table_name = table_name
+        self.dynamodb_client = dynamodb_client
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def reset_counters(self):
+        """Reset the hit and miss counters, eg. at the start of an invocation."""
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def claim(self, key):
+        """
+        Claim an event for processing.
+
+        Returns True if the caller should process the event, and complete or
+        release it afterwards. Returns False if it is a duplicate of an event
+        which was already processed or is in progress.
+        """
+        now = time.time()
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return False
+            self._store(key, now + self.in_progress_seconds)
+
+        if self.table_name:
+            try:
+                claimed = self._claim_in_table(key, now)
+            except Exception:
+                # Nobody holds the claim, so a retry must be able to make it
+                with self.lock:
+                    self.entries.pop(key, None)
+                raise
+            if not claimed:
+                with self.lock:
+                    self.hits += 1
+                return False
+
+        with self.lock:
+            self.misses += 1
+        return True
+
+    def complete(self, key):
+        """Mark a claimed event as processed, so duplicates are suppressed."""
+        now = time.time()
+        with self.lock:
+            self._store(key, now + self.ttl_seconds)
+        if self.table_name:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "PK": {"S": key},
+                    "status": {"S": COMPLETED},
+                    "expires_at": {"N": str(int(now + self.ttl_seconds))},
+                },
+            )
+
+    def release(self, key):
+        """Forget a claimed event, so a retry will process it again."""
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.table_name:
+            self.dynamodb_client.delete_item(
+                TableName=self.table_name, Key={"PK": {"S": key}}
+            )
+
+    def _store(self, key, expires_at):
+        """Add a key to the LRU, evicting the least recently used if it is full."""
+        self.entries[key] = expires_at
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _claim_in_table(self, key, now):
+        """Conditionally write the key, unless an unexpired claim already exists."""
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "PK": {"S": key},
+                    "status": {"S": IN_PROGRESS},
+                    "expires_at": {"N": str(int(now + self.in_progress_seconds))},
+                },
+                # DynamoDB TTL deletes lazily, so check the expiry ourselves
+                ConditionExpression="attribute_not_exists(PK) OR expires_at < :now",
+                ExpressionAttributeValues={":now": {"N": str(int(now))}},
+            )
+            return True
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
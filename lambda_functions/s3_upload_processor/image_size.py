@@ -0,0 +1,292 @@
+"""Determine image dimensions from the ranges of a file held in memory.
+
+The format is sniffed once from the magic bytes, after which a format-specific
+parser reads the dimensions straight from memoryviews of the ranges. Parsers
+never read more than they need: if a range is missing they raise NeedMoreData
+with the offset and length required, so the caller can fetch just that range
+and try again. Fields at the end of large files don't need the bytes before.
+"""
+
+# Standard library imports
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+HEIF_BRANDS = {
+    b"avif",
+    b"avis",
+    b"heic",
+    b"heim",
+    b"heis",
+    b"heix",
+    b"hevc",
+    b"hevx",
+    b"mif1",
+    b"msf1",
+}
+
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7}
+# SOFn markers; 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) share the range but are not
+# frame headers. SOF0 is baseline, SOF2 progressive.
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+
+
+class NeedMoreData(Exception):
+    """The data doesn't hold a range the parser needs."""
+
+    def __init__(self, offset, length):
+        """Store the range the parser needs."""
+        super().__init__(f"Need {length} bytes at offset {offset}")
+        self.offset = offset
+        self.length = length
+
+
+class SparseData:
+    """
+    Ranges of a file, which don't need to be contiguous.
+
+    Overlapping and adjacent ranges are merged, so a read succeeds as long as
+    the bytes it covers were added, in any number of ranges.
+    """
+
+    def __init__(self, data=None):
+        """Start with the data of the entire file, or without any data."""
+        self.ranges = {}
+        if data is not None:
+            self.ranges[0] = data
+
+    def add(self, offset, data):
+        """Add the data of the file at offset."""
+        end = offset + len(data)
+        touching = {
+            start: chunk
+            for start, chunk in self.ranges.items()
+            if start <= end and offset <= start + len(chunk)
+        }
+        if not touching:
+            self.ranges[offset] = data
+            return
+
+        touching[offset] = data
+        merged_start = min(touching)
+        merged = bytearray(
+            max(start + len(chunk) for start, chunk in touching.items()) - merged_start
+        )
+        for start, chunk in touching.items():
+            merged[start - merged_start : start - merged_start + len(chunk)] = chunk
+            self.ranges.pop(start, None)
+        self.ranges[merged_start] = merged
+
+    def covered_until(self, offset):
+        """Return the end of the range which covers offset, or offset itself."""
+        for start, chunk in self.ranges.items():
+            if start <= offset < start + len(chunk):
+                return start + len(chunk)
+        return offset
+
+    def read(self, offset, length):
+        """Return a memoryview of length bytes at offset, or ask for the range."""
+        for start, chunk in self.ranges.items():
+            if start <= offset and offset + length <= start + len(chunk):
+                return memoryview(chunk)[offset - start : offset - start + length]
+        raise NeedMoreData(offset, length)
+
+
+def get_image_size(data):
+    """Return the (width, height) of the image in data, bytes or SparseData."""
+    if not isinstance(data, SparseData):
+        data = SparseData(data)
+    image_format = sniff_format(data)
+    if image_format not in PARSERS:
+        raise RuntimeError("Unsupported image type")
+    return PARSERS[image_format](data)
+
+
+def sniff_format(data):
+    """Return the image format based on the magic bytes, or None if unknown."""
+    head = bytes(data.read(0, 16))
+    if head.startswith(PNG_SIGNATURE):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:2] == b"BM":
+        return "bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        return "heif"
+    return None
+
+
+def _unpack(fmt, data, offset):
+    """Unpack fmt at offset, or ask for the range if the data doesn't hold it."""
+    return struct.unpack(fmt, data.read(offset, struct.calcsize(fmt)))
+
+
+def parse_png(data):
+    """Read the dimensions from the IHDR chunk."""
+    if _unpack(">4s", data, 12)[0] != b"IHDR":
+        raise RuntimeError("PNG does not start with an IHDR chunk")
+    return _unpack(">II", data, 16)
+
+
+def parse_gif(data):
+    """Read the dimensions from the logical screen descriptor."""
+    return _unpack("<HH", data, 6)
+
+
+def parse_jpeg(data):
+    """
+    Walk the JPEG markers until the first SOFn frame header.
+
+    Each segment is skipped as a whole using its length field, so large EXIF, ICC
+    or other APPn segments cost a single jump instead of a byte-by-byte scan.
+    """
+    offset = 2
+    while True:
+        (marker_prefix,) = _unpack(">B", data, offset)
+        if marker_prefix != 0xFF:
+            raise RuntimeError(f"Invalid JPEG marker at offset {offset}")
+        # Any number of 0xFF fill bytes may precede the marker
+        (marker,) = _unpack(">B", data, offset + 1)
+        while marker == 0xFF:
+            offset += 1
+            (marker,) = _unpack(">B", data, offset + 1)
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        if marker in (JPEG_SOS, JPEG_EOI):
+            raise RuntimeError("JPEG has no frame header before the image data")
+
+        (length,) = _unpack(">H", data, offset + 2)
+        if marker in JPEG_SOF_MARKERS:
+            # Length (2 bytes) and precision (1 byte) precede the dimensions
+            height, width = _unpack(">HH", data, offset + 5)
+            return width, height
+        offset += 2 + length
+
+
+def parse_webp(data):
+    """Read the dimensions from the first VP8, VP8L or VP8X chunk."""
+    (chunk_type,) = _unpack(">4s", data, 12)
+    if chunk_type == b"VP8 ":
+        # Lossy: 3 byte frame tag, 3 byte start code, then 14 bit dimensions
+        if _unpack("3s", data, 23)[0] != b"\x9d\x01\x2a":
+            raise RuntimeError("Invalid VP8 start code")
+        width, height = _unpack("<HH", data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk_type == b"VP8L":
+        # Lossless: signature byte, then 14 bit width-1 and 14 bit height-1
+        signature, bits = _unpack("<BI", data, 20)
+        if signature != 0x2F:
+            raise RuntimeError("Invalid VP8L signature")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk_type == b"VP8X":
+        # Extended: 24 bit canvas width-1 and height-1
+        width_bytes, height_bytes = _unpack("<3s3s", data, 24)
+        return (
+            int.from_bytes(width_bytes, "little") + 1,
+            int.from_bytes(height_bytes, "little") + 1,
+        )
+    raise RuntimeError(f"Unsupported WebP chunk {chunk_type!r}")
+
+
+def parse_bmp(data):
+    """Read the dimensions from the DIB header."""
+    (header_size,) = _unpack("<I", data, 14)
+    if header_size == 12:
+        # OS/2 BITMAPCOREHEADER uses 16 bit dimensions
+        return _unpack("<HH", data, 18)
+    width, height = _unpack("<ii", data, 18)
+    # A negative height means the rows are stored top-down
+    return width, abs(height)
+
+
+def parse_tiff(data):
+    """Read ImageWidth and ImageLength from the first IFD."""
+    byte_order = "<" if _unpack("2s", data, 0)[0] == b"II" else ">"
+    (ifd_offset,) = _unpack(f"{byte_order}I", data, 4)
+    (entry_count,) = _unpack(f"{byte_order}H", data, ifd_offset)
+    # The IFD may be anywhere in the file, ask for all of its entries at once
+    data.read(ifd_offset + 2, entry_count * 12)
+
+    dimensions = {}
+    for index in range(entry_count):
+        entry_offset = ifd_offset + 2 + index * 12
+        tag, field_type = _unpack(f"{byte_order}HH", data, entry_offset)
+        if tag not in (256, 257):
+            continue
+        # SHORT (3) or LONG (4), stored inline in the value field
+        value_format = "H" if field_type == 3 else "I"
+        (dimensions[tag],) = _unpack(
+            f"{byte_order}{value_format}", data, entry_offset + 8
+        )
+        if len(dimensions) == 2:
+            return dimensions[256], dimensions[257]
+    raise RuntimeError("TIFF has no ImageWidth/ImageLength tags")
+
+
+def _iter_boxes(data, start, end):
+    """Yield (type, payload offset, box end) for the ISO BMFF boxes in a range."""
+    offset = start
+    while offset < end:
+        size, box_type = _unpack(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            (size,) = _unpack(">Q", data, offset + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise RuntimeError(f"Invalid box size at offset {offset}")
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def _find_box(data, box_type, start, end):
+    """Return (payload offset, box end) of the first box of a type in a range."""
+    for current_type, payload, box_end in _iter_boxes(data, start, end):
+        if current_type == box_type:
+            return payload, box_end
+    raise RuntimeError(f"HEIF has no {box_type.decode()} box")
+
+
+def parse_heif(data):
+    """
+    Read the dimensions from the ispe properties in meta/iprp/ipco.
+
+    HEIF and AVIF files may contain several ispe boxes (thumbnails, grid tiles);
+    the largest one describes the full image.
+    """
+    file_end = float("inf")
+    meta_payload, meta_end = _find_box(data, b"meta", 0, file_end)
+    # meta is a FullBox, skip its version and flags
+    iprp_payload, iprp_end = _find_box(data, b"iprp", meta_payload + 4, meta_end)
+    ipco_payload, ipco_end = _find_box(data, b"ipco", iprp_payload, iprp_end)
+
+    sizes = [
+        # ispe is a FullBox, skip its version and flags
+        _unpack(">II", data, payload + 4)
+        for box_type, payload, _ in _iter_boxes(data, ipco_payload, ipco_end)
+        if box_type == b"ispe"
+    ]
+    if not sizes:
+        raise RuntimeError("HEIF has no ispe box")
+    return max(sizes, key=lambda size: size[0] * size[1])
+
+
+PARSERS = {
+    "png": parse_png,
+    "gif": parse_gif,
+    "jpeg": parse_jpeg,
+    "webp": parse_webp,
+    "bmp": parse_bmp,
+    "tiff": parse_tiff,
+    "heif": parse_heif,
+}
@@ -1,88 +1,493 @@
-"""Function to store image size in S3 metadata."""
+"""Function to store image size in S3 metadata or object tags."""
 
-import struct
-import imghdr
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import unquote_plus, urlencode
 import boto3
+from botocore.config import Config
+from dimension_index import DimensionIndex
+from idempotency import IdempotencyCache
+from image_size import NeedMoreData, get_image_size
+from instrumentation import MetricsLogger
+from ranged_reader import RangedObjectReader
 
-s3_client = boto3.client("s3")
+# Records in a batch are processed concurrently, and so are the parts of large
+# multipart copies. The records share one part copy executor, so at most
+# max_concurrency + multipart_copy_concurrency requests are in flight.
+max_concurrency = int(os.environ.get("MAX_CONCURRENCY", "10"))
+multipart_copy_concurrency = int(os.environ.get("MULTIPART_COPY_CONCURRENCY", "8"))
+part_copy_executor = ThreadPoolExecutor(max_workers=multipart_copy_concurrency)
+s3_client = boto3.client(
+    "s3",
+    config=Config(max_pool_connections=max_concurrency + multipart_copy_concurrency),
+)
+
+# "ranged" only fetches the leading bytes of an object (and more ranges if the
+# parser needs them), "download" fetches the whole object.
+fetch_mode = os.environ.get("FETCH_MODE", "ranged")
+initial_range_bytes = int(os.environ.get("INITIAL_RANGE_BYTES", "65536"))
+
+# "metadata" rewrites the object with the dimensions in its user metadata,
+# "tags" stores them as object tags without touching the object itself.
+storage_mode = os.environ.get("STORAGE_MODE", "metadata")
+
+# Objects above the threshold are rewritten with a multipart copy. CopyObject is
+# limited to 5 GiB and copies serially, UploadPartCopy copies parts in parallel.
+multipart_copy_threshold = int(
+    os.environ.get("MULTIPART_COPY_THRESHOLD", str(512 * 1024**2))
+)
+multipart_copy_part_size = int(
+    os.environ.get("MULTIPART_COPY_PART_SIZE", str(128 * 1024**2))
+)
+MAX_MULTIPART_PARTS = 10000
+
+dynamodb_client = boto3.client(
+    "dynamodb", config=Config(max_pool_connections=max_concurrency)
+)
+
+# S3 delivers notifications at least once, remember which events were processed.
+# Events in progress are claimed for about the function timeout.
+idempotency_cache = IdempotencyCache(
+    max_entries=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000")),
+    ttl_seconds=int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "86400")),
+    in_progress_seconds=int(os.environ.get("IDEMPOTENCY_IN_PROGRESS_SECONDS", "60")),
+    table_name=os.environ.get("IDEMPOTENCY_TABLE"),
+    dynamodb_client=dynamodb_client,
+)
+
+# Optional queryable index of the dimensions, kept in sync with deletes
+dimension_index = None
+if os.environ.get("DIMENSION_INDEX_TABLE"):
+    dimension_index = DimensionIndex(
+        table_name=os.environ["DIMENSION_INDEX_TABLE"],
+        shard_count=int(os.environ.get("DIMENSION_INDEX_SHARDS", "10")),
+        dynamodb_client=dynamodb_client,
+    )
+
+# Embedded metrics, printed once at the end of every invocation
+metrics = MetricsLogger()
+
+
+@dataclass
+class ObjectInfo:
+    """Properties of the S3 object learned while reading its dimensions."""
+
+    content_type: Optional[str] = None
+    tag_count: int = 0
+    bytes_fetched: int = 0
+    object_size: Optional[int] = None
+    etag: Optional[str] = None
+    metadata: Optional[dict] = None
 
 
 def event_handler(event, _context):
     """Run the main lambda function."""
-    for record in event["Records"]:
-        parse_image(record)
+    try:
+        return process_event(event)
+    finally:
+        metrics.flush()
+
+
+def process_event(event):
+    """Process the S3 events of a direct invocation or an SQS batch."""
+    # Notifications buffered through SQS carry the S3 event in the message body
+    if event["Records"] and event["Records"][0].get("eventSource") == "aws:sqs":
+        return process_sqs_messages(event["Records"])
+
+    outcomes = process_records(event["Records"])
+    failed_keys = [
+        record["s3"]["object"]["key"]
+        for record, exc in zip(event["Records"], outcomes)
+        if exc is not None
+    ]
+    if failed_keys:
+        raise RuntimeError(
+            f"Failed to process {len(failed_keys)} of {len(event['Records'])} "
+            f"records: {failed_keys}"
+        )
+    return None
+
+
+def process_sqs_messages(messages):
+    """
+    Process the S3 events in a batch of SQS messages.
+
+    Returns the IDs of messages with failed records as partial batch failures,
+    so only those messages are retried (and eventually sent to the DLQ).
+    """
+    s3_records = []
+    message_ids = []
+    for message in messages:
+        body = json.loads(message["body"])
+        # S3 sends an s3:TestEvent without records when the notification is set up
+        for record in body.get("Records", []):
+            s3_records.append(record)
+            message_ids.append(message["messageId"])
+
+    outcomes = process_records(s3_records)
+    failed_message_ids = {
+        message_id for message_id, exc in zip(message_ids, outcomes) if exc is not None
+    }
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in sorted(failed_message_ids)
+        ]
+    }
+
+
+def process_records(records):
+    """
+    Process S3 event records concurrently.
+
+    Each record is isolated: a failing record is reported but does not stop the
+    other records. Returns the exception (or None) for every record, in order.
+    """
+    if not records:
+        return []
+
+    idempotency_cache.reset_counters()
+    if len(records) == 1:
+        outcomes = [process_record(records[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            outcomes = list(executor.map(process_record, records))
+
+    metrics.put_metric("BatchSize", len(records))
+    metrics.put_metric("Errors", sum(exc is not None for exc in outcomes))
+    print(
+        json.dumps(
+            {
+                "idempotency_hits": idempotency_cache.hits,
+                "idempotency_misses": idempotency_cache.misses,
+            }
+        )
+    )
+    return outcomes
+
+
+def process_record(record):
+    """Process a single record, returning the exception if it failed."""
+    if record["eventName"] == "ObjectCreated:Copy":
+        print("Not processing copy commands to prevent infinite loops")
+        return None
+
+    # Skip redelivered events and objects we already processed without any S3 I/O.
+    # A failing claim, eg. a throttled table, only fails its own record.
+    try:
+        idempotency_key = get_idempotency_key(record)
+        claimed = idempotency_cache.claim(idempotency_key)
+    except Exception as exc:  # pylint: disable=broad-except
+        log_record_error(record, exc)
+        return exc
+    if not claimed:
+        print(json.dumps({"duplicate_event": idempotency_key}))
+        return None
+
+    try:
+        # A malformed eventTime only fails its own record
+        event_name = record["eventName"]
+        metrics.put_metric("Records", 1, event_type=event_name)
+        metrics.put_metric(
+            "Lag", event_lag_milliseconds(record), "Milliseconds", event_type=event_name
+        )
+
+        if event_name.startswith("ObjectRemoved:"):
+            remove_from_index(record)
+        else:
+            parse_image(record)
+    except Exception as exc:  # pylint: disable=broad-except
+        log_record_error(record, exc)
+        update_idempotency_cache(idempotency_cache.release, idempotency_key)
+        return exc
+
+    update_idempotency_cache(idempotency_cache.complete, idempotency_key)
+    return None
+
+
+def log_record_error(record, exc):
+    """Log the error of a failed record."""
+    print(
+        json.dumps(
+            {
+                "object_key": record.get("s3", {}).get("object", {}).get("key"),
+                "error": repr(exc),
+                "cause": repr(exc.__cause__) if exc.__cause__ else None,
+            }
+        )
+    )
+
+
+def update_idempotency_cache(update, idempotency_key):
+    """
+    Complete or release a claimed event, logging instead of raising errors.
+
+    The outcome of the record doesn't depend on it: a claim which isn't
+    completed or released expires after about the function timeout.
+    """
+    try:
+        update(idempotency_key)
+    except Exception as exc:  # pylint: disable=broad-except
+        print(
+            json.dumps(
+                {
+                    "idempotency_key": idempotency_key,
+                    "idempotency_update": update.__name__,
+                    "error": repr(exc),
+                }
+            )
+        )
+
+
+def event_lag_milliseconds(record):
+    """Return the time between the S3 event and now in milliseconds."""
+    # Event times look like "2022-01-01T12:00:00.123Z"
+    event_time = datetime.fromisoformat(record["eventTime"].replace("Z", "+00:00"))
+    return round((datetime.now(timezone.utc) - event_time).total_seconds() * 1000)
+
+
+def get_idempotency_key(record):
+    """
+    Return the key identifying the event for duplicate suppression.
+
+    The sequencer is unique per object change and identical for redeliveries; the
+    ETag is only used as a fallback because re-uploading identical content
+    replaces the metadata and tags and should be processed again.
+    """
+    s3_object = record["s3"]["object"]
+    version = s3_object.get("sequencer") or s3_object.get("eTag", "")
+    return f"{record['s3']['bucket']['name']}/{s3_object['key']}#{version}"
+
+
+def get_object_key(record):
+    """Return the object key of a record; keys in S3 events are URL encoded."""
+    return unquote_plus(record["s3"]["object"]["key"])
+
+
+def remove_from_index(record):
+    """Remove a deleted object from the dimension index."""
+    if dimension_index:
+        dimension_index.remove(
+            get_object_key(record), record["s3"]["object"]["sequencer"]
+        )
 
 
 def parse_image(record):
     """Download an image from S3 and extract its dimensions."""
-    object_key = record["s3"]["object"]["key"]
+    object_key = get_object_key(record)
     bucket_name = record["s3"]["bucket"]["name"]
-    s3_event_name = record["eventName"]
-    if s3_event_name == "ObjectCreated:Copy":
-        print("Not processing copy commands to prevent infinite loops")
-        return
-
-    # Copy the file to local disk
-    filename = object_key.split("/")[-1]
-    local_file_location = f"/tmp/{filename}"
-    image_object = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-    with open(local_file_location, "wb") as file_loc:
-        file_loc.write(image_object["Body"].read())
 
     # Determine the image dimensions
-    try:
-        image_width, image_height = get_image_size(local_file_location)
-    except Exception as exc:
-        raise RuntimeError("Failed to get image dimensions") from exc
+    if fetch_mode == "download":
+        image_size, object_info = download_image_size(bucket_name, object_key)
+    else:
+        image_size, object_info = ranged_image_size(bucket_name, object_key)
+    image_width, image_height = image_size
+
+    print(
+        json.dumps(
+            {
+                "object_key": object_key,
+                "fetch_mode": fetch_mode,
+                "bytes_fetched": object_info.bytes_fetched,
+            }
+        )
+    )
+    metrics.put_metric(
+        "BytesRead", object_info.bytes_fetched, "Bytes", event_type=record["eventName"]
+    )
+
+    store_dimensions(bucket_name, object_key, image_width, image_height, object_info)
+    if dimension_index:
+        dimension_index.put(
+            object_key, image_width, image_height, record["s3"]["object"]["sequencer"]
+        )
+
+
+def store_dimensions(
+    bucket_name, object_key, image_width, image_height, object_info, mode=None
+):
+    """Store the dimensions according to the storage mode."""
+    if (mode or storage_mode) == "tags":
+        store_dimensions_as_tags(
+            bucket_name, object_key, image_width, image_height, object_info
+        )
+    else:
+        store_dimensions_as_metadata(
+            bucket_name, object_key, image_width, image_height, object_info
+        )
+
+
+def store_dimensions_as_metadata(
+    bucket_name, object_key, image_width, image_height, object_info
+):
+    """Copy the object onto itself with the dimensions in its user metadata."""
+    metadata = {
+        "image_width": str(image_width),
+        "image_height": str(image_height),
+    }
+
+    # The multipart copy below emits an ObjectCreated:CompleteMultipartUpload
+    # event instead of a Copy event, so don't rewrite objects which already
+    # have the right dimensions.
+    if all(object_info.metadata.get(key) == value for key, value in metadata.items()):
+        print(json.dumps({"object_key": object_key, "metadata_up_to_date": True}))
+        return
+
+    if object_info.object_size > multipart_copy_threshold:
+        multipart_copy_with_metadata(bucket_name, object_key, metadata, object_info)
+        return
 
-    # Copy the object back to its original location, but with metadata
     s3_client.copy_object(
         Key=object_key,
         Bucket=bucket_name,
-        ContentType=image_object["ContentType"],
+        ContentType=object_info.content_type,
         CopySource={"Bucket": bucket_name, "Key": object_key},
-        Metadata={
-            "IMAGE_WIDTH": str(image_width),
-            "IMAGE_HEIGHT": str(image_height),
-        },
+        Metadata=metadata,
         MetadataDirective="REPLACE",
     )
 
 
-def get_image_size(fname):
+def multipart_copy_with_metadata(bucket_name, object_key, metadata, object_info):
+    """Copy a large object onto itself with new metadata, copying parts in parallel."""
+    # Grow the part size if the object would otherwise need too many parts
+    part_size = max(
+        multipart_copy_part_size, -(-object_info.object_size // MAX_MULTIPART_PARTS)
+    )
+    part_ranges = [
+        (start, min(start + part_size, object_info.object_size) - 1)
+        for start in range(0, object_info.object_size, part_size)
+    ]
+
+    # Unlike CopyObject, a multipart upload doesn't carry over the tags
+    create_params = {}
+    if object_info.tag_count:
+        response = s3_client.get_object_tagging(Bucket=bucket_name, Key=object_key)
+        create_params["Tagging"] = urlencode(
+            {tag["Key"]: tag["Value"] for tag in response["TagSet"]}
+        )
+
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket_name,
+        Key=object_key,
+        ContentType=object_info.content_type,
+        Metadata=metadata,
+        **create_params,
+    )["UploadId"]
+
+    def copy_part(part):
+        part_number, (start, end) = part
+        response = s3_client.upload_part_copy(
+            Bucket=bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource={"Bucket": bucket_name, "Key": object_key},
+            CopySourceRange=f"bytes={start}-{end}",
+            # Fail instead of mixing parts of two versions if the object changes
+            CopySourceIfMatch=object_info.etag,
+        )
+        return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    futures = []
+    try:
+        futures = [
+            part_copy_executor.submit(copy_part, part)
+            for part in enumerate(part_ranges, start=1)
+        ]
+        parts = [future.result() for future in futures]
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        # Don't leave (billed) orphaned parts behind, nor copy any more of them
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        s3_client.abort_multipart_upload(
+            Bucket=bucket_name, Key=object_key, UploadId=upload_id
+        )
+        raise
+
+    print(
+        json.dumps(
+            {
+                "object_key": object_key,
+                "multipart_copy_parts": len(parts),
+                "multipart_copy_part_size": part_size,
+            }
+        )
+    )
+
+
+def store_dimensions_as_tags(
+    bucket_name, object_key, image_width, image_height, object_info
+):
     """
-    Determine the image type of fhandle and return its size.
+    Store the dimensions as object tags.
 
-    Copied from https://stackoverflow.com/a/20380514/1600866
+    Tagging does not rewrite the object and does not emit an ObjectCreated event.
+    PutObjectTagging replaces the whole tag set, so existing tags are merged in;
+    the (free) TagCount from the GET tells us whether there are any.
     """
-    with open(fname, "rb") as fhandle:
-        head = fhandle.read(24)
-        if len(head) != 24:
-            raise RuntimeError("Head is not 24 bytes")
-        if imghdr.what(fname) == "png":
-            check = struct.unpack(">i", head[4:8])[0]
-            if check != 0x0D0A1A0A:
-                raise RuntimeError("Magic number is not 0x0D0A1A0A")
-            width, height = struct.unpack(">ii", head[16:24])
-        elif imghdr.what(fname) == "gif":
-            width, height = struct.unpack("<HH", head[6:10])
-        elif imghdr.what(fname) == "jpeg":
-            try:
-                fhandle.seek(0)  # Read 0xff next
-                size = 2
-                ftype = 0
-                while not 0xC0 <= ftype <= 0xCF:
-                    fhandle.seek(size, 1)
-                    byte = fhandle.read(1)
-                    while ord(byte) == 0xFF:
-                        byte = fhandle.read(1)
-                    ftype = ord(byte)
-                    size = struct.unpack(">H", fhandle.read(2))[0] - 2
-                # We are at a SOFn block
-                fhandle.seek(1, 1)  # Skip `precision' byte.
-                height, width = struct.unpack(">HH", fhandle.read(4))
-            except Exception as exc:  # pylint: disable=broad-except
-                raise RuntimeError("Failed to parse jpeg") from exc
-        else:
-            raise RuntimeError("Unsupported image type")
-        return width, height
+    tags = {}
+    if object_info.tag_count:
+        response = s3_client.get_object_tagging(Bucket=bucket_name, Key=object_key)
+        tags = {tag["Key"]: tag["Value"] for tag in response["TagSet"]}
+    tags["image_width"] = str(image_width)
+    tags["image_height"] = str(image_height)
+
+    s3_client.put_object_tagging(
+        Bucket=bucket_name,
+        Key=object_key,
+        Tagging={
+            "TagSet": [{"Key": key, "Value": value} for key, value in tags.items()]
+        },
+    )
+
+
+def ranged_image_size(bucket_name, object_key, range_bytes=None):
+    """Determine the image dimensions from the ranges of the object they are in."""
+    reader = RangedObjectReader(
+        s3_client, bucket_name, object_key, range_bytes or initial_range_bytes
+    )
+    try:
+        image_size = reader.image_size()
+    except NeedMoreData as exc:
+        raise RuntimeError("Failed to get image dimensions: truncated") from exc
+    except Exception as exc:
+        raise RuntimeError("Failed to get image dimensions") from exc
+
+    return image_size, ObjectInfo(
+        content_type=reader.content_type,
+        tag_count=reader.tag_count,
+        bytes_fetched=reader.bytes_fetched,
+        object_size=reader.object_size,
+        etag=reader.etag,
+        metadata=reader.metadata,
+    )
+
+
+def download_image_size(bucket_name, object_key):
+    """Download the full object and determine its dimensions."""
+    image_object = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+    body = image_object["Body"].read()
+    try:
+        image_size = get_image_size(body)
+    except Exception as exc:
+        raise RuntimeError("Failed to get image dimensions") from exc
+
+    return image_size, ObjectInfo(
+        content_type=image_object["ContentType"],
+        tag_count=image_object.get("TagCount", 0),
+        bytes_fetched=len(body),
+        object_size=image_object["ContentLength"],
+        etag=image_object["ETag"],
+        metadata=image_object.get("Metadata", {}),
+    )
@@ -0,0 +1,88 @@
+"""Read the dimensions of an image in S3 from the ranges the parser needs."""
+
+# Third party imports
+from botocore.exceptions import ClientError
+
+# Local application/library specific imports
+from image_size import NeedMoreData, SparseData, get_image_size
+
+# The ranges after the first one start at a marker or field the parser skipped
+# to, which is small. A larger window would mostly fetch the segments it skips.
+WINDOW_BYTES = 4096
+
+
+class RangedObjectReader:
+    """The ranges of an S3 object the parser needs, fetched with ranged GETs."""
+
+    def __init__(self, s3_client, bucket_name, object_key, range_bytes):
+        """Fetch the first range of the object."""
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.data = SparseData()
+        self.bytes_fetched = 0
+        self.object_size = None
+        self.content_type = None
+        self.tag_count = 0
+        self.etag = None
+        self.metadata = None
+        self.range_requests = 0
+        self._fetch(0, range_bytes)
+
+    def image_size(self):
+        """
+        Return the (width, height) of the image, fetching what the parser asks for.
+
+        Raises NeedMoreData if the parser needs a range beyond the end of the
+        object.
+        """
+        while True:
+            try:
+                return get_image_size(self.data)
+            except NeedMoreData as exc:
+                if not self.fetch(exc.offset, exc.length):
+                    raise
+
+    def _fetch(self, offset, length):
+        """Add `length` bytes of the object at `offset` to the data."""
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=self.object_key,
+                Range=f"bytes={offset}-{offset + length - 1}",
+            )
+        except ClientError as exc:
+            # S3 rejects ranges that start beyond the end of the object
+            if exc.response["Error"]["Code"] != "InvalidRange":
+                raise
+            self.object_size = offset
+            return 0
+
+        self.range_requests += 1
+        if self.content_type is None:
+            self.content_type = response["ContentType"]
+            self.tag_count = response.get("TagCount", 0)
+            self.etag = response["ETag"]
+            self.metadata = response.get("Metadata", {})
+        # ContentRange looks like "bytes 0-65535/4718592"
+        self.object_size = int(response["ContentRange"].split("/")[-1])
+        body = response["Body"].read()
+        self.data.add(offset, body)
+        self.bytes_fetched += len(body)
+        return len(body)
+
+    def fetch(self, offset, length):
+        """
+        Fetch a range the parser asked for, return False if the object ends first.
+
+        Only the part of the range which isn't held yet is fetched, in a window
+        of at least WINDOW_BYTES so the next few markers usually come along.
+        Bytes between the ranges are never fetched, so fields at the end of
+        multi-GB files cost about one window.
+        """
+        end = offset + length
+        if end > self.object_size:
+            return False
+        start = self.data.covered_until(offset)
+        fetch_end = min(max(end, start + WINDOW_BYTES), self.object_size)
+        return self._fetch(start, fetch_end - start) > 0
@@ -1,10 +1,45 @@
 """Lambda function that reports the state machine results back to CFN."""
 from dataclasses import dataclass
+from datetime import datetime, timezone
 import json
+import os
+import statistics
+import time
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 import urllib3
 
 http = urllib3.PoolManager()
 
+dynamodb_client = boto3.client("dynamodb")
+timing_history_table = os.environ.get("TIMING_HISTORY_TABLE")
+
+# The maximum timings per test name, and how much slower than the median of the
+# latest passing runs a timing may be
+latency_budgets = json.loads(os.environ.get("LATENCY_BUDGETS", "{}"))
+regression_tolerance = float(os.environ.get("REGRESSION_TOLERANCE", "0.5"))
+regression_history_runs = int(os.environ.get("REGRESSION_HISTORY_RUNS", "10"))
+# Accept the timings of this run as the new baseline, eg. after an intentional
+# slowdown. Budgets still apply, regressions against the history don't.
+accept_timings = os.environ.get("ACCEPT_TIMINGS", "false") == "true"
+
+# The timings every passing test reports, in seconds
+TIMINGS = (
+    "act_duration_seconds",
+    "time_to_consistency_seconds",
+    "assert_duration_seconds",
+)
+# Polling makes the time to consistency jump by seconds, so small differences
+# and short histories don't count as regressions
+MIN_HISTORY_RUNS = 3
+MIN_REGRESSION_SECONDS = 1.0
+HISTORY_TTL_SECONDS = 90 * 24 * 60 * 60
+SLOWEST_TESTS_IN_REASON = 3
+# CloudFormation rejects responses over 4 KB, which leaves the stack waiting for
+# an hour. The full lists are logged, the reason only names the first ones.
+MAX_ITEMS_IN_REASON = 10
+MAX_REASON_LENGTH = 2048
+
 
 @dataclass
 class CfnProperties:
@@ -26,16 +61,37 @@ def event_handler(event, _context):
         logical_resource_id=event["ExecutionInput"]["LogicalResourceId"],
     )
 
-    # Successful Lambda executions will look like this:
+    # CloudFormation waits for an hour when it gets no response, so report any
+    # error, eg. of DynamoDB, as a failure
+    try:
+        return report_results(event, cfn_props)
+    except Exception as exc:  # pylint: disable=broad-except
+        return error_response(
+            msg=f"Failed to report the test results: {exc!r}", cfn_props=cfn_props
+        )
+
+
+def report_results(event, cfn_props: CfnProperties) -> None:
+    """Check the test results and timings, and report them to CloudFormation."""
+    # Successful Lambda executions will look like this, a list of results per
+    # shard:
     # {
     #     "ExecutionInput": {
     #         ...
     #     },
     #     "IntegrationTestResults": [
-    #         {
-    #             "success": true,
-    #             "test_name": "s3_png_metadata"
-    #         }
+    #         [
+    #             {
+    #                 "pending": false,
+    #                 "success": true,
+    #                 "test_name": "s3_png_metadata",
+    #                 "acted_at": 1640995200.123,
+    #                 "act_duration_seconds": 0.213,
+    #                 "time_to_consistency_seconds": 1.234,
+    #                 "assert_duration_seconds": 0.087,
+    #                 "attempts": 2
+    #             }
+    #         ]
     #     ]
     # }
 
@@ -46,24 +102,150 @@ def event_handler(event, _context):
     #     "Cause": "..."
     # }
 
-    lambda_results = event["IntegrationTestResults"]
-    parallel_success = isinstance(lambda_results, list)
+    shard_results = event["IntegrationTestResults"]
+    shards_success = isinstance(shard_results, list)
 
-    if not parallel_success:
-        return error_response(
-            msg="Execution error in parallel state", cfn_props=cfn_props
-        )
+    if not shards_success:
+        return error_response(msg="Execution error in test shards", cfn_props=cfn_props)
+    lambda_results = [result for results in shard_results for result in results]
     errors = []
     for result in lambda_results:
         if not result["success"]:
             errors.append(result["test_name"])
 
+    passed = [result for result in lambda_results if result["success"]]
+    slowest = slowest_tests_summary(passed)
+
+    violations = []
+    within_gate = []
+    for result in passed:
+        history = [] if accept_timings else load_timing_history(result["test_name"])
+        test_violations = check_timings(result, history)
+        violations += test_violations
+        if not test_violations:
+            within_gate.append(result)
+
+    # Every test is judged on its own history, so the timings of the tests
+    # which passed the gate are stored even when other tests failed
+    store_timings(within_gate)
+
+    print(json.dumps({"failed_tests": errors, "latency_violations": violations}))
     if errors:
         return error_response(
-            msg=f"Tests failed: [{', '.join(errors)}]", cfn_props=cfn_props
+            msg=f"Tests failed: [{summarize(errors, ', ')}]. {slowest}",
+            cfn_props=cfn_props,
         )
+    if violations:
+        return error_response(
+            msg=f"Latency gate failed: [{summarize(violations, '; ')}]. {slowest}",
+            cfn_props=cfn_props,
+        )
+    return success_response(cfn_props=cfn_props, reason=slowest)
+
+
+def check_timings(result, history):
+    """Return the timings of a test result which exceed its budget or regressed."""
+    test_name = result["test_name"]
+    violations = []
+    for timing in TIMINGS:
+        seconds = result.get(timing)
+        if seconds is None:
+            continue
+
+        budget = latency_budgets.get(test_name, {}).get(timing)
+        if budget is not None and seconds > budget:
+            violations.append(
+                f"{test_name} {timing} {seconds:.1f}s exceeds budget {budget:.1f}s"
+            )
+
+        past = [run[timing] for run in history if timing in run]
+        if len(past) < MIN_HISTORY_RUNS:
+            continue
+        median = statistics.median(past)
+        if (
+            seconds > median * (1 + regression_tolerance)
+            and seconds - median >= MIN_REGRESSION_SECONDS
+        ):
+            violations.append(
+                f"{test_name} {timing} {seconds:.1f}s regressed from median "
+                f"{median:.1f}s of {len(past)} runs"
+            )
+    return violations
+
+
+def load_timing_history(test_name):
+    """Return the timings of the latest passing runs of a test, newest first."""
+    response = dynamodb_client.query(
+        TableName=timing_history_table,
+        KeyConditionExpression="PK = :test_name",
+        ExpressionAttributeValues={":test_name": {"S": test_name}},
+        ScanIndexForward=False,
+        Limit=regression_history_runs,
+    )
+    return [
+        {timing: float(item[timing]["N"]) for timing in TIMINGS if timing in item}
+        for item in response["Items"]
+    ]
+
+
+def store_timings(results):
+    """
+    Store the timings of passing test results as the latest run.
+
+    The timings only feed the next regression checks, so errors are logged
+    instead of failing a run whose tests passed.
+    """
+    run_at = datetime.now(timezone.utc).isoformat()
+    for result in results:
+        item = {
+            "PK": {"S": result["test_name"]},
+            "SK": {"S": run_at},
+            "expires_at": {"N": str(int(time.time()) + HISTORY_TTL_SECONDS)},
+        }
+        for timing in TIMINGS:
+            if timing in result:
+                item[timing] = {"N": str(result[timing])}
+        try:
+            dynamodb_client.put_item(TableName=timing_history_table, Item=item)
+        except (BotoCoreError, ClientError) as exc:
+            print(f"Failed to store the timings of {result['test_name']}: {exc!r}")
+
+
+def slowest_tests_summary(results):
+    """Return a summary of the slowest passing tests, by total duration."""
+    durations = sorted(
+        (
+            (sum(result.get(timing, 0) for timing in TIMINGS), result)
+            for result in results
+        ),
+        key=lambda pair: pair[0],
+        reverse=True,
+    )
+    if not durations:
+        return "No passing tests"
+    slowest = [
+        f"{result['test_name']} {total:.1f}s "
+        f"(act {result.get('act_duration_seconds', 0):.1f}s, "
+        f"consistency {result.get('time_to_consistency_seconds', 0):.1f}s, "
+        f"assert {result.get('assert_duration_seconds', 0):.1f}s)"
+        for total, result in durations[:SLOWEST_TESTS_IN_REASON]
+    ]
+    return f"Slowest: {', '.join(slowest)}"
+
+
+def summarize(items, separator):
+    """Join the first items of a list, and count the others."""
+    summary = separator.join(items[:MAX_ITEMS_IN_REASON])
+    if len(items) > MAX_ITEMS_IN_REASON:
+        summary += f" and {len(items) - MAX_ITEMS_IN_REASON} more"
+    return summary
+
 
-    return success_response(cfn_props=cfn_props)
+def truncate(reason: str) -> str:
+    """Shorten a reason to fit in a CloudFormation response."""
+    if len(reason) <= MAX_REASON_LENGTH:
+        return reason
+    return reason[: MAX_REASON_LENGTH - 3] + "..."
 
 
 def error_response(msg: str, cfn_props: CfnProperties) -> None:
@@ -72,7 +254,7 @@ def error_response(msg: str, cfn_props: CfnProperties) -> None:
     call_cloudformation(
         {
             "Status": "FAILED",
-            "Reason": msg,
+            "Reason": truncate(msg),
             "PhysicalResourceId": cfn_props.logical_resource_id,
             "StackId": cfn_props.cfn_stack_id,
             "RequestId": cfn_props.cfn_request_id,
@@ -82,12 +264,13 @@ def error_response(msg: str, cfn_props: CfnProperties) -> None:
     )
 
 
-def success_response(cfn_props: CfnProperties) -> None:
+def success_response(cfn_props: CfnProperties, reason: str) -> None:
     """Report success to CloudFormation."""
-    print("Reporting success")
+    print(f"Reporting success: {reason}")
     call_cloudformation(
         {
             "Status": "SUCCESS",
+            "Reason": truncate(reason),
             "PhysicalResourceId": cfn_props.logical_resource_id,
             "StackId": cfn_props.cfn_stack_id,
             "RequestId": cfn_props.cfn_request_id,
@@ -0,0 +1,85 @@
+"""
+CloudWatch metrics in the Embedded Metric Format (EMF).
+
+Metrics are collected in memory during an invocation and printed as EMF
+documents by flush(), which should be called once at the end of every
+invocation. CloudWatch extracts the metrics from the function's log output, no
+API calls are needed.
+
+Usage:
+    metrics = MetricsLogger()
+    metrics.put_metric("BatchSize", len(records))
+    metrics.put_metric("Lag", 1200, unit="Milliseconds", event_type="UserCreated")
+    metrics.flush()
+
+Metrics with an event_type are published per function and event type, and
+aggregated per function. Other metrics are only published per function.
+"""
+
+# Standard library imports
+import json
+import os
+import threading
+import time
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ServerlessIntegrationTesting")
+# CloudWatch accepts at most 100 values per metric in a single EMF document
+MAX_VALUES_PER_METRIC = 100
+
+
+class MetricsLogger:
+    """Collect metrics during an invocation and print them as EMF documents."""
+
+    def __init__(self, namespace=NAMESPACE, function_name=None):
+        """Create a new MetricsLogger."""
+        self.namespace = namespace
+        self.function_name = function_name or os.environ.get(
+            "AWS_LAMBDA_FUNCTION_NAME", "local"
+        )
+        self.lock = threading.Lock()
+        # Metric name -> unit and values, per event type (None for function level)
+        self.metrics = {}
+
+    def put_metric(self, name, value, unit="Count", event_type=None):
+        """Add a value to a metric."""
+        with self.lock:
+            metrics = self.metrics.setdefault(event_type, {})
+            metric = metrics.setdefault(name, {"unit": unit, "values": []})
+            metric["values"].append(value)
+
+    def flush(self):
+        """Print the collected metrics as EMF documents and start over."""
+        with self.lock:
+            collected, self.metrics = self.metrics, {}
+
+        timestamp = int(time.time() * 1000)
+        for event_type, metrics in collected.items():
+            properties = {"FunctionName": self.function_name}
+            dimensions = [["FunctionName"]]
+            if event_type is not None:
+                properties["EventType"] = event_type
+                dimensions.append(["FunctionName", "EventType"])
+
+            longest = max(len(metric["values"]) for metric in metrics.values())
+            for start in range(0, longest, MAX_VALUES_PER_METRIC):
+                values = {
+                    name: metric["values"][start : start + MAX_VALUES_PER_METRIC]
+                    for name, metric in metrics.items()
+                    if len(metric["values"]) > start
+                }
+                document = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": self.namespace,
+                                "Dimensions": dimensions,
+                                "Metrics": [
+                                    {"Name": name, "Unit": metrics[name]["unit"]}
+                                    for name in values
+                                ],
+                            }
+                        ],
+                    },
+                }
+                print(json.dumps(document | properties | values))
@@ -2,21 +2,72 @@
 
 # Standard library imports
 import json
+from dataclasses import asdict, dataclass
+from typing import List
 
 # Third party imports
 from aws_cdk import (
     core as cdk,
     aws_dynamodb as dynamodb,
+    aws_iam as iam,
+    aws_kinesisfirehose as firehose,
     aws_logs as logs,
     aws_lambda as lambda_,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_s3 as s3,
+    aws_sqs as sqs,
 )
 
 # Local application/library specific imports
+from serverless_integration_testing_with_step_functions.constructs.instrumentation import (
+    METRICS_NAMESPACE,
+    create_alarms,
+    instrumentation_layer,
+)
 from serverless_integration_testing_with_step_functions.constructs.lambda_function import (
     LambdaFunction,
 )
 
 
+# How the stream processor builds the audit message for every event name
+MESSAGE_HANDLERS = {
+    "INSERT": "new_image",
+    "MODIFY": "changes",
+    "REMOVE": "keys",
+}
+
+
+@dataclass
+class AuditRoute:
+    """
+    Route stream events of one entity type and event name to an audit event type.
+
+    The handler determines the audit message: "new_image" logs the full new item,
+    "changes" only the changed attributes and "keys" only the item keys. It
+    defaults to the natural handler of the event name.
+    """
+
+    key_prefix: str
+    event_name: str
+    event_type: str
+    handler: str = None
+
+    def __post_init__(self):
+        """Validate the route and fill in the default handler."""
+        if self.event_name not in MESSAGE_HANDLERS:
+            raise ValueError(f"Unsupported event_name: {self.event_name}")
+        self.handler = self.handler or MESSAGE_HANDLERS[self.event_name]
+        if self.handler not in MESSAGE_HANDLERS.values():
+            raise ValueError(f"Unsupported handler: {self.handler}")
+
+
+DEFAULT_AUDIT_ROUTES = [
+    AuditRoute(key_prefix="USER#", event_name="INSERT", event_type="UserCreated"),
+    AuditRoute(key_prefix="USER#", event_name="MODIFY", event_type="UserUpdated"),
+    AuditRoute(key_prefix="USER#", event_name="REMOVE", event_type="UserDeleted"),
+]
+
+
 class DynamoDbStreams(cdk.Construct):
     """CDK Construct for the DDB Audit Log demo."""
 
@@ -24,11 +75,73 @@ class DynamoDbStreams(cdk.Construct):
         self,
         scope: cdk.Construct,
         construct_id: str,
+        batch_size: int = 1,
+        max_batching_window: cdk.Duration = cdk.Duration.seconds(1),
+        parallelization_factor: int = 1,
+        retry_attempts: int = 3,
+        max_record_age: cdk.Duration = cdk.Duration.hours(1),
+        audit_encoding: str = "dynamodb",
+        audit_sink: str = "cloudwatch",
+        audit_ledger_table: bool = False,
+        audit_routes: List[AuditRoute] = None,
+        lag_alarm_threshold: cdk.Duration = None,
+        error_rate_alarm_threshold: float = None,
         **kwargs,
     ) -> None:
-        """Construct a new S3EventNotification."""
+        """Construct a new DynamoDbStreams.
+
+        The audit_routes map the PK prefix and event name of stream events to
+        an audit event type. By default creating, updating and deleting users is
+        audited as UserCreated, UserUpdated (with only the changed attributes)
+        and UserDeleted events. A single stream processor serves all routes.
+
+        The stream processor receives up to batch_size records (at most 10,000)
+        per invocation, waiting at most max_batching_window to fill a batch. Every
+        invocation logs its record count, sink API calls and throughput.
+
+        The parallelization_factor (1 to 10) sets how many batches of one stream
+        shard are processed concurrently. Every concurrent batch writes to the
+        audit log stream of its own execution environment.
+
+        Failed records are reported as partial batch failures, so only the
+        records from the first failure onwards are retried. Failing batches are
+        split in half on every retry. Records which still fail after
+        retry_attempts, or are older than max_record_age, are sent to a DLQ.
+
+        The audit_encoding determines the format of the audit messages:
+        "dynamodb" logs the stream image with its DynamoDB type wrappers, "plain"
+        converts it to compact plain JSON.
+
+        The audit_sink determines where the audit log is written: "cloudwatch"
+        writes to a Log Group, "firehose" writes to a Kinesis Data Firehose
+        delivery stream, which stores gzipped newline delimited JSON in an S3
+        bucket, partitioned by date. Firehose buffers records for up to a minute.
+
+        Retried batches are deduplicated on the stream event ID with an in-memory
+        cache per container. With audit_ledger_table enabled, the written event
+        IDs are also recorded in a DynamoDB table shared by all containers.
+
+        The stream processor publishes embedded metrics per event type: record
+        counts, errors, sink latency and the lag between a change and its audit
+        log. With lag_alarm_threshold set, an alarm fires when the lag stays above
+        it for three minutes. With error_rate_alarm_threshold set, an alarm fires
+        when more than that percentage of the records fails for three minutes.
+        """
         super().__init__(scope, construct_id, **kwargs)
 
+        if audit_encoding not in ("dynamodb", "plain"):
+            raise ValueError(f"Unsupported audit_encoding: {audit_encoding}")
+        if audit_sink not in ("cloudwatch", "firehose"):
+            raise ValueError(f"Unsupported audit_sink: {audit_sink}")
+        self.audit_encoding = audit_encoding
+        self.audit_sink = audit_sink
+        self.audit_log_group = None
+        self.audit_bucket = None
+        self.audit_ledger_table = None
+        self.audit_routes = audit_routes or DEFAULT_AUDIT_ROUTES
+        self.max_batching_window = max_batching_window
+        self.alarms = []
+
         # Create the DynamoDB Table
         self.table = dynamodb.Table(
             scope=self,
@@ -40,15 +153,7 @@ class DynamoDbStreams(cdk.Construct):
             point_in_time_recovery=True,
             sort_key=dynamodb.Attribute(name="SK", type=dynamodb.AttributeType.STRING),
             removal_policy=cdk.RemovalPolicy.DESTROY,
-            stream=dynamodb.StreamViewType.NEW_IMAGE,
-        )
-
-        # Create the Audit Log Group
-        self.audit_log_group = logs.LogGroup(
-            scope=self,
-            id="AuditLogGroup",
-            retention=logs.RetentionDays.ONE_MONTH,
-            removal_policy=cdk.RemovalPolicy.DESTROY,
+            stream=dynamodb.StreamViewType.NEW_AND_OLD_IMAGES,
         )
 
         # Create a Lambda Function to process changes in DDB
@@ -56,28 +161,93 @@ class DynamoDbStreams(cdk.Construct):
             scope=self,
             construct_id="StreamProcessor",
             code=lambda_.Code.from_asset("lambda_functions/ddb_stream_processor"),
-            environment={"AUDIT_LOG_GROUP_NAME": self.audit_log_group.log_group_name},
+            environment={
+                "AUDIT_ENCODING": audit_encoding,
+                "AUDIT_SINK": audit_sink,
+                "AUDIT_ROUTES": json.dumps(
+                    [asdict(route) for route in self.audit_routes]
+                ),
+                "METRICS_NAMESPACE": METRICS_NAMESPACE,
+            },
+            timeout=cdk.Duration.seconds(30),
+            layers=[instrumentation_layer(self)],
+        )
+        self.alarms = create_alarms(
+            scope=self,
+            function=stream_processor.function,
+            lag_alarm_threshold=lag_alarm_threshold,
+            error_rate_alarm_threshold=error_rate_alarm_threshold,
         )
 
-        # Allow function to write to the Log Group
-        self.audit_log_group.grant_write(stream_processor.function)
+        if audit_sink == "firehose":
+            self._create_firehose_sink(stream_processor=stream_processor)
+        else:
+            # Create the Audit Log Group
+            self.audit_log_group = logs.LogGroup(
+                scope=self,
+                id="AuditLogGroup",
+                retention=logs.RetentionDays.ONE_MONTH,
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+            )
+
+            # Allow function to write to the Log Group
+            self.audit_log_group.grant_write(stream_processor.function)
+            stream_processor.function.add_environment(
+                "AUDIT_LOG_GROUP_NAME", self.audit_log_group.log_group_name
+            )
+
+        if audit_ledger_table:
+            # Stream records expire after a day, so their event IDs can too
+            self.audit_ledger_table = dynamodb.Table(
+                scope=self,
+                id="AuditLedgerTable",
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                partition_key=dynamodb.Attribute(
+                    name="PK", type=dynamodb.AttributeType.STRING
+                ),
+                time_to_live_attribute="expires_at",
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+            )
+            self.audit_ledger_table.grant_read_write_data(stream_processor.function)
+            stream_processor.function.add_environment(
+                "AUDIT_LEDGER_TABLE", self.audit_ledger_table.table_name
+            )
 
         # Allow function to read the DDB Stream
         self.table.grant_stream_read(stream_processor.function)
 
+        # Records which can't be written end up here
+        self.dead_letter_queue = sqs.Queue(
+            scope=self,
+            id="StreamDeadLetterQueue",
+            retention_period=cdk.Duration.days(14),
+        )
+
         # Stream changes in the DynamoDB Table to a Lambda Event Source Mapping
         event_source_mapping = lambda_.EventSourceMapping(
             scope=self,
             id="DdbLambdaEventSourceMapping",
             target=stream_processor.function,
             event_source_arn=self.table.table_stream_arn,
-            max_batching_window=cdk.Duration.seconds(1),
+            max_batching_window=max_batching_window,
             starting_position=lambda_.StartingPosition.TRIM_HORIZON,
-            batch_size=1,
+            batch_size=batch_size,
+            parallelization_factor=parallelization_factor,
+            report_batch_item_failures=True,
+            bisect_batch_on_error=True,
+            retry_attempts=retry_attempts,
+            max_record_age=max_record_age,
+            on_failure=lambda_event_sources.SqsDlq(queue=self.dead_letter_queue),
         )
 
-        # Use a CDK escape hatch to configure FilterCriteria so we
-        # only receive user creation events.
+        # Use a CDK escape hatch to configure FilterCriteria so we only receive
+        # the routed events, with one filter per event name
+        key_prefixes = {}
+        for route in self.audit_routes:
+            key_prefixes.setdefault(route.event_name, [])
+            if route.key_prefix not in key_prefixes[route.event_name]:
+                key_prefixes[route.event_name].append(route.key_prefix)
+
         cfn_event_source_mapping: lambda_.CfnEventSourceMapping = (
             event_source_mapping.node.default_child
         )
@@ -88,13 +258,63 @@ class DynamoDbStreams(cdk.Construct):
                     {
                         "Pattern": json.dumps(
                             {
-                                "eventName": ["INSERT"],
+                                "eventName": [event_name],
                                 "dynamodb": {
-                                    "NewImage": {"PK": {"S": [{"prefix": "USER#"}]}}
+                                    "Keys": {
+                                        "PK": {
+                                            "S": [
+                                                {"prefix": prefix}
+                                                for prefix in prefixes
+                                            ]
+                                        }
+                                    }
                                 },
                             }
                         )
-                    },
+                    }
+                    for event_name, prefixes in key_prefixes.items()
                 ],
             },
         )
+
+    def _create_firehose_sink(self, stream_processor: LambdaFunction) -> None:
+        """Create the delivery stream which stores the audit log in S3."""
+        self.audit_bucket = s3.Bucket(
+            scope=self, id="AuditBucket", removal_policy=cdk.RemovalPolicy.DESTROY
+        )
+
+        delivery_role = iam.Role(
+            scope=self,
+            id="AuditDeliveryRole",
+            assumed_by=iam.ServicePrincipal("firehose.amazonaws.com"),
+        )
+        self.audit_bucket.grant_read_write(delivery_role)
+
+        # Deliver gzipped NDJSON in a prefix per day, after at most a minute or 64 MB
+        delivery_stream = firehose.CfnDeliveryStream(
+            scope=self,
+            id="AuditDeliveryStream",
+            delivery_stream_type="DirectPut",
+            extended_s3_destination_configuration=firehose.CfnDeliveryStream.ExtendedS3DestinationConfigurationProperty(
+                bucket_arn=self.audit_bucket.bucket_arn,
+                role_arn=delivery_role.role_arn,
+                prefix="audit/!{timestamp:yyyy/MM/dd}/",
+                error_output_prefix="errors/!{firehose:error-output-type}/!{timestamp:yyyy/MM/dd}/",
+                compression_format="GZIP",
+                buffering_hints=firehose.CfnDeliveryStream.BufferingHintsProperty(
+                    interval_in_seconds=60, size_in_m_bs=64
+                ),
+            ),
+        )
+        delivery_stream.node.add_dependency(delivery_role)
+
+        # Allow function to write to the delivery stream
+        stream_processor.function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["firehose:PutRecordBatch"],
+                resources=[delivery_stream.attr_arn],
+            )
+        )
+        stream_processor.function.add_environment(
+            "AUDIT_DELIVERY_STREAM_NAME", delivery_stream.ref
+        )
@@ -0,0 +1,98 @@
+"""Module for the shared instrumentation of the Lambda Functions."""
+
+# Third party imports
+from aws_cdk import (
+    core as cdk,
+    aws_cloudwatch as cloudwatch,
+    aws_lambda as lambda_,
+)
+
+# The namespace of the embedded metrics, see lambda_layers/instrumentation
+METRICS_NAMESPACE = "ServerlessIntegrationTesting"
+
+
+def instrumentation_layer(scope: cdk.Construct) -> lambda_.LayerVersion:
+    """Return the instrumentation layer of the stack, creating it if needed."""
+    stack = cdk.Stack.of(scope)
+    layer = stack.node.try_find_child("InstrumentationLayer")
+    if layer is None:
+        layer = lambda_.LayerVersion(
+            scope=stack,
+            id="InstrumentationLayer",
+            code=lambda_.Code.from_asset("lambda_layers/instrumentation"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+            description="Embedded metric format metrics",
+        )
+    return layer
+
+
+def create_alarms(
+    scope: cdk.Construct,
+    function: lambda_.IFunction,
+    lag_alarm_threshold: cdk.Duration = None,
+    error_rate_alarm_threshold: float = None,
+) -> list:
+    """
+    Create the optional alarms on the embedded metrics of a function.
+
+    The lag alarm fires when events wait longer than lag_alarm_threshold between
+    being emitted and being processed. The error rate alarm fires when more than
+    error_rate_alarm_threshold percent of the records in a minute fail.
+    """
+    alarms = []
+    dimensions_map = {"FunctionName": function.function_name}
+
+    if lag_alarm_threshold is not None:
+        lag = cloudwatch.Metric(
+            namespace=METRICS_NAMESPACE,
+            metric_name="Lag",
+            dimensions_map=dimensions_map,
+            statistic="Maximum",
+            period=cdk.Duration.minutes(1),
+        )
+        alarms.append(
+            lag.create_alarm(
+                scope=scope,
+                id="LagAlarm",
+                threshold=lag_alarm_threshold.to_milliseconds(),
+                evaluation_periods=3,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+            )
+        )
+
+    if error_rate_alarm_threshold is not None:
+        if not 0 < error_rate_alarm_threshold <= 100:
+            raise ValueError(
+                f"Unsupported error_rate_alarm_threshold: {error_rate_alarm_threshold}"
+            )
+        error_rate = cloudwatch.MathExpression(
+            expression="100 * errors / records",
+            using_metrics={
+                metric_id: cloudwatch.Metric(
+                    namespace=METRICS_NAMESPACE,
+                    metric_name=metric_name,
+                    dimensions_map=dimensions_map,
+                    statistic="Sum",
+                    period=cdk.Duration.minutes(1),
+                )
+                for metric_id, metric_name in (
+                    ("errors", "Errors"),
+                    ("records", "BatchSize"),
+                )
+            },
+            label="Error rate (%)",
+            period=cdk.Duration.minutes(1),
+        )
+        alarms.append(
+            error_rate.create_alarm(
+                scope=scope,
+                id="ErrorRateAlarm",
+                threshold=error_rate_alarm_threshold,
+                evaluation_periods=3,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+            )
+        )
+
+    return alarms
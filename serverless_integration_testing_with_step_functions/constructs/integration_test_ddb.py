@@ -4,11 +4,16 @@
 from aws_cdk import (
     core as cdk,
     aws_lambda as lambda_,
-    aws_stepfunctions as sfn,
-    aws_stepfunctions_tasks as sfn_tasks,
 )
 
 # Local application/library specific imports
+from serverless_integration_testing_with_step_functions.constructs.integration_test_registry import (
+    IntegrationTestRegistry,
+    RegisteredTest,
+)
+from serverless_integration_testing_with_step_functions.constructs.latency_budget import (
+    LatencyBudget,
+)
 from serverless_integration_testing_with_step_functions.constructs.lambda_function import (
     LambdaFunction,
 )
@@ -18,6 +23,15 @@ from serverless_integration_testing_with_step_functions.constructs.dynamo_db_str
 )
 
 
+# The scenarios of the audit log test with their test names, each scenario is a
+# test of its own
+SCENARIOS = {
+    "create": "ddb_user_audit_log",
+    "update": "ddb_user_update_audit_log",
+    "delete": "ddb_user_delete_audit_log",
+}
+
+
 class IntegrationTestDdb(cdk.Construct):
     """CDK Construct for the DynamoDB integration test."""
 
@@ -26,9 +40,10 @@ class IntegrationTestDdb(cdk.Construct):
         scope: cdk.Construct,
         construct_id: str,
         dynamo_db_streams: DynamoDbStreams,
+        registry: IntegrationTestRegistry,
         **kwargs,
     ) -> None:
-        """Construct a new IntegrationTestS3."""
+        """Construct a new IntegrationTestDdb, which registers a test per scenario."""
         super().__init__(scope, construct_id, **kwargs)
 
         # Create a Lambda Function to upload an image to the bucket
@@ -51,40 +66,60 @@ class IntegrationTestDdb(cdk.Construct):
             ),
             environment={
                 "DDB_TABLE": dynamo_db_streams.table.table_name,
-                "LOG_STREAM_NAME": dynamo_db_streams.audit_log_group.log_group_name,
+                "AUDIT_ENCODING": dynamo_db_streams.audit_encoding,
+                "AUDIT_SINK": dynamo_db_streams.audit_sink,
             },
+            # Searching a busy audit log can take many pages
+            timeout=cdk.Duration.seconds(30),
         )
         dynamo_db_streams.table.grant_read_write_data(
             assert_cleanup_ddb_audit_log.function
         )
-        dynamo_db_streams.audit_log_group.grant(
-            assert_cleanup_ddb_audit_log.function, "logs:FilterLogEvents"
-        )
 
-        # The State Machine step to execute Arrange & Act
-        arrange_step = sfn_tasks.LambdaInvoke(
-            scope=self,
-            id="DDB - Arrange & Act",
-            lambda_function=arrange_act_ddb_audit_log.function,
-        )
+        # Allow the assert function to read the audit log from the deployed sink
+        if dynamo_db_streams.audit_bucket:
+            dynamo_db_streams.audit_bucket.grant_read(
+                assert_cleanup_ddb_audit_log.function
+            )
+            assert_cleanup_ddb_audit_log.function.add_environment(
+                "AUDIT_BUCKET", dynamo_db_streams.audit_bucket.bucket_name
+            )
+        else:
+            dynamo_db_streams.audit_log_group.grant(
+                assert_cleanup_ddb_audit_log.function, "logs:FilterLogEvents"
+            )
+            assert_cleanup_ddb_audit_log.function.add_environment(
+                "LOG_STREAM_NAME", dynamo_db_streams.audit_log_group.log_group_name
+            )
 
-        # Wait ten seconds for the audit log to be written
-        sleep_step = sfn.Wait(
-            scope=self,
-            id="Wait ten seconds",
-            time=sfn.WaitTime.duration(cdk.Duration.seconds(10)),
+        # Give up when the audit log isn't written within a minute, allowing for
+        # the time stream records spend waiting for a batch to fill. Firehose
+        # buffers the audit log for up to a minute before writing to S3.
+        deadline_seconds = 60 + dynamo_db_streams.max_batching_window.to_seconds()
+        if dynamo_db_streams.audit_sink == "firehose":
+            deadline_seconds += 120
+        assert_cleanup_ddb_audit_log.function.add_environment(
+            "POLL_DEADLINE_SECONDS", str(deadline_seconds)
         )
 
-        # The State Machine step to execute Assert & Clean Up
-        assert_step = sfn_tasks.LambdaInvoke(
-            scope=self,
-            id="DDB - Assert & Clean Up",
-            lambda_function=assert_cleanup_ddb_audit_log.function,
-            payload=sfn.TaskInput.from_object(
-                {
-                    "arrange_act_payload": sfn.JsonPath.string_at("$.Payload"),
-                }
-            ),
-        )
+        self.arrange_act_function = arrange_act_ddb_audit_log.function
+        self.assert_cleanup_function = assert_cleanup_ddb_audit_log.function
 
-        self.steps = arrange_step.next(sleep_step).next(assert_step)
+        # Every scenario is a test of Arrange & Act, then Assert until the audit
+        # log is written, which is usually well before the deadline
+        for scenario, test_name in SCENARIOS.items():
+            registry.register(
+                RegisteredTest(
+                    test_name=test_name,
+                    arrange_act_function=self.arrange_act_function,
+                    assert_cleanup_function=self.assert_cleanup_function,
+                    arrange_act_input={"scenario": scenario},
+                    assert_input={"scenario": scenario},
+                    tags=["ddb", f"ddb_{scenario}"],
+                    latency_budget=LatencyBudget(
+                        act_duration_seconds=5,
+                        time_to_consistency_seconds=deadline_seconds / 2,
+                        assert_duration_seconds=10,
+                    ),
+                )
+            )
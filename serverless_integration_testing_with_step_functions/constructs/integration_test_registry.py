@@ -0,0 +1,69 @@
+"""Module for the registry of the integration tests."""
+
+# Standard library imports
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+# Third party imports
+from aws_cdk import aws_lambda as lambda_
+
+# Local application/library specific imports
+from serverless_integration_testing_with_step_functions.constructs.latency_budget import (
+    LatencyBudget,
+)
+
+
+@dataclass
+class RegisteredTest:
+    """
+    An integration test as the State Machine runs it.
+
+    The Arrange & Act function is invoked with the arrange_act_input. The
+    Assert & Clean Up function is invoked with the assert_input plus the
+    arrange_act_payload, the attempt and clean_up, and again with its own
+    output for as long as it returns pending.
+    """
+
+    test_name: str
+    arrange_act_function: lambda_.IFunction
+    assert_cleanup_function: lambda_.IFunction
+    arrange_act_input: dict = field(default_factory=dict)
+    assert_input: dict = field(default_factory=dict)
+    tags: List[str] = field(default_factory=list)
+    latency_budget: LatencyBudget = None
+
+    def state_input(self, clean_up: bool = True) -> dict:
+        """
+        Return the input of the test in the State Machine.
+
+        Without clean_up, the test leaves its data and returns its keys instead.
+        """
+        return {
+            "test_name": self.test_name,
+            "arrange_act_function": self.arrange_act_function.function_arn,
+            "arrange_act_input": self.arrange_act_input,
+            "assert_cleanup_function": self.assert_cleanup_function.function_arn,
+            "assert_input": self.assert_input | {"attempt": 0, "clean_up": clean_up},
+        }
+
+
+class IntegrationTestRegistry:
+    """The integration tests which the test constructs declare, by test name."""
+
+    def __init__(self) -> None:
+        """Construct a new, empty IntegrationTestRegistry."""
+        self.tests: Dict[str, RegisteredTest] = {}
+
+    def register(self, test: RegisteredTest) -> None:
+        """Add a test, every test needs a test name of its own."""
+        if test.test_name in self.tests:
+            raise ValueError(f"Duplicate test_name: {test.test_name}")
+        self.tests[test.test_name] = test
+
+    def select(self, tags: List[str] = None) -> List[RegisteredTest]:
+        """Return the tests with any of the tags, or every test without tags."""
+        if not tags:
+            return list(self.tests.values())
+        return [
+            test for test in self.tests.values() if set(test.tags).intersection(tags)
+        ]
@@ -4,11 +4,16 @@
 from aws_cdk import (
     core as cdk,
     aws_lambda as lambda_,
-    aws_stepfunctions as sfn,
-    aws_stepfunctions_tasks as sfn_tasks,
 )
 
 # Local application/library specific imports
+from serverless_integration_testing_with_step_functions.constructs.integration_test_registry import (
+    IntegrationTestRegistry,
+    RegisteredTest,
+)
+from serverless_integration_testing_with_step_functions.constructs.latency_budget import (
+    LatencyBudget,
+)
 from serverless_integration_testing_with_step_functions.constructs.lambda_function import (
     LambdaFunction,
 )
@@ -25,9 +30,10 @@ class IntegrationTestS3(cdk.Construct):
         scope: cdk.Construct,
         construct_id: str,
         s3_event_notification: S3EventNotification,
+        registry: IntegrationTestRegistry,
         **kwargs,
     ) -> None:
-        """Construct a new IntegrationTestS3."""
+        """Construct a new IntegrationTestS3, which registers its test."""
         super().__init__(scope, construct_id, **kwargs)
 
         # Create a Lambda Function to upload an image to the bucket
@@ -44,36 +50,46 @@ class IntegrationTestS3(cdk.Construct):
             scope=self,
             construct_id="AssertAndCleanUpS3UploadFunction",
             code=lambda_.Code.from_asset("integration_tests/assert_cleanup_s3_upload"),
-            environment={"S3_BUCKET": s3_event_notification.s3_bucket.bucket_name},
+            environment={
+                "S3_BUCKET": s3_event_notification.s3_bucket.bucket_name,
+                "STORAGE_MODE": s3_event_notification.storage_mode,
+            },
         )
         s3_event_notification.s3_bucket.grant_read_write(
             assert_cleanup_s3_upload.function
         )
+        if s3_event_notification.dimension_index_table:
+            s3_event_notification.dimension_index_table.grant_read_data(
+                assert_cleanup_s3_upload.function
+            )
+            assert_cleanup_s3_upload.function.add_environment(
+                "DIMENSION_INDEX_TABLE",
+                s3_event_notification.dimension_index_table.table_name,
+            )
 
-        # The State Machine step to execute Arrange & Act
-        arrange_step = sfn_tasks.LambdaInvoke(
-            scope=self,
-            id="S3 - Arrange & Act",
-            lambda_function=arrange_act_s3_upload.function,
+        # Give up when the dimensions aren't written within 30 seconds, plus the
+        # time the notification may spend in the SQS buffer waiting for a batch
+        deadline_seconds = 30
+        if s3_event_notification.max_batching_window:
+            deadline_seconds += s3_event_notification.max_batching_window.to_seconds()
+        assert_cleanup_s3_upload.function.add_environment(
+            "POLL_DEADLINE_SECONDS", str(deadline_seconds)
         )
 
-        # Wait two seconds for the metadata to be written
-        sleep_step = sfn.Wait(
-            scope=self,
-            id="Wait two seconds",
-            time=sfn.WaitTime.duration(cdk.Duration.seconds(2)),
-        )
+        self.arrange_act_function = arrange_act_s3_upload.function
+        self.assert_cleanup_function = assert_cleanup_s3_upload.function
 
-        # The State Machine step to execute Assert & Clean Up
-        assert_step = sfn_tasks.LambdaInvoke(
-            scope=self,
-            id="S3 - Assert & Clean Up",
-            lambda_function=assert_cleanup_s3_upload.function,
-            payload=sfn.TaskInput.from_object(
-                {
-                    "arrange_act_payload": sfn.JsonPath.string_at("$.Payload"),
-                }
-            ),
+        # The dimensions are usually written within seconds
+        registry.register(
+            RegisteredTest(
+                test_name="s3_png_metadata",
+                arrange_act_function=self.arrange_act_function,
+                assert_cleanup_function=self.assert_cleanup_function,
+                tags=["s3"],
+                latency_budget=LatencyBudget(
+                    act_duration_seconds=5,
+                    time_to_consistency_seconds=deadline_seconds / 2,
+                    assert_duration_seconds=5,
+                ),
+            )
         )
-
-        self.steps = arrange_step.next(sleep_step).next(assert_step)
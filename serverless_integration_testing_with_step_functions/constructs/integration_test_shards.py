@@ -0,0 +1,234 @@
+"""Module for the sharded integration test run CDK construct."""
+
+# Standard library imports
+import math
+from typing import List
+
+# Third party imports
+from aws_cdk import (
+    core as cdk,
+    aws_iam as iam,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as sfn_tasks,
+)
+
+# Local application/library specific imports
+from serverless_integration_testing_with_step_functions.constructs.integration_test_registry import (
+    RegisteredTest,
+)
+
+# Step Functions runs at most 40 iterations of an inline Map concurrently
+MAX_CONCURRENCY = 40
+# The longest a single test may take, including all of its Assert attempts
+TEST_TIMEOUT_MINUTES = 5
+# The first Assert & Clean Up input, merged from the test and Arrange & Act
+ASSERT_INPUT = "States.JsonMerge($.assert_input, $.arrange_act, false)"
+# The same retries LambdaInvoke adds for transient Lambda service errors
+LAMBDA_SERVICE_RETRY = {
+    "ErrorEquals": [
+        "Lambda.ServiceException",
+        "Lambda.AWSLambdaException",
+        "Lambda.SdkClientException",
+    ],
+    "IntervalSeconds": 2,
+    "MaxAttempts": 6,
+    "BackoffRate": 2,
+}
+
+
+class IntegrationTestShards(cdk.Construct):
+    """CDK Construct for the steps which run the tests in shards."""
+
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        tests: List[RegisteredTest],
+        shard_size: int = 25,
+        shard_concurrency: int = 4,
+        test_concurrency: int = 10,
+        **kwargs,
+    ) -> None:
+        """Construct a new IntegrationTestShards.
+
+        The tests are split into shards of at most shard_size tests. Every shard
+        is an execution of the shard State Machine, which runs at most
+        test_concurrency tests of the shard at a time. At most shard_concurrency
+        shards run at a time. The executions only pass shard indexes, the shard
+        State Machine looks up the inputs of its tests, so no execution input
+        grows beyond one shard. Every shard has an execution history of its own.
+
+        The steps output the results of every shard, as a list of lists.
+        """
+        super().__init__(scope, construct_id, **kwargs)
+
+        if not tests:
+            raise ValueError("No tests to run")
+        if shard_size < 1:
+            raise ValueError(f"Unsupported shard_size: {shard_size}")
+        if not 1 <= shard_concurrency <= MAX_CONCURRENCY:
+            raise ValueError(f"Unsupported shard_concurrency: {shard_concurrency}")
+        if not 1 <= test_concurrency <= MAX_CONCURRENCY:
+            raise ValueError(f"Unsupported test_concurrency: {test_concurrency}")
+
+        self.shards = [
+            tests[start : start + shard_size]
+            for start in range(0, len(tests), shard_size)
+        ]
+
+        # Every test runs its functions by ARN, so the same steps run any test
+        tests_step = sfn.Map(
+            scope=self,
+            id="Tests",
+            items_path="$.tests",
+            max_concurrency=test_concurrency,
+        )
+        tests_step.iterator(create_test_steps(self))
+
+        # The inputs of the tests are part of the definition, by shard index
+        load_tests_step = sfn.Choice(scope=self, id="Load shard")
+        for index, shard in enumerate(self.shards):
+            load_tests_step.when(
+                sfn.Condition.number_equals("$.shard", index),
+                sfn.Pass(
+                    scope=self,
+                    id=f"Shard {index}",
+                    result=sfn.Result.from_object(
+                        {"tests": [test.state_input() for test in shard]}
+                    ),
+                ).next(tests_step),
+            )
+        load_tests_step.otherwise(
+            sfn.Fail(scope=self, id="Unknown shard", error="UnknownShard")
+        )
+
+        # Run the largest shard in waves of test_concurrency tests
+        shard_timeout_minutes = TEST_TIMEOUT_MINUTES * math.ceil(
+            max(len(shard) for shard in self.shards) / test_concurrency
+        )
+        self.shard_state_machine = sfn.StateMachine(
+            self,
+            "ShardStateMachine",
+            definition=load_tests_step,
+            timeout=cdk.Duration.minutes(shard_timeout_minutes),
+        )
+        grant_invoke_tests(tests, self.shard_state_machine)
+
+        # The Map state iterates over the shard indexes
+        plan_step = sfn.Pass(
+            scope=self,
+            id="Plan shards",
+            result=sfn.Result.from_object({"shards": list(range(len(self.shards)))}),
+        )
+        run_shard_step = sfn_tasks.StepFunctionsStartExecution(
+            scope=self,
+            id="Run shard",
+            state_machine=self.shard_state_machine,
+            integration_pattern=sfn.IntegrationPattern.RUN_JOB,
+            associate_with_parent=True,
+            input=sfn.TaskInput.from_object(
+                {"shard": sfn.JsonPath.number_at("$.shard")}
+            ),
+            output_path="$.Output",
+        )
+        self.shards_step = sfn.Map(
+            scope=self,
+            id="Shards",
+            items_path="$.shards",
+            max_concurrency=shard_concurrency,
+            parameters={"shard": sfn.JsonPath.number_at("$$.Map.Item.Value")},
+        )
+        self.shards_step.iterator(run_shard_step)
+
+        self.steps = plan_step.next(self.shards_step)
+        self.timeout = cdk.Duration.minutes(
+            shard_timeout_minutes * math.ceil(len(self.shards) / shard_concurrency)
+        )
+
+
+def create_test_steps(scope: cdk.Construct) -> sfn.IChainable:
+    """
+    Create the steps which run any test, given its input.
+
+    The input is the state_input of a RegisteredTest. Arrange & Act runs once,
+    then Assert & Clean Up runs with its own output for as long as it returns
+    pending, waiting as long as it asks for. The steps output the result of the
+    last Assert & Clean Up.
+    """
+    lambda_invoke = f"arn:{cdk.Aws.PARTITION}:states:::lambda:invoke"
+
+    arrange_step = sfn.CustomState(
+        scope=scope,
+        id="Arrange & Act",
+        state_json={
+            "Type": "Task",
+            "Resource": lambda_invoke,
+            "Parameters": {
+                "FunctionName.$": "$.arrange_act_function",
+                "Payload.$": "$.arrange_act_input",
+            },
+            "ResultSelector": {"arrange_act_payload.$": "$.Payload"},
+            "ResultPath": "$.arrange_act",
+            "Retry": [LAMBDA_SERVICE_RETRY],
+        },
+    )
+
+    # The first Assert & Clean Up input is the assert_input of the test,
+    # plus the arrange_act_payload. Later inputs are the previous output.
+    prepare_assert_step = sfn.Pass(
+        scope=scope,
+        id="Prepare Assert",
+        parameters={
+            "assert_cleanup_function": sfn.JsonPath.string_at(
+                "$.assert_cleanup_function"
+            ),
+            "assert_cleanup": {"Payload.$": ASSERT_INPUT},
+        },
+    )
+
+    assert_step = sfn.CustomState(
+        scope=scope,
+        id="Assert & Clean Up",
+        state_json={
+            "Type": "Task",
+            "Resource": lambda_invoke,
+            "Parameters": {
+                "FunctionName.$": "$.assert_cleanup_function",
+                "Payload.$": "$.assert_cleanup.Payload",
+            },
+            "ResultSelector": {"Payload.$": "$.Payload"},
+            "ResultPath": "$.assert_cleanup",
+            "Retry": [LAMBDA_SERVICE_RETRY],
+        },
+    )
+
+    wait_step = sfn.Wait(
+        scope=scope,
+        id="Wait for consistency",
+        time=sfn.WaitTime.seconds_path("$.assert_cleanup.Payload.wait_seconds"),
+    )
+    assert_pending = (
+        sfn.Choice(scope=scope, id="Assert pending?")
+        .when(
+            sfn.Condition.boolean_equals("$.assert_cleanup.Payload.pending", True),
+            wait_step.next(assert_step),
+        )
+        .otherwise(
+            sfn.Succeed(
+                scope=scope, id="Test done", output_path="$.assert_cleanup.Payload"
+            )
+        )
+    )
+
+    return arrange_step.next(prepare_assert_step).next(assert_step).next(assert_pending)
+
+
+def grant_invoke_tests(tests: List[RegisteredTest], grantee: iam.IGrantable) -> None:
+    """Allow a State Machine to invoke the functions of the tests."""
+    # Every function is granted once, even when it runs several tests
+    functions = {}
+    for test in tests:
+        for function in (test.arrange_act_function, test.assert_cleanup_function):
+            functions[function.node.path] = function
+    for function in functions.values():
+        function.grant_invoke(grantee)
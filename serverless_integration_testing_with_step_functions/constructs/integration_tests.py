@@ -1,11 +1,15 @@
 """Module for the Integration Test infrastructure."""
 
 # Standard library imports
+import json
 import time
+from dataclasses import asdict
+from typing import Dict, List
 
 # Third party imports
 from aws_cdk import (
     core as cdk,
+    aws_dynamodb as dynamodb,
     aws_lambda as lambda_,
     aws_stepfunctions as sfn,
     aws_stepfunctions_tasks as sfn_tasks,
@@ -21,11 +25,17 @@ from serverless_integration_testing_with_step_functions.constructs.s3_event_noti
 from serverless_integration_testing_with_step_functions.constructs.dynamo_db_streams import (
     DynamoDbStreams,
 )
-from serverless_integration_testing_with_step_functions.constructs.integration_test_s3 import (
-    IntegrationTestS3,
+from serverless_integration_testing_with_step_functions.constructs.integration_test_registry import (
+    IntegrationTestRegistry,
 )
-from serverless_integration_testing_with_step_functions.constructs.integration_test_ddb import (
-    IntegrationTestDdb,
+from serverless_integration_testing_with_step_functions.constructs.integration_test_shards import (
+    IntegrationTestShards,
+)
+from serverless_integration_testing_with_step_functions.constructs.latency_budget import (
+    LatencyBudget,
+)
+from serverless_integration_testing_with_step_functions.constructs.load_tests import (
+    LoadTests,
 )
 
 
@@ -38,17 +48,89 @@ class IntegrationTests(cdk.Construct):
         construct_id: str,
         s3_event_notification: S3EventNotification,
         dynamo_db_streams: DynamoDbStreams,
+        registry: IntegrationTestRegistry,
+        test_tags: List[str] = None,
+        shard_size: int = 25,
+        shard_concurrency: int = 4,
+        test_concurrency: int = 10,
+        load_test_iterations: int = None,
+        load_test_max_concurrency: int = 10,
+        latency_budgets: Dict[str, LatencyBudget] = None,
+        regression_tolerance: float = 0.5,
+        regression_history_runs: int = 10,
+        accept_timings: bool = False,
         **kwargs,
     ) -> None:
-        """Construct a new IntegrationTests."""
+        """Construct a new IntegrationTests.
+
+        The test constructs register their tests in the registry, this
+        construct doesn't know them. The tests with any of the test_tags, or
+        every test without test_tags, run in shards of at most shard_size tests.
+        At most shard_concurrency shards run at a time, and at most
+        test_concurrency tests per shard.
+
+        Every test reports how long it took to act, until its effect was
+        observed and to assert. The deployment fails when a timing exceeds the
+        latency budget of its test, or is more than regression_tolerance (0.5
+        is 50%) slower than the median of the latest regression_history_runs
+        passing runs. The latency_budgets override the default budget of a test
+        by test name. The timings of every test which passed the gate are stored
+        in a DynamoDB table. With accept_timings, eg. after an intentional
+        slowdown, the timings of the run only have to be within their budgets
+        and become the new baseline.
+
+        With load_test_iterations set, a separate State Machine runs every
+        selected test that many times, at most load_test_max_concurrency at a
+        time. It is not part of the tests which run on every deployment.
+        """
         super().__init__(scope, construct_id, **kwargs)
 
+        if regression_tolerance <= 0:
+            raise ValueError(
+                f"Unsupported regression_tolerance: {regression_tolerance}"
+            )
+        if regression_history_runs < 1:
+            raise ValueError(
+                f"Unsupported regression_history_runs: {regression_history_runs}"
+            )
+
+        tests = registry.select(tags=test_tags)
+        if not tests:
+            raise ValueError(f"No tests with any of the test_tags: {test_tags}")
+        budgets = {
+            test.test_name: test.latency_budget for test in tests if test.latency_budget
+        } | (latency_budgets or {})
+
+        # The timings of every passing test run, partitioned by test name
+        self.timing_history_table = dynamodb.Table(
+            scope=self,
+            id="TimingHistoryTable",
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            partition_key=dynamodb.Attribute(
+                name="PK", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(name="SK", type=dynamodb.AttributeType.STRING),
+            time_to_live_attribute="expires_at",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
         # Lambda Function to call back to CloudFormation
         update_cfn_lambda = LambdaFunction(
             scope=self,
             construct_id="UpdateCfnLambda",
             code=lambda_.Code.from_asset("lambda_functions/update_cfn_custom_resource"),
+            environment={
+                "LATENCY_BUDGETS": json.dumps(
+                    {test_name: asdict(budget) for test_name, budget in budgets.items()}
+                ),
+                "REGRESSION_TOLERANCE": str(regression_tolerance),
+                "REGRESSION_HISTORY_RUNS": str(regression_history_runs),
+                "TIMING_HISTORY_TABLE": self.timing_history_table.table_name,
+                "ACCEPT_TIMINGS": "true" if accept_timings else "false",
+            },
+            timeout=cdk.Duration.seconds(30),
         )
+        self.timing_history_table.grant_read_write_data(update_cfn_lambda.function)
 
         # SFN Step for the CloudFormation Callback Function
         update_cfn_step = sfn_tasks.LambdaInvoke(
@@ -68,33 +150,40 @@ class IntegrationTests(cdk.Construct):
             ),
         )
 
-        integration_test_s3 = IntegrationTestS3(
-            scope=self,
-            construct_id="TestS3",
-            s3_event_notification=s3_event_notification,
-        )
-
-        integration_test_ddb = IntegrationTestDdb(
+        # The shards contain the tests and catch errors, every shard outputs the
+        # result of the last Assert step of each of its tests
+        test_shards = IntegrationTestShards(
             scope=self,
-            construct_id="TestDdb",
-            dynamo_db_streams=dynamo_db_streams,
+            construct_id="Shards",
+            tests=tests,
+            shard_size=shard_size,
+            shard_concurrency=shard_concurrency,
+            test_concurrency=test_concurrency,
         )
-
-        # Parallel step to contain the tests and catch errors
-        parallel = sfn.Parallel(
-            scope=self, id="Parallel Container", output_path="$[*].Payload"
+        test_shards.shards_step.add_catch(
+            handler=update_cfn_step, errors=["States.ALL"]
         )
-        parallel.branch(integration_test_s3.steps)
-        parallel.branch(integration_test_ddb.steps)
-        parallel.add_catch(handler=update_cfn_step, errors=["States.ALL"])
 
         state_machine = sfn.StateMachine(
             self,
             "StateMachine",
-            definition=parallel.next(update_cfn_step),
-            timeout=cdk.Duration.minutes(5),
+            definition=test_shards.steps.next(update_cfn_step),
+            # Allow a minute for the CloudFormation callback
+            timeout=test_shards.timeout.plus(cdk.Duration.minutes(1)),
         )
 
+        self.load_tests = None
+        if load_test_iterations:
+            self.load_tests = LoadTests(
+                scope=self,
+                construct_id="LoadTests",
+                s3_event_notification=s3_event_notification,
+                dynamo_db_streams=dynamo_db_streams,
+                tests=tests,
+                iterations=load_test_iterations,
+                max_concurrency=load_test_max_concurrency,
+            )
+
         # The Lambda Function backing the custom resource
         custom_resource_handler = LambdaFunction(
             scope=self,
@@ -19,6 +19,8 @@ class LambdaFunction(cdk.Construct):
         construct_id: str,
         code: lambda_.Code,
         environment: dict = None,
+        timeout: cdk.Duration = None,
+        layers: list = None,
         **kwargs,
     ) -> None:
         """Construct a new LambdaFunction."""
@@ -43,6 +45,8 @@ class LambdaFunction(cdk.Construct):
             code=code,
             handler="index.event_handler",
             environment=environment,
+            timeout=timeout,
+            layers=layers,
         )
 
         # Create the Lambda Function Log Group
@@ -0,0 +1,25 @@
+"""Module for the latency budgets of the integration tests."""
+
+# Standard library imports
+from dataclasses import dataclass
+
+
+@dataclass
+class LatencyBudget:
+    """
+    The maximum timings of a passing integration test, in seconds.
+
+    The act duration covers the Arrange & Act step, the time to consistency
+    runs from the act until its effect was observed and the assert duration
+    covers the final Assert step. Timings without a budget are not gated.
+    """
+
+    act_duration_seconds: float = None
+    time_to_consistency_seconds: float = None
+    assert_duration_seconds: float = None
+
+    def __post_init__(self):
+        """Validate the budget."""
+        for name, seconds in vars(self).items():
+            if seconds is not None and seconds <= 0:
+                raise ValueError(f"Unsupported {name}: {seconds}")
@@ -0,0 +1,181 @@
+"""Module for the Load Test CDK construct."""
+
+# Standard library imports
+from typing import List
+
+# Third party imports
+from aws_cdk import (
+    core as cdk,
+    aws_lambda as lambda_,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as sfn_tasks,
+)
+
+# Local application/library specific imports
+from serverless_integration_testing_with_step_functions.constructs.lambda_function import (
+    LambdaFunction,
+)
+from serverless_integration_testing_with_step_functions.constructs.s3_event_notifications import (
+    S3EventNotification,
+)
+from serverless_integration_testing_with_step_functions.constructs.dynamo_db_streams import (
+    DynamoDbStreams,
+)
+from serverless_integration_testing_with_step_functions.constructs.integration_test_registry import (
+    RegisteredTest,
+)
+from serverless_integration_testing_with_step_functions.constructs.integration_test_shards import (
+    create_test_steps,
+    grant_invoke_tests,
+)
+
+# The results of all iterations pass through the State Machine, which limits
+# its input and output to 256 KB
+MAX_ITERATIONS = 100
+# Step Functions runs at most 40 iterations of an inline Map concurrently
+MAX_CONCURRENCY = 40
+# The Arrange & Act input of an iteration, which names the data after the
+# execution and the iteration
+ITERATION_INPUT = "States.JsonMerge($.test.arrange_act_input, $.load_test, false)"
+
+
+class LoadTests(cdk.Construct):
+    """CDK Construct for a State Machine which runs the integration tests under load."""
+
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        s3_event_notification: S3EventNotification,
+        dynamo_db_streams: DynamoDbStreams,
+        tests: List[RegisteredTest],
+        iterations: int = 50,
+        max_concurrency: int = 10,
+        **kwargs,
+    ) -> None:
+        """Construct a new LoadTests.
+
+        Every test runs iterations times, at most max_concurrency at a time, with
+        the same steps as the integration tests. Every iteration creates its own
+        test data, named after the execution and the iteration. An iteration
+        which fails with an error counts as a failure. The data of all
+        iterations is removed in batches at the end, and the State Machine
+        returns the throughput and the p50, p95 and p99 time to consistency of
+        every test, with the poll resolution they were measured at.
+
+        The State Machine isn't started by deployments, start it on demand.
+        """
+        super().__init__(scope, construct_id, **kwargs)
+
+        if not 1 <= iterations <= MAX_ITERATIONS:
+            raise ValueError(f"Unsupported iterations: {iterations}")
+        if not 1 <= max_concurrency <= MAX_CONCURRENCY:
+            raise ValueError(f"Unsupported max_concurrency: {max_concurrency}")
+
+        # Lambda Function to aggregate the results and remove the test data
+        report_clean_up_load_test = LambdaFunction(
+            scope=self,
+            construct_id="ReportAndCleanUpLoadTest",
+            code=lambda_.Code.from_asset("integration_tests/report_clean_up_load_test"),
+            environment={
+                "S3_BUCKET": s3_event_notification.s3_bucket.bucket_name,
+                "DDB_TABLE": dynamo_db_streams.table.table_name,
+            },
+            timeout=cdk.Duration.minutes(1),
+        )
+        s3_event_notification.s3_bucket.grant_delete(report_clean_up_load_test.function)
+        dynamo_db_streams.table.grant_write_data(report_clean_up_load_test.function)
+
+        # The tests leave their data for the Report & Clean Up step
+        plan_step = sfn.Pass(
+            scope=self,
+            id="Plan iterations",
+            result=sfn.Result.from_object(
+                {
+                    "tests": [test.state_input(clean_up=False) for test in tests],
+                    "iterations": list(range(iterations)),
+                }
+            ),
+        )
+
+        # Every iteration runs the test with the load_test_run and iteration
+        # added to its Arrange & Act input, which isolate the test data
+        prepare_iteration_step = sfn.Pass(
+            scope=self,
+            id="Prepare iteration",
+            parameters={
+                "test_name": sfn.JsonPath.string_at("$.test.test_name"),
+                "arrange_act_function": sfn.JsonPath.string_at(
+                    "$.test.arrange_act_function"
+                ),
+                "arrange_act_input.$": ITERATION_INPUT,
+                "assert_cleanup_function": sfn.JsonPath.string_at(
+                    "$.test.assert_cleanup_function"
+                ),
+                "assert_input": sfn.JsonPath.string_at("$.test.assert_input"),
+            },
+        )
+        iterations_step = sfn.Map(
+            scope=self,
+            id="Iterations",
+            items_path="$.iterations",
+            max_concurrency=max_concurrency,
+            parameters={
+                "test": sfn.JsonPath.string_at("$.test"),
+                "load_test": {
+                    "load_test_run": sfn.JsonPath.string_at("$$.Execution.Name"),
+                    "iteration": sfn.JsonPath.number_at("$$.Map.Item.Value"),
+                },
+            },
+        )
+
+        # An error fails only its own iteration, which is reported as a failure
+        # with the input the Report & Clean Up step needs to remove its data
+        iteration_step = sfn.Parallel(
+            scope=self, id="Iteration", output_path="$[0]"
+        ).branch(prepare_iteration_step.next(create_test_steps(self)))
+        iteration_step.add_catch(
+            handler=sfn.Pass(
+                scope=self,
+                id="Iteration failed",
+                parameters={
+                    "pending": False,
+                    "success": False,
+                    "test_name": sfn.JsonPath.string_at("$.test.test_name"),
+                    "error_message": sfn.JsonPath.string_at("$.error.Error"),
+                    "arrange_act_input.$": ITERATION_INPUT,
+                },
+            ),
+            errors=["States.ALL"],
+            result_path="$.error",
+        )
+        iterations_step.iterator(iteration_step)
+
+        # Every test runs its iterations at the same time as the other tests
+        tests_step = sfn.Map(
+            scope=self,
+            id="Tests",
+            items_path="$.tests",
+            parameters={
+                "test": sfn.JsonPath.string_at("$$.Map.Item.Value"),
+                "iterations": sfn.JsonPath.list_at("$.iterations"),
+            },
+        )
+        tests_step.iterator(iterations_step)
+
+        # SFN Step to aggregate the results and remove the test data
+        report_step = sfn_tasks.LambdaInvoke(
+            scope=self,
+            id="Report & Clean Up",
+            lambda_function=report_clean_up_load_test.function,
+            payload=sfn.TaskInput.from_object({"results": sfn.JsonPath.string_at("$")}),
+            payload_response_only=True,
+        )
+
+        self.state_machine = sfn.StateMachine(
+            self,
+            "StateMachine",
+            definition=plan_step.next(tests_step).next(report_step),
+            timeout=cdk.Duration.hours(1),
+        )
+        grant_invoke_tests(tests, self.state_machine)
@@ -3,12 +3,20 @@
 # Third party imports
 from aws_cdk import (
     core as cdk,
+    aws_dynamodb as dynamodb,
     aws_s3 as s3,
     aws_s3_notifications as s3n,
+    aws_sqs as sqs,
     aws_lambda as lambda_,
+    aws_lambda_event_sources as lambda_event_sources,
 )
 
 # Local application/library specific imports
+from serverless_integration_testing_with_step_functions.constructs.instrumentation import (
+    METRICS_NAMESPACE,
+    create_alarms,
+    instrumentation_layer,
+)
 from serverless_integration_testing_with_step_functions.constructs.lambda_function import (
     LambdaFunction,
 )
@@ -21,17 +29,121 @@ class S3EventNotification(cdk.Construct):
         self,
         scope: cdk.Construct,
         construct_id: str,
+        fetch_mode: str = "ranged",
+        storage_mode: str = "metadata",
+        max_concurrency: int = 10,
+        sqs_buffer: bool = False,
+        batch_size: int = 10,
+        max_batching_window: cdk.Duration = None,
+        idempotency_table: bool = False,
+        multipart_copy_threshold: int = 512 * 1024**2,
+        processor_timeout: cdk.Duration = None,
+        dimension_index: bool = False,
+        lag_alarm_threshold: cdk.Duration = None,
+        error_rate_alarm_threshold: float = None,
         **kwargs,
     ) -> None:
-        """Construct a new S3EventNotification."""
+        """Construct a new S3EventNotification.
+
+        The fetch_mode determines how the upload processor reads images: "ranged"
+        only fetches the leading bytes of each object, "download" fetches the
+        entire object.
+
+        The storage_mode determines where the dimensions are written: "metadata"
+        copies the object onto itself with new user metadata (which emits a
+        second ObjectCreated:Copy event), "tags" stores them as object tags
+        without rewriting the object or triggering another invocation. In
+        "metadata" mode objects larger than multipart_copy_threshold bytes are
+        rewritten with a parallel multipart copy; raise the processor_timeout
+        (30 seconds by default) when processing very large objects.
+
+        The max_concurrency bounds how many records of one batch the upload
+        processor handles in parallel.
+
+        With sqs_buffer enabled, notifications go to an SQS queue which the upload
+        processor consumes in batches of batch_size messages, waiting at most
+        max_batching_window to fill a batch. Failed records are reported as
+        partial batch failures, messages failing repeatedly end up in a DLQ.
+
+        The upload processor suppresses duplicate notifications with an in-memory
+        cache per container. With idempotency_table enabled, processed events are
+        also recorded in a DynamoDB table shared by all containers. Events being
+        processed are claimed for the processor_timeout only, so a retry after a
+        timeout isn't suppressed.
+
+        With dimension_index enabled, the dimensions are also written to a
+        DynamoDB table keyed by object key, with GSIs for range queries on width
+        and height. Deleted objects are removed from the index.
+
+        The upload processor publishes embedded metrics per event name: record
+        counts, errors, bytes read and the lag between an upload and its
+        processing. With lag_alarm_threshold set, an alarm fires when the lag
+        stays above it for three minutes. With error_rate_alarm_threshold set, an
+        alarm fires when more than that percentage of the records fails for three
+        minutes.
+        """
         super().__init__(scope, construct_id, **kwargs)
 
+        if fetch_mode not in ("ranged", "download"):
+            raise ValueError(f"Unsupported fetch_mode: {fetch_mode}")
+        if storage_mode not in ("metadata", "tags"):
+            raise ValueError(f"Unsupported storage_mode: {storage_mode}")
+        self.storage_mode = storage_mode
+        self.max_batching_window = max_batching_window if sqs_buffer else None
+        self.idempotency_table = None
+        self.dimension_index_table = None
+        self.alarms = []
+
         # Create a Lambda Function to process image uploads
+        processor_timeout = processor_timeout or cdk.Duration.seconds(30)
         upload_processor = LambdaFunction(
             scope=self,
             construct_id="UploadProcessor",
             code=lambda_.Code.from_asset("lambda_functions/s3_upload_processor"),
+            environment={
+                "FETCH_MODE": fetch_mode,
+                "STORAGE_MODE": storage_mode,
+                "MAX_CONCURRENCY": str(max_concurrency),
+                "MULTIPART_COPY_THRESHOLD": str(multipart_copy_threshold),
+                "METRICS_NAMESPACE": METRICS_NAMESPACE,
+                # An event is claimed while it is processed, until the processor
+                # would have timed out, so a retry after a timeout or crash
+                # processes it again
+                "IDEMPOTENCY_IN_PROGRESS_SECONDS": str(
+                    int(processor_timeout.to_seconds())
+                ),
+            },
+            timeout=processor_timeout,
+            layers=[instrumentation_layer(self)],
         )
+        self.alarms = create_alarms(
+            scope=self,
+            function=upload_processor.function,
+            lag_alarm_threshold=lag_alarm_threshold,
+            error_rate_alarm_threshold=error_rate_alarm_threshold,
+        )
+
+        if idempotency_table:
+            # Processed events expire after a day, well past S3's redelivery window
+            self.idempotency_table = dynamodb.Table(
+                scope=self,
+                id="IdempotencyTable",
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                partition_key=dynamodb.Attribute(
+                    name="PK", type=dynamodb.AttributeType.STRING
+                ),
+                time_to_live_attribute="expires_at",
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+            )
+            self.idempotency_table.grant_read_write_data(upload_processor.function)
+            upload_processor.function.add_environment(
+                "IDEMPOTENCY_TABLE", self.idempotency_table.table_name
+            )
+
+        if dimension_index:
+            self.dimension_index_table = self._create_dimension_index(
+                upload_processor=upload_processor
+            )
 
         # Create an S3 bucket to upload images to
         self.s3_bucket = s3.Bucket(
@@ -39,15 +151,119 @@ class S3EventNotification(cdk.Construct):
         )
 
         # Send out an event when images are uploaded
-        supported_extensions = ["jpeg", "jpg", "gif", "png"]
-        for ext in supported_extensions:
-            self.s3_bucket.add_event_notification(
-                s3.EventType.OBJECT_CREATED,
-                s3n.LambdaDestination(fn=upload_processor.function),
-                s3.NotificationKeyFilter(
-                    suffix=f".{ext}",
-                ),
+        supported_extensions = [
+            "jpeg",
+            "jpg",
+            "gif",
+            "png",
+            "webp",
+            "bmp",
+            "tif",
+            "tiff",
+            "heic",
+            "heif",
+            "avif",
+        ]
+        if sqs_buffer:
+            notification_destination = self._create_sqs_buffer(
+                upload_processor=upload_processor,
+                batch_size=batch_size,
+                max_batching_window=max_batching_window,
             )
+        else:
+            notification_destination = s3n.LambdaDestination(
+                fn=upload_processor.function
+            )
+
+        # Deletes are only needed to keep the dimension index up to date
+        event_types = [s3.EventType.OBJECT_CREATED]
+        if dimension_index:
+            event_types.append(s3.EventType.OBJECT_REMOVED)
 
-        # Allow the Lambda Function to write metadata to the bucket
+        for event_type in event_types:
+            for ext in supported_extensions:
+                self.s3_bucket.add_event_notification(
+                    event_type,
+                    notification_destination,
+                    s3.NotificationKeyFilter(
+                        suffix=f".{ext}",
+                    ),
+                )
+
+        # Allow the Lambda Function to write metadata and tags to the bucket
         self.s3_bucket.grant_read_write(upload_processor.function)
+
+    def _create_dimension_index(
+        self, upload_processor: LambdaFunction
+    ) -> dynamodb.Table:
+        """Create the table with the queryable dimensions of every image."""
+        table = dynamodb.Table(
+            scope=self,
+            id="DimensionIndexTable",
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            partition_key=dynamodb.Attribute(
+                name="PK", type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # The GSIs are partitioned over a number of shards so a high write rate
+        # isn't throttled by a single GSI partition.
+        for index_name, sort_key in (
+            ("WidthIndex", "image_width"),
+            ("HeightIndex", "image_height"),
+        ):
+            table.add_global_secondary_index(
+                index_name=index_name,
+                partition_key=dynamodb.Attribute(
+                    name="shard", type=dynamodb.AttributeType.STRING
+                ),
+                sort_key=dynamodb.Attribute(
+                    name=sort_key, type=dynamodb.AttributeType.NUMBER
+                ),
+            )
+
+        table.grant_read_write_data(upload_processor.function)
+        upload_processor.function.add_environment(
+            "DIMENSION_INDEX_TABLE", table.table_name
+        )
+        upload_processor.function.add_environment("DIMENSION_INDEX_SHARDS", "10")
+        return table
+
+    def _create_sqs_buffer(
+        self,
+        upload_processor: LambdaFunction,
+        batch_size: int,
+        max_batching_window: cdk.Duration,
+    ) -> s3n.SqsDestination:
+        """Create the queue between the bucket and the upload processor."""
+        # Objects which can't be processed after three attempts end up here
+        dead_letter_queue = sqs.Queue(
+            scope=self,
+            id="UploadDeadLetterQueue",
+            retention_period=cdk.Duration.days(14),
+        )
+
+        # The visibility timeout should be at least six times the function timeout
+        upload_queue = sqs.Queue(
+            scope=self,
+            id="UploadQueue",
+            visibility_timeout=cdk.Duration.seconds(
+                6 * upload_processor.function.timeout.to_seconds()
+            ),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3, queue=dead_letter_queue
+            ),
+        )
+
+        upload_processor.function.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                queue=upload_queue,
+                batch_size=batch_size,
+                max_batching_window=max_batching_window,
+                report_batch_item_failures=True,
+            )
+        )
+
+        return s3n.SqsDestination(queue=upload_queue)
@@ -13,6 +13,15 @@ from serverless_integration_testing_with_step_functions.constructs.s3_event_noti
 from serverless_integration_testing_with_step_functions.constructs.dynamo_db_streams import (
     DynamoDbStreams,
 )
+from serverless_integration_testing_with_step_functions.constructs.integration_test_registry import (
+    IntegrationTestRegistry,
+)
+from serverless_integration_testing_with_step_functions.constructs.integration_test_s3 import (
+    IntegrationTestS3,
+)
+from serverless_integration_testing_with_step_functions.constructs.integration_test_ddb import (
+    IntegrationTestDdb,
+)
 from serverless_integration_testing_with_step_functions.constructs.integration_tests import (
     IntegrationTests,
 )
@@ -38,9 +47,36 @@ class ServerlessIntegrationTestingWithStepFunctionsStack(cdk.Stack):
             scope=self, construct_id="DynamoDbStreamsConstruct"
         )
 
+        # Every test construct registers its tests, a new test is a new construct
+        registry = IntegrationTestRegistry()
+        IntegrationTestS3(
+            scope=self,
+            construct_id="TestS3",
+            s3_event_notification=s3_event_notification,
+            registry=registry,
+        )
+        IntegrationTestDdb(
+            scope=self,
+            construct_id="TestDdb",
+            dynamo_db_streams=dynamo_db_streams,
+            registry=registry,
+        )
+
+        # Run a selection of the tests with eg. -c test_tags=s3,ddb_create
+        test_tags = self.node.try_get_context("test_tags")
+        # Deploy the load test State Machine with eg. -c load_test_iterations=50
+        load_test_iterations = self.node.try_get_context("load_test_iterations")
         IntegrationTests(
             scope=self,
             construct_id="IntegrationTests",
             s3_event_notification=s3_event_notification,
             dynamo_db_streams=dynamo_db_streams,
+            registry=registry,
+            test_tags=test_tags.split(",") if test_tags else None,
+            load_test_iterations=int(load_test_iterations or 0),
+            load_test_max_concurrency=int(
+                self.node.try_get_context("load_test_max_concurrency") or 10
+            ),
+            # Accept the timings of an intentional slowdown with -c accept_timings=true
+            accept_timings=self.node.try_get_context("accept_timings") == "true",
         )
@@ -17,11 +17,16 @@ setuptools.setup(
         where="serverless_integration_testing_with_step_functions"
     ),
     install_requires=[
+        "aws-cdk.aws_cloudwatch==1.137.0",
         "aws-cdk.aws_dynamodb==1.137.0",
+        "aws-cdk.aws_iam==1.137.0",
+        "aws-cdk.aws_kinesisfirehose==1.137.0",
+        "aws-cdk.aws_lambda_event_sources==1.137.0",
         "aws-cdk.aws_lambda==1.137.0",
         "aws-cdk.aws_logs==1.137.0",
         "aws-cdk.aws_s3_notifications==1.137.0",
         "aws-cdk.aws_s3==1.137.0",
+        "aws-cdk.aws_sqs==1.137.0",
         "aws-cdk.aws_stepfunctions_tasks==1.137.0",
         "aws-cdk.aws_stepfunctions==1.137.0",
         "aws-cdk.core==1.137.0",
@@ -31,6 +36,12 @@ setuptools.setup(
         "python-dotenv==0.17.0",
         "stringcase==1.2.0",
     ],
+    extras_require={
+        "test": [
+            "moto==5.0.28",
+            "pytest==7.4.4",
+        ],
+    },
     python_requires=">=3.7",
     classifiers=[
         "Development Status :: 4 - Beta",
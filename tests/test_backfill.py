@@ -0,0 +1,161 @@
+"""Tests for the backfill of the upload processor, against moto's S3 and DynamoDB."""
+
+# Standard library imports
+import json
+import os
+import struct
+import sys
+import zlib
+
+# Third party imports
+import boto3
+import pytest
+from moto import mock_aws
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "lambda_functions", "s3_upload_processor"))
+
+BUCKET_NAME = "backfill-test-bucket"
+INDEX_TABLE_NAME = "dimension-index"
+
+
+def png(width, height):
+    """Return the signature and IHDR chunk of a PNG, all the parser reads."""
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    crc = zlib.crc32(b"IHDR" + ihdr)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + struct.pack(">I", len(ihdr))
+        + b"IHDR"
+        + ihdr
+        + struct.pack(">I", crc)
+    )
+
+
+@pytest.fixture(name="backfill")
+def fixture_backfill(monkeypatch):
+    """Return a freshly imported backfill module, with a bucket and index table."""
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("DIMENSION_INDEX_TABLE", INDEX_TABLE_NAME)
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET_NAME)
+        boto3.client("dynamodb").create_table(
+            TableName=INDEX_TABLE_NAME,
+            KeySchema=[{"AttributeName": "PK", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "PK", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        # The processor creates its clients and index at import time
+        for module in ("backfill", "index"):
+            sys.modules.pop(module, None)
+        import backfill  # pylint: disable=import-error,import-outside-toplevel
+
+        yield backfill
+        for module in ("backfill", "index"):
+            sys.modules.pop(module, None)
+
+
+def put_object(object_key, body, metadata=None):
+    """Upload an object to the test bucket."""
+    boto3.client("s3").put_object(
+        Bucket=BUCKET_NAME, Key=object_key, Body=body, Metadata=metadata or {}
+    )
+
+
+def indexed_dimensions(object_key):
+    """Return the (width, height) in the dimension index, or None."""
+    item = (
+        boto3.client("dynamodb")
+        .get_item(TableName=INDEX_TABLE_NAME, Key={"PK": {"S": object_key}})
+        .get("Item")
+    )
+    if not item:
+        return None
+    return int(item["image_width"]["N"]), int(item["image_height"]["N"])
+
+
+def test_backfill_stores_and_indexes_missing_dimensions(backfill, tmp_path):
+    """Objects without dimensions are parsed, all images are indexed."""
+    put_object("new.png", png(640, 480))
+    put_object("done.png", png(10, 20), {"image_width": "10", "image_height": "20"})
+    # Already processed, so it's skipped without reading the image
+    put_object(
+        "unparseable_done.png",
+        b"not an image",
+        {"image_width": "30", "image_height": "40"},
+    )
+    put_object("broken.png", b"not an image")
+    put_object("readme.txt", b"not an image either")
+
+    checkpoint_path = tmp_path / "checkpoint.json"
+    progress = backfill.backfill(BUCKET_NAME, checkpoint_path=str(checkpoint_path))
+
+    assert progress.objects_updated == 1
+    assert progress.objects_skipped == 2
+    assert progress.objects_failed == 1
+    assert progress.failed_keys == ["broken.png"]
+    assert progress.bytes_read == len(png(640, 480))
+    assert progress.start_after == "unparseable_done.png"
+    assert json.loads(checkpoint_path.read_text())["objects_updated"] == 1
+
+    metadata = boto3.client("s3").head_object(Bucket=BUCKET_NAME, Key="new.png")[
+        "Metadata"
+    ]
+    # moto returns the underscores of metadata keys as hyphens
+    assert {key.replace("-", "_"): value for key, value in metadata.items()} == {
+        "image_width": "640",
+        "image_height": "480",
+    }
+    assert indexed_dimensions("new.png") == (640, 480)
+    assert indexed_dimensions("done.png") == (10, 20)
+    assert indexed_dimensions("unparseable_done.png") == (30, 40)
+    assert indexed_dimensions("broken.png") is None
+
+
+def test_backfill_resumes_from_checkpoint(backfill, tmp_path):
+    """A second run starts after the last completed page."""
+    put_object("a.png", png(1, 2))
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    backfill.backfill(BUCKET_NAME, checkpoint_path=checkpoint_path)
+
+    put_object("b.png", png(3, 4))
+    progress = backfill.backfill(BUCKET_NAME, checkpoint_path=checkpoint_path)
+
+    assert progress.objects_updated == 2
+    assert progress.objects_skipped == 0
+    assert progress.start_after == "b.png"
+
+
+def test_backfill_retries_failed_objects(backfill, tmp_path):
+    """A resumed run retries the objects which failed, before it lists more."""
+    put_object("a.png", b"not an image yet")
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    progress = backfill.backfill(BUCKET_NAME, checkpoint_path=checkpoint_path)
+    assert progress.failed_keys == ["a.png"]
+
+    put_object("a.png", png(7, 8))
+    put_object("b.png", b"not an image")
+    progress = backfill.backfill(BUCKET_NAME, checkpoint_path=checkpoint_path)
+
+    assert progress.objects_updated == 1
+    assert progress.objects_failed == 1
+    assert progress.failed_keys == ["b.png"]
+    assert indexed_dimensions("a.png") == (7, 8)
+
+
+def test_backfill_tags_mode(backfill):
+    """In tags mode the dimensions are looked up and stored as object tags."""
+    put_object("a.png", png(5, 6))
+    progress = backfill.backfill(BUCKET_NAME, storage_mode="tags")
+    assert progress.objects_updated == 1
+
+    progress = backfill.backfill(BUCKET_NAME, storage_mode="tags")
+    assert progress.objects_skipped == 1
+    assert progress.bytes_read == 0
+    tags = boto3.client("s3").get_object_tagging(Bucket=BUCKET_NAME, Key="a.png")
+    assert {tag["Key"]: tag["Value"] for tag in tags["TagSet"]} == {
+        "image_width": "5",
+        "image_height": "6",
+    }
@@ -0,0 +1,226 @@
+"""Tests for the audit log sinks of the stream processor, against moto."""
+
+# Standard library imports
+import importlib.util
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+# Third party imports
+import boto3
+import pytest
+from moto import mock_aws
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSOR_DIR = os.path.join(REPO_ROOT, "lambda_functions", "ddb_stream_processor")
+# Appended, the upload processor has an index module of its own
+sys.path.append(PROCESSOR_DIR)
+sys.path.append(os.path.join(REPO_ROOT, "lambda_layers", "instrumentation", "python"))
+
+# Local application/library specific imports
+import sinks  # pylint: disable=import-error,wrong-import-position
+
+LOG_GROUP_NAME = "audit-log"
+DELIVERY_STREAM_NAME = "audit-stream"
+AUDIT_BUCKET_NAME = "audit-test-bucket"
+CONTEXT = SimpleNamespace(log_stream_name="2022/01/01/[$LATEST]0123456789abcdef")
+AUDIT_ROUTES = [
+    {
+        "key_prefix": "USER#",
+        "event_name": "INSERT",
+        "event_type": "UserCreated",
+        "handler": "new_image",
+    }
+]
+
+
+class RejectingFirehose:
+    """Firehose client which rejects some records, and delivers the others."""
+
+    def __init__(self, firehose_client, rejections):
+        """Reject every record data in rejections as often as its count says."""
+        self.firehose_client = firehose_client
+        self.rejections = dict(rejections)
+        self.batch_sizes = []
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        # pylint: disable=invalid-name
+        """Deliver the records which aren't rejected, in the order of the batch."""
+        self.batch_sizes.append(len(Records))
+        results = []
+        for record in Records:
+            if self.rejections.get(record["Data"], 0) > 0:
+                self.rejections[record["Data"]] -= 1
+                results.append({"ErrorCode": "ServiceUnavailableException"})
+                continue
+            self.firehose_client.put_record_batch(
+                DeliveryStreamName=DeliveryStreamName, Records=[record]
+            )
+            results.append({"RecordId": "delivered"})
+        return {
+            "FailedPutCount": sum("ErrorCode" in result for result in results),
+            "RequestResponses": results,
+        }
+
+
+@pytest.fixture(name="aws")
+def fixture_aws(monkeypatch):
+    """Mock AWS with an audit Log Group and a delivery stream to S3."""
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    # The sinks back off between attempts
+    monkeypatch.setattr(sinks.time, "sleep", lambda seconds: None)
+    with mock_aws():
+        boto3.client("logs").create_log_group(logGroupName=LOG_GROUP_NAME)
+        boto3.client("s3").create_bucket(Bucket=AUDIT_BUCKET_NAME)
+        boto3.client("firehose").create_delivery_stream(
+            DeliveryStreamName=DELIVERY_STREAM_NAME,
+            ExtendedS3DestinationConfiguration={
+                "RoleARN": "arn:aws:iam::123456789012:role/firehose",
+                "BucketARN": f"arn:aws:s3:::{AUDIT_BUCKET_NAME}",
+            },
+        )
+        yield
+
+
+def log_events(count, message_bytes=10, start=None):
+    """Return count log events, one millisecond apart."""
+    start = start or int(time.time() * 1000)
+    return [
+        {"timestamp": start + position, "message": str(position).zfill(message_bytes)}
+        for position in range(count)
+    ]
+
+
+def test_chunk_log_events_limits():
+    """Chunks stay within the event count, size and time span of PutLogEvents."""
+    assert [len(chunk) for chunk in sinks.chunk_log_events(log_events(10001))] == [
+        10000,
+        1,
+    ]
+
+    # 100 events per MiB once the overhead per event is counted
+    message_bytes = sinks.MAX_BYTES_PER_CALL // 100 - sinks.EVENT_OVERHEAD_BYTES
+    chunks = list(sinks.chunk_log_events(log_events(101, message_bytes)))
+    assert [len(chunk) for chunk in chunks] == [100, 1]
+
+    events = log_events(2) + log_events(1, start=int(time.time() * 1000) + 86400001)
+    assert [len(chunk) for chunk in sinks.chunk_log_events(events)] == [2, 1]
+
+
+def test_chunk_records_limits():
+    """Batches stay within the record count and size of PutRecordBatch."""
+    assert [len(batch) for batch in sinks.chunk_records([b"x"] * 1001)] == [
+        500,
+        500,
+        1,
+    ]
+    record = b"x" * (1024 * 1024)
+    assert [len(batch) for batch in sinks.chunk_records([record] * 5)] == [4, 1]
+
+
+def test_cloudwatch_logs_sink_writes_every_event(aws):
+    """Every event is written in order, to the stream of the environment."""
+    sink = sinks.CloudWatchLogsSink(boto3.client("logs"), LOG_GROUP_NAME)
+    events = log_events(3)
+
+    assert sink.write(events, CONTEXT) == [0, 1, 2]
+    assert sink.write(log_events(2), CONTEXT) == [0, 1]
+
+    log_stream_name = sinks.audit_log_stream_name(CONTEXT)
+    written = boto3.client("logs").get_log_events(
+        logGroupName=LOG_GROUP_NAME,
+        logStreamName=log_stream_name,
+        startFromHead=True,
+    )["events"]
+    assert [event["message"] for event in written[:3]] == [
+        event["message"] for event in events
+    ]
+    assert len(written) == 5
+
+
+def test_cloudwatch_logs_sink_stops_at_failed_chunk(aws):
+    """The written events are the ones before the first chunk which failed."""
+    sink = sinks.CloudWatchLogsSink(boto3.client("logs"), "missing-log-group")
+    assert sink.write(log_events(3), CONTEXT) == []
+
+
+def test_firehose_sink_batches_records(aws):
+    """Records are delivered in batches of at most 500."""
+    firehose = RejectingFirehose(boto3.client("firehose"), {})
+    sink = sinks.FirehoseSink(firehose, DELIVERY_STREAM_NAME)
+
+    assert sink.write(log_events(1200), CONTEXT) == list(range(1200))
+    assert firehose.batch_sizes == [500, 500, 200]
+    assert sink.calls == 3
+
+
+def test_firehose_sink_retries_rejected_records(aws):
+    """Rejected records are sent again, until they are delivered."""
+    events = log_events(5)
+    firehose = RejectingFirehose(
+        boto3.client("firehose"), {f"{events[1]['message']}\n".encode("utf-8"): 2}
+    )
+    sink = sinks.FirehoseSink(firehose, DELIVERY_STREAM_NAME)
+
+    assert sink.write(events, CONTEXT) == [0, 1, 2, 3, 4]
+    assert firehose.batch_sizes == [5, 1, 1]
+
+
+def test_firehose_sink_returns_every_delivered_record(aws):
+    """Records after one which is never delivered count as written."""
+    events = log_events(5)
+    firehose = RejectingFirehose(
+        boto3.client("firehose"),
+        {f"{events[1]['message']}\n".encode("utf-8"): sinks.MAX_BATCH_ATTEMPTS},
+    )
+    sink = sinks.FirehoseSink(firehose, DELIVERY_STREAM_NAME)
+
+    assert sink.write(events, CONTEXT) == [0, 2, 3, 4]
+    assert sink.calls == sinks.MAX_BATCH_ATTEMPTS
+
+
+def stream_record(position):
+    """Return an INSERT stream record of a user."""
+    key = {"PK": {"S": f"USER#{position}"}, "SK": {"S": f"USER#{position}"}}
+    return {
+        "eventID": f"event-{position}",
+        "eventName": "INSERT",
+        "dynamodb": {
+            "SequenceNumber": str(100 + position),
+            "ApproximateCreationDateTime": 1640995200 + position,
+            "Keys": key,
+            "NewImage": key,
+        },
+    }
+
+
+def test_process_batch_records_delivered_events(aws, monkeypatch):
+    """Only the events the sink wrote are recorded, the batch retries the rest."""
+    monkeypatch.setenv("AUDIT_SINK", "firehose")
+    monkeypatch.setenv("AUDIT_DELIVERY_STREAM_NAME", DELIVERY_STREAM_NAME)
+    monkeypatch.setenv("AUDIT_ROUTES", json.dumps(AUDIT_ROUTES))
+    spec = importlib.util.spec_from_file_location(
+        "ddb_stream_processor_index", os.path.join(PROCESSOR_DIR, "index.py")
+    )
+    index = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(index)
+
+    records = [stream_record(position) for position in range(4)]
+    rejected = index.to_log_event(records[1], AUDIT_ROUTES[0])["message"]
+    index.sink.firehose_client = RejectingFirehose(
+        boto3.client("firehose"),
+        {f"{rejected}\n".encode("utf-8"): sinks.MAX_BATCH_ATTEMPTS},
+    )
+
+    response = index.process_batch({"Records": records}, CONTEXT)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "101"}]}
+    assert index.ledger.find_logged([record["eventID"] for record in records]) == {
+        "event-0",
+        "event-2",
+        "event-3",
+    }